@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Compare the throughput of the capture of command output when it is
+spliced into files by the kernel and when it is copied through Python.
+
+Usage::
+
+    python benchmarks/output_throughput.py [--size 512M] [--repeat 3]
+
+The output of a command is written into a file standing for the terminal and
+into a log file, the way it is done when executing steps with ``--log-dir``.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ci.output import ZERO_COPY, FileSink, OutputMultiplexer  # noqa: E402
+from ci.utils import parse_size  # noqa: E402
+
+import subprocess  # noqa: E402
+
+PRODUCER = r"""
+import os, sys
+line = b"x" * 79 + b"\n"
+chunk = line * (64 * 1024 // len(line))
+remaining = int(sys.argv[1])
+while remaining > 0:
+    remaining -= os.write(1, chunk[:remaining])
+"""
+
+
+def measure(size, zero_copy, with_tail):
+    """Return the number of seconds needed to capture ``size`` bytes.
+    """
+    directory = tempfile.mkdtemp()
+    terminal_path = os.path.join(directory, "terminal")
+    log_path = os.path.join(directory, "log")
+    try:
+        with open(terminal_path, "wb") as terminal, \
+                open(log_path, "wb") as log:
+            sinks = [FileSink(terminal), (FileSink(log), b"")]
+            if with_tail:
+                from ci.output import TailBuffer
+                sinks.append(TailBuffer())
+            multiplexer = OutputMultiplexer(zero_copy=zero_copy)
+            start = time.time()
+            process = subprocess.Popen(
+                [sys.executable, "-c", PRODUCER, str(size)],
+                stdout=subprocess.PIPE)
+            multiplexer.register(process.stdout, sinks)
+            multiplexer.run()
+            process.wait()
+            duration = time.time() - start
+            multiplexer.close()
+        assert os.path.getsize(log_path) == size
+        return duration
+    finally:
+        for path in (terminal_path, log_path):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", default="512M")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    size = parse_size(args.size)
+
+    print("Zero-copy available: %s" % ZERO_COPY)
+    print("%-30s %10s %12s" % ("mode", "seconds", "MiB/s"))
+    for label, zero_copy, with_tail in [
+            ("read/write", False, False),
+            ("read/write + tail", False, True),
+            ("tee/splice", True, False),
+            ("tee/splice + tail", True, True)]:
+        if zero_copy and not ZERO_COPY:
+            continue
+        duration = min([measure(size, zero_copy, with_tail)
+                        for _ in range(args.repeat)])
+        print("%-30s %10.3f %12.1f" % (
+            label, duration, size / duration / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,10 @@ scikit-ci enables a centralized and simpler CI configuration for Python
 extensions.
 """
 
+import importlib
+import sys
+
 from .constants import STEPS
-from .driver import execute_step
 from .exceptions import SKCIError
 from ._version import get_versions
 
@@ -16,3 +18,21 @@ __version__ = get_versions()['version']
 del get_versions
 
 __all__ = ["execute_step", "SKCIError", "STEPS"]
+
+
+def __getattr__(name):
+    """Import :mod:`ci.driver` and the other submodules on first use (see
+    PEP 562) so that invocations forwarded to a daemon do not pay for it.
+    """
+    if name == "execute_step":
+        from .driver import execute_step
+        return execute_step
+    try:
+        return importlib.import_module("%s.%s" % (__name__, name))
+    except ImportError:
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    from .driver import execute_step  # noqa: F401
@@ -7,6 +7,9 @@ Ci command line tool (enable python -m ci syntax)
 import argparse
 import ci
 import os
+import sys
+
+from ci.constants import SCIKIT_CI_CONFIG
 
 
 class _OptionalStep(argparse.Action):
@@ -30,16 +33,199 @@ class _OptionalStep(argparse.Action):
             setattr(namespace, self.dest, value)
 
 
-def main():
+def _add_max_jobs_argument(parser):
+    parser.add_argument(
+        "--max-jobs", type=int, default=None, metavar="N",
+        help="number of job slots of the GNU make jobserver shared by "
+             "scikit-ci and the commands it executes. 0 disables the "
+             "jobserver (default: the jobserver inherited through "
+             "MAKEFLAGS if any, otherwise no jobserver)"
+    )
+
+
+def matrix_main(argv):
+    """Execute a step for all the entries of the ``matrix`` section.
+
+    Options that are not recognized are forwarded to the ``ci`` process
+    executing each entry.
+    """
+    from ci.driver import Driver, dependent_steps, step_resources
+    from ci.jobserver import jobserver
+    from ci.matrix import MatrixRunner, expand_matrix
+    from ci.resources import AdmissionController
+    from ci.utils import available_memory, cpu_count
+
+    parser = argparse.ArgumentParser(
+        prog="ci matrix",
+        description="Execute a step for all the entries of the matrix "
+                    "section in isolated work directories.")
+    parser.add_argument(
+        "step", type=str, nargs='?', default=ci.STEPS[-1],
+        action=_OptionalStep, metavar='STEP',
+        help="name of the step to execute for each entry."
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=cpu_count(),
+        help="maximum number of entries executed concurrently "
+             "(default: %(default)s)"
+    )
+    _add_max_jobs_argument(parser)
+    parser.add_argument(
+        "--fail-fast", action="store_true",
+        help="stop all entries as soon as one of them fails"
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="also display the output of entries, each line being prefixed "
+             "with the name of the entry"
+    )
+    parser.add_argument(
+        "--config", default=SCIKIT_CI_CONFIG,
+        help="path to the configuration file (default: %(default)s)"
+    )
+    args, ci_args = parser.parse_known_args(argv)
+
+    server = None
+    try:
+        matrix = Driver.load_config(args.config).get("matrix")
+        if not matrix:
+            raise ci.SKCIError("%s has no matrix section" % args.config)
+        server = jobserver(args.max_jobs)
+        admission = AdmissionController(
+            memory=available_memory(), cpus=args.max_jobs or cpu_count())
+        MatrixRunner(
+            args.step, args.config, max_workers=args.jobs,
+            fail_fast=args.fail_fast, ci_args=ci_args, log=Driver.log,
+            jobserver=server, admission=admission,
+            stream_output=args.stream,
+            resources=step_resources(
+                dependent_steps(args.step) + [args.step], args.config)
+        ).run(expand_matrix(matrix))
+    except ci.SKCIError as exc:
+        exit(exc)
+    finally:
+        if server is not None:
+            server.close()
+
+
+def stats_main(argv):
+    """Display statistics about the durations of steps and commands
+    recorded during previous executions.
+    """
+    from ci.timings import TIMINGS_DB, format_statistics, load_statistics
+
+    parser = argparse.ArgumentParser(
+        prog="ci stats",
+        description="Display the percentiles and trend of the durations of "
+                    "steps and the slowest commands recorded during "
+                    "previous executions.")
+    parser.add_argument(
+        "step", type=str, nargs='?', default=None,
+        action=_OptionalStep, metavar='STEP',
+        help="only consider this step"
+    )
+    parser.add_argument(
+        "--service", default=None,
+        help="only consider executions on this service (e.g travis)"
+    )
+    parser.add_argument(
+        "--os", default=None, dest="operating_system",
+        help="only consider executions on this operating system"
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, metavar="N",
+        help="number of slowest commands displayed (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--db", default=TIMINGS_DB,
+        help="path to the timing database (default: %(default)s)"
+    )
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        exit(ci.SKCIError("%s does not exist" % args.db))
+    print(format_statistics(
+        load_statistics(args.db, step=args.step, service=args.service,
+                        operating_system=args.operating_system),
+        top=args.top))
+
+
+def compile_main(argv):
+    """Write the plan of the steps defined in the configuration file for the
+    current service and operating system.
+    """
+    from ci.driver import compile_plan
+    from ci.plan import PLAN_FILE
+
+    parser = argparse.ArgumentParser(
+        prog="ci compile",
+        description="Write the definition of all steps for the current "
+                    "service and operating system into a JSON plan that "
+                    "can be executed using 'ci --plan' without parsing the "
+                    "configuration file.")
+    parser.add_argument(
+        "--config", default=SCIKIT_CI_CONFIG,
+        help="path to the configuration file (default: %(default)s)"
+    )
+    parser.add_argument(
+        "-o", "--output", default=PLAN_FILE,
+        help="path of the plan (default: %(default)s)"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        plan = compile_plan(args.output, args.config)
+    except (ci.SKCIError, LookupError, ValueError) as exc:
+        exit(ci.SKCIError(exc))
+    print("[scikit-ci] Plan of %d steps written into %s" % (
+        len(plan["steps"]), args.output))
+
+
+COMMANDS = {
+    "compile": compile_main,
+    "matrix": matrix_main,
+    "stats": stats_main
+}
+"""Commands available in addition to the execution of steps."""
+
+
+def main(argv=None, use_daemon=True):
     """The main entry point to ``ci.py``.
 
     This is installed as the script entry point.
+
+    If ``use_daemon`` is True and a daemon started using ``ci --daemon`` is
+    listening, it executes the invocation.
     """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if use_daemon and "--daemon" not in argv and "--no-daemon" not in argv:
+        from ci.daemon import forward
+        code = forward(argv)
+        if code is not None:
+            sys.exit(code)
+
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](
+            [arg for arg in argv[1:] if arg != "--no-daemon"])
+
+    # Imported here so that invocations forwarded to a daemon do not pay for
+    # them
+    from ci.banners import BANNER_STYLES
+    from ci.logs import COMPRESSIONS
+    from ci.output import TAIL_LINES, TAIL_SIZE
+    from ci.profiling import PROFILE_DIR, PROFILE_TOP
+    from ci.timings import REGRESSION_MADS, REGRESSION_THRESHOLD
+    from ci.utils import parse_size
 
     version_str = ("This is scikit-ci version %s, imported from %s\n" %
                    (ci.__version__, os.path.abspath(ci.__file__)))
 
-    parser = argparse.ArgumentParser(description=ci.__doc__)
+    parser = argparse.ArgumentParser(
+        description=ci.__doc__,
+        epilog="additional commands: {} (see 'ci <command> --help')".format(
+            ", ".join(sorted(COMMANDS))))
     parser.add_argument(
         "step", type=str, nargs='?', default=ci.STEPS[-1],
         action=_OptionalStep, metavar='STEP',
@@ -56,22 +242,206 @@ def main():
         "--without-deps", action="store_false",
         help="do not execute dependent steps", dest='with_dependencies'
     )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="resume the execution of a failed step from the first command "
+             "that did not complete"
+    )
     parser.add_argument(
         "--clear-cached-env", action="store_true",
         help="clear cached environment (removes 'env.json' file)"
     )
+    parser.add_argument(
+        "--cache-dir", default=None,
+        help="directory where cached directories are stored "
+             "(default: $SCIKIT_CI_CACHE_DIR or ~/.cache/scikit-ci)"
+    )
+    parser.add_argument(
+        "--cache-max-size", default=None,
+        help="maximum total size of the cache (e.g 512M or 2G). Least "
+             "recently used entries are removed first"
+    )
+    parser.add_argument(
+        "--cache-url", default=None,
+        help="URL of the server storing cached directories "
+             "(default: $SCIKIT_CI_CACHE_URL). See ci.cache_server"
+    )
+    parser.add_argument(
+        "--changed-base", default=None, metavar="REF",
+        help="git revision used to find out which paths changed when "
+             "evaluating only_if_changed and skip_if_changed_only. Specify "
+             "'last-success' to compare with the state of the workspace "
+             "after the last successful execution "
+             "(default: $SCIKIT_CI_CHANGED_BASE or 'last-success' if it "
+             "was recorded)"
+    )
+    parser.add_argument(
+        "--config", default=SCIKIT_CI_CONFIG,
+        help="path to the configuration file (default: %(default)s)"
+    )
+    _add_max_jobs_argument(parser)
+    parser.add_argument(
+        "--timestamps", action="store_true",
+        help="prefix each line of the output of commands with the time"
+    )
+    parser.add_argument(
+        "--log-dir", default=None, metavar="DIR",
+        help="directory where the output of the commands of each step is "
+             "also written into a file named <step>.log"
+    )
+    parser.add_argument(
+        "--log-per-command", action="store_true",
+        help="write the output of each command into its own file named "
+             "<step>.<index>.log"
+    )
+    parser.add_argument(
+        "--log-compression", default="none", choices=sorted(COMPRESSIONS),
+        help="compression of the log files (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--log-max-size", default=None, metavar="SIZE",
+        help="size (e.g 100M) after which output is written into a new log "
+             "file named <step>.<n>.log"
+    )
+    parser.add_argument(
+        "--log-max-files", type=int, default=None, metavar="N",
+        help="number of log files kept for each step or command when "
+             "rotating them. Older files are removed"
+    )
+    parser.add_argument(
+        "--tail-lines", type=int, default=TAIL_LINES, metavar="N",
+        help="number of last output lines of a failed command reported in "
+             "the error message. 0 disables the report (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--tail-size", default=TAIL_SIZE, metavar="SIZE",
+        help="maximum size of the reported output lines (e.g 4K) "
+             "(default: %(default)s bytes)"
+    )
+    parser.add_argument(
+        "--profile-shell", action="store_true",
+        help="report the time spent executing each line of shell commands "
+             "(requires bash >= 5.0)"
+    )
+    parser.add_argument(
+        "--profile-python", action="store_true",
+        help="profile python commands using cProfile and write their "
+             "profile into <profile-dir>/<step>.<index>.pstats"
+    )
+    parser.add_argument(
+        "--profile-dir", default=PROFILE_DIR, metavar="DIR",
+        help="directory where the profiles of python commands are written "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--profile-top", type=int, default=PROFILE_TOP, metavar="N",
+        help="number of entries of the profile of python commands with the "
+             "largest cumulative time reported (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--metrics-textfile", default=None, metavar="PATH",
+        help="file where metrics about executed steps are written using the "
+             "Prometheus text format (e.g for the textfile collector of "
+             "node_exporter)"
+    )
+    parser.add_argument(
+        "--plan", default=None, metavar="PATH",
+        help="execute steps using the plan written by 'ci compile' instead "
+             "of parsing the configuration file"
+    )
+    parser.add_argument(
+        "--banner", default="figlet", choices=BANNER_STYLES,
+        help="style of the banner displayed before executing each step "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--python-preload", action="append", default=[], metavar="MODULES",
+        help="comma separated list of modules imported once by a python "
+             "process from which python commands are forked. Modules "
+             "starting threads (e.g. numpy with OpenBLAS) can not be "
+             "preloaded: forking could deadlock. Can be repeated"
+    )
+    parser.add_argument(
+        "--regression-mads", type=float, default=REGRESSION_MADS,
+        metavar="K",
+        help="report a step as a regression if its duration exceeds the "
+             "median of its previous executions by more than K median "
+             "absolute deviations (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--regression-threshold", type=float, default=REGRESSION_THRESHOLD,
+        metavar="FRACTION",
+        help="minimum relative increase of the duration of a step reported "
+             "as a regression (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--fail-on-regression", action="store_true",
+        help="fail once all steps are executed if any of them was reported "
+             "as a regression"
+    )
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="execute the following invocations of ci in this process, "
+             "listening on the socket $SCIKIT_CI_DAEMON_SOCKET "
+             "(default: .scikit-ci/daemon.sock)"
+    )
+    parser.add_argument(
+        "--no-daemon", action="store_true",
+        help="do not forward the invocation to a daemon"
+    )
     parser.add_argument(
         "--version", action="version",
         version=version_str,
         help="display scikit-ci version and import information.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.daemon:
+        from ci.daemon import Daemon
+        from ci.driver import Driver
+        try:
+            Daemon(lambda argv: main(argv, use_daemon=False),
+                   log=Driver.log).serve()
+        except ci.SKCIError as exc:
+            exit(exc)
+        except KeyboardInterrupt:
+            pass
+        return
 
     try:
         ci.execute_step(
             args.step,
             force=args.force,
             with_dependencies=args.with_dependencies,
-            clear_cached_env=args.clear_cached_env
+            clear_cached_env=args.clear_cached_env,
+            cache_dir=args.cache_dir,
+            cache_max_size=args.cache_max_size,
+            cache_url=args.cache_url,
+            changed_base=args.changed_base,
+            resume=args.resume,
+            config_file=args.config,
+            max_jobs=args.max_jobs,
+            timestamps=args.timestamps,
+            tail_lines=args.tail_lines,
+            tail_size=parse_size(args.tail_size),
+            log_dir=args.log_dir,
+            log_compression=args.log_compression,
+            log_max_size=parse_size(args.log_max_size)
+            if args.log_max_size else None,
+            log_max_files=args.log_max_files,
+            log_per_command=args.log_per_command,
+            regression_mads=args.regression_mads,
+            regression_threshold=args.regression_threshold,
+            fail_on_regression=args.fail_on_regression,
+            profile_shell=args.profile_shell,
+            profile_python=args.profile_python,
+            profile_dir=args.profile_dir,
+            profile_top=args.profile_top,
+            metrics_textfile=args.metrics_textfile,
+            python_preload=[
+                module for modules in args.python_preload
+                for module in modules.split(",") if module],
+            banner=args.banner,
+            plan=args.plan
         )
     except ci.SKCIError as exc:
         exit(exc)
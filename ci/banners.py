@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to render the banners displayed before
+executing steps.
+
+Rendering a figlet banner requires importing :mod:`pyfiglet` and parsing its
+font. The banners of all :const:`ci.constants.STEPS` are rendered the first
+time one of them is needed and cached in :const:`BANNERS_FILE`, so that
+:mod:`pyfiglet` is only imported when the cache is missing or outdated.
+
+The cache is outdated if the version of :mod:`pyfiglet` changed. It is read
+from the sources of the package, which is not imported.
+"""
+
+import json
+import os
+import re
+
+try:
+    from importlib.util import find_spec
+except ImportError:  # pragma: no cover
+    find_spec = None
+
+from . import utils
+from .constants import CACHE_DIR, STEPS
+
+BANNER_STYLES = ["figlet", "plain", "none"]
+"""Styles of banners. ``none`` disables them."""
+
+BANNERS_FILE = "banners.json"
+"""Name of the file caching figlet banners, stored in the cache directory
+(see :const:`ci.constants.CACHE_DIR`)."""
+
+_BANNERS_VERSION = 2
+
+_VERSION_REGEX = re.compile(
+    r"^__version__\s*=\s*[\"']([^\"']+)[\"']", re.MULTILINE)
+
+
+def banners_path():
+    """Return the path of the file caching figlet banners.
+    """
+    return os.path.join(os.path.expanduser(
+        os.environ.get("SCIKIT_CI_CACHE_DIR", CACHE_DIR)), BANNERS_FILE)
+
+
+def _pyfiglet_directory():
+    if find_spec is None:  # pragma: no cover
+        import imp
+        return imp.find_module("pyfiglet")[1]
+    spec = find_spec("pyfiglet")
+    return os.path.dirname(spec.origin)
+
+
+def installed_pyfiglet_version():
+    """Return the version of the installed :mod:`pyfiglet` read from its
+    sources without importing it, or None if it can not be found.
+    """
+    try:
+        directory = _pyfiglet_directory()
+    except (ImportError, AttributeError, TypeError, ValueError):
+        return None
+    for name in ["version.py", "__init__.py"]:
+        try:
+            with open(os.path.join(directory, name)) as input_stream:
+                match = _VERSION_REGEX.search(input_stream.read())
+        except (IOError, OSError):
+            continue
+        if match:
+            return match.group(1)
+    return None
+
+
+def _load_banners(path):
+    try:
+        with open(path) as input_stream:
+            content = json.load(input_stream)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(content, dict) or \
+            content.get("version") != _BANNERS_VERSION:
+        return {}
+    version = installed_pyfiglet_version()
+    if version is None or content.get("pyfiglet") != version:
+        return {}
+    return content.get("banners", {})
+
+
+def figlet_banner(text, path=None):
+    """Return ``text`` rendered by :mod:`pyfiglet` using its default font.
+
+    Banners of the steps are read from and written into the file ``path``
+    (defaults to :func:`banners_path`).
+    """
+    path = path or banners_path()
+    banners = _load_banners(path)
+    if text in banners:
+        return banners[text]
+    import pyfiglet
+    figlet = pyfiglet.Figlet()
+    banner = figlet.renderText(text)
+    if text in [step.upper() for step in STEPS]:
+        banners = dict([(step.upper(), figlet.renderText(step.upper()))
+                        for step in STEPS])
+        try:
+            utils.atomic_write(path, json.dumps(
+                {"version": _BANNERS_VERSION, "banners": banners,
+                 "pyfiglet": getattr(pyfiglet, "__version__", None)},
+                indent=2, sort_keys=True), mode=0o644)
+        except (IOError, OSError):  # pragma: no cover
+            pass
+    return banner
+
+
+def render_banner(text, style="figlet", path=None):
+    """Return the banner displaying ``text`` in ``style`` (see
+    :const:`BANNER_STYLES`), or None if banners are disabled.
+    """
+    if style == "figlet":
+        return figlet_banner(text, path)
+    if style == "plain":
+        return "%s\n%s\n" % (text, "=" * len(text))
+    if style == "none":
+        return None
+    raise ValueError("invalid banner style: {}".format(style))
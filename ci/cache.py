@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to cache directories (e.g pip cache or
+build trees) across executions of a step.
+
+Each directory is stored as a compressed archive named after a key computed
+from the step, the directory and the content of the associated key files.
+
+Archives are stored using a backend. Two backends are available:
+
+* :class:`FileSystemCacheBackend` storing archives in a local directory.
+* :class:`HTTPCacheBackend` storing archives on a server implementing the
+  protocol described in :mod:`ci.cache_server`.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import zlib
+
+try:
+    from http.client import HTTPException
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+except ImportError:  # pragma: no cover
+    from httplib import HTTPException
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+from . import utils
+from .constants import CACHE_DIR, CACHE_MAX_SIZE
+from .exceptions import SKCIError
+
+ARCHIVE_SUFFIX = ".tar.gz"
+
+CHUNK_SIZE = 1024 * 1024
+
+CHECKSUM_HEADER = "X-Checksum-Sha256"
+"""Name of the HTTP header associated with the sha256 digest of an
+archive."""
+
+KEY_REGEX = re.compile(r"^[0-9a-f]+$")
+"""Regular expression matching valid keys."""
+
+_TRANSPORT_ERRORS = (URLError, HTTPException, socket.error, IOError,
+                     ValueError)
+
+
+def file_digest(path):
+    """Return the sha256 digest of the file ``path``.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as input_stream:
+        for chunk in iter(lambda: input_stream.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SKCICacheError(SKCIError):
+    """Exception raised when an archive can not be retrieved or stored.
+    """
+    pass
+
+
+def extract_archive(archive, directory):
+    """Extract the compressed archive read from the file object ``archive``
+    into ``directory``.
+
+    Archives may come from a shared cache: members that would be written
+    outside of ``directory`` are refused and :class:`SKCICacheError` is
+    raised. If available, the ``data`` extraction filter is used (see
+    :mod:`tarfile`). Otherwise, links are refused as well.
+
+    :class:`SKCICacheError` is also raised if the archive is truncated or
+    corrupted, leaving the members already extracted in place.
+    """
+    try:
+        _extract_members(archive, directory)
+    except (tarfile.TarError, zlib.error, EOFError, IOError, OSError) as exc:
+        if hasattr(tarfile, "FilterError") and \
+                isinstance(exc, tarfile.FilterError):
+            raise SKCICacheError("refused to extract archive: %s" % exc)
+        raise SKCICacheError("failed to extract archive: %s" % exc)
+
+
+def _extract_members(archive, directory):
+    with tarfile.open(fileobj=archive, mode="r|gz") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(directory, filter="data")
+            return
+        root = os.path.realpath(directory)
+        for member in tar:
+            path = os.path.realpath(os.path.join(root, member.name))
+            if member.issym() or member.islnk() or member.isdev() or \
+                    not (path == root or path.startswith(root + os.sep)):
+                raise SKCICacheError(
+                    "refused to extract archive: unsafe member %s" %
+                    member.name)
+            tar.extract(member, root)
+
+
+class CacheBackend(object):
+    """Interface of the backends storing archives.
+    """
+
+    def lookup(self, keys):
+        """Return the subset of ``keys`` associated with a stored archive.
+        """
+        raise NotImplementedError
+
+    def get(self, key, output_stream):
+        """Write the archive associated with ``key`` into ``output_stream``.
+
+        Return False if there is no such archive.
+        """
+        raise NotImplementedError
+
+    def open(self, key):
+        """Return the archive associated with ``key`` opened for reading or
+        None if there is no such archive.
+
+        By default, the archive is retrieved into a temporary file using
+        :meth:`get`.
+        """
+        archive = tempfile.TemporaryFile()
+        try:
+            if not self.get(key, archive):
+                archive.close()
+                return None
+        except Exception:  # noqa: B902
+            archive.close()
+            raise
+        archive.seek(0)
+        return archive
+
+    def put(self, key, path):
+        """Store the file ``path`` as the archive associated with ``key``.
+
+        The file is consumed by the backend. Storing may happen
+        asynchronously, see :meth:`wait`.
+        """
+        raise NotImplementedError
+
+    def wait(self):
+        """Wait for pending :meth:`put` to complete and return the list of
+        stored keys.
+        """
+        return []
+
+
+class FileSystemCacheBackend(CacheBackend):
+    """Store archives in ``root``.
+
+    When the total size of the archives exceeds ``max_size``, the least
+    recently used ones are removed.
+    """
+
+    def __init__(self, root=None, max_size=None):
+        if root is None:
+            root = os.environ.get("SCIKIT_CI_CACHE_DIR", CACHE_DIR)
+        if max_size is None:
+            max_size = os.environ.get("SCIKIT_CI_CACHE_MAX_SIZE",
+                                      CACHE_MAX_SIZE)
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_size = utils.parse_size(max_size)
+        self._stored = []
+
+    def path(self, key):
+        return os.path.join(self.root, key + ARCHIVE_SUFFIX)
+
+    def lookup(self, keys):
+        return set([key for key in keys if os.path.exists(self.path(key))])
+
+    def digest(self, key):
+        """Return the sha256 digest of the archive associated with ``key``.
+        """
+        checksum_file = self.path(key) + ".sha256"
+        if os.path.exists(checksum_file):
+            with open(checksum_file) as input_stream:
+                return input_stream.read().strip()
+        return file_digest(self.path(key))
+
+    def get(self, key, output_stream):
+        archive = self.open(key)
+        if archive is None:
+            return False
+        with archive:
+            shutil.copyfileobj(archive, output_stream, CHUNK_SIZE)
+        return True
+
+    def open(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        # Keep track of usage for LRU eviction
+        os.utime(self.path(key), None)
+        return open(self.path(key), "rb")
+
+    def put(self, key, path, digest=None):
+        """Store ``path`` as the archive associated with ``key``.
+
+        If ``digest`` is provided, it is saved along side the archive.
+        """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        # Move to a temporary file in the same directory first so that
+        # concurrent executions never see a partial archive.
+        handle, tmp_archive = tempfile.mkstemp(
+            dir=self.root, suffix=".tmp")
+        os.close(handle)
+        try:
+            shutil.move(path, tmp_archive)
+            if digest is not None:
+                with open(self.path(key) + ".sha256", "w") as output_stream:
+                    output_stream.write(digest)
+            try:
+                os.rename(tmp_archive, self.path(key))
+            except OSError:  # pragma: no cover
+                # On windows, renaming fails if an other execution
+                # stored the same archive first.
+                if not os.path.exists(self.path(key)):
+                    raise
+        finally:
+            if os.path.exists(tmp_archive):
+                os.remove(tmp_archive)
+        self._stored.append(key)
+        self.evict()
+
+    def wait(self):
+        stored, self._stored = self._stored, []
+        return stored
+
+    def evict(self):
+        """Remove the least recently used archives until their total size
+        is smaller than ``max_size``.
+
+        Return the list of removed archives.
+        """
+        archives = []
+        for name in os.listdir(self.root):
+            if not name.endswith(ARCHIVE_SUFFIX):
+                continue
+            path = os.path.join(self.root, name)
+            stat = os.stat(path)
+            archives.append((stat.st_mtime, stat.st_size, path))
+        archives.sort()
+        total_size = sum([size for _, size, _ in archives])
+        removed = []
+        while archives and total_size > self.max_size:
+            _, size, path = archives.pop(0)
+            os.remove(path)
+            if os.path.exists(path + ".sha256"):
+                os.remove(path + ".sha256")
+            total_size -= size
+            removed.append(path)
+        return removed
+
+
+class HTTPCacheBackend(CacheBackend):
+    """Store archives on a server reachable at ``url``.
+
+    Archives are retrieved using ``GET <url>/<key>`` and stored using
+    ``PUT <url>/<key>``. Their sha256 digest is exchanged using the
+    ``X-Checksum-Sha256`` header and checked by both ends.
+
+    Keys are looked up in one request using ``POST <url>/_lookup`` with a
+    JSON body of the form ``{"keys": [...]}``.
+
+    Up to ``max_workers`` archives are uploaded concurrently.
+    """
+
+    def __init__(self, url, max_workers=4, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(max_workers)
+        self._uploads = []
+        self._stored = []
+        self._errors = []
+
+    def _request(self, path, data=None, method="GET", headers=None):
+        request = Request(self.url + "/" + path, data=data,
+                          headers=headers or {})
+        request.get_method = lambda: method
+        return urlopen(request, timeout=self.timeout)
+
+    def lookup(self, keys):
+        body = json.dumps({"keys": list(keys)}).encode("utf-8")
+        try:
+            response = self._request(
+                "_lookup", data=body, method="POST",
+                headers={"Content-Type": "application/json"})
+            try:
+                return set(
+                    json.loads(response.read().decode("utf-8"))["found"])
+            finally:
+                response.close()
+        except _TRANSPORT_ERRORS as exc:
+            raise SKCICacheError("failed to look up archives on {}: {}".format(
+                self.url, exc))
+
+    def get(self, key, output_stream):
+        """Write the archive associated with ``key`` into ``output_stream``
+        and check its digest once it is entirely downloaded.
+        """
+        digest = hashlib.sha256()
+        try:
+            response = self._request(key)
+            try:
+                expected_digest = response.headers.get(CHECKSUM_HEADER)
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    output_stream.write(chunk)
+            finally:
+                response.close()
+        except HTTPError as exc:
+            if exc.code == 404:
+                return False
+            raise SKCICacheError("failed to retrieve {}: {}".format(key, exc))
+        except _TRANSPORT_ERRORS as exc:
+            raise SKCICacheError("failed to retrieve {}: {}".format(key, exc))
+        if expected_digest and digest.hexdigest() != expected_digest:
+            raise SKCICacheError(
+                "corrupted archive {}: expected sha256 {} got {}".format(
+                    key, expected_digest, digest.hexdigest()))
+        return True
+
+    def _upload(self, key, path):
+        try:
+            with open(path, "rb") as input_stream:
+                response = self._request(
+                    key, data=input_stream, method="PUT",
+                    headers={
+                        "Content-Length": str(os.path.getsize(path)),
+                        "Content-Type": "application/octet-stream",
+                        CHECKSUM_HEADER: file_digest(path)})
+                response.close()
+            self._stored.append(key)
+        except Exception as exc:  # noqa: B902
+            self._errors.append((key, exc))
+        finally:
+            os.remove(path)
+            self._semaphore.release()
+
+    def put(self, key, path):
+        self._semaphore.acquire()
+        upload = threading.Thread(target=self._upload, args=(key, path))
+        upload.daemon = True
+        upload.start()
+        self._uploads.append(upload)
+
+    def wait(self):
+        for upload in self._uploads:
+            upload.join()
+        self._uploads = []
+        stored, self._stored = self._stored, []
+        errors, self._errors = self._errors, []
+        if errors:
+            raise SKCICacheError("failed to upload {}: {}".format(
+                ", ".join([key for key, _ in errors]), errors[0][1]))
+        return stored
+
+
+def cache_backend(url=None, max_size=None):
+    """Return the backend associated with ``url``.
+
+    URLs starting with ``http://`` or ``https://`` are associated with
+    a :class:`HTTPCacheBackend`. Otherwise, ``url`` is expected to be
+    a directory (optionally prefixed with ``file://``) and a
+    :class:`FileSystemCacheBackend` is returned.
+
+    If ``url`` is None, the value of the ``SCIKIT_CI_CACHE_URL``
+    environment variable is considered.
+    """
+    if url is None:
+        url = os.environ.get("SCIKIT_CI_CACHE_URL")
+    if url and re.match(r"^https?://", url):
+        return HTTPCacheBackend(url)
+    if url and url.startswith("file://"):
+        url = url[len("file://"):]
+    return FileSystemCacheBackend(url, max_size)
+
+
+class DirectoryCache(object):
+    """Store directories as compressed archives using ``backend``.
+    """
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = cache_backend()
+        self.backend = backend
+        self._found = {}
+
+    @staticmethod
+    def key(step, directory, inputs_digest=None, extra=None):
+        """Return the key identifying the archive of ``directory`` for
+        ``step``.
+
+        ``inputs_digest`` is the digest of the files the content of
+        ``directory`` depends on (see :class:`ci.hashing.FileHasher`).
+        ``extra`` is any JSON serializable value (e.g service name and
+        operating system) also considered to compute the key.
+        """
+        content = json.dumps(
+            [step, directory, inputs_digest, extra], sort_keys=True)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def lookup(self, keys):
+        """Query the backend for all ``keys`` at once and remember which ones
+        are associated with an archive.
+
+        If the backend fails, the keys are considered missing and
+        :class:`SKCICacheError` is raised.
+        """
+        keys = [key for key in keys if key not in self._found]
+        if not keys:
+            return
+        try:
+            found = self.backend.lookup(keys)
+        except SKCICacheError:
+            for key in keys:
+                self._found[key] = False
+            raise
+        for key in keys:
+            self._found[key] = key in found
+
+    def contains(self, key):
+        self.lookup([key])
+        return self._found[key]
+
+    def restore(self, key, directory):
+        """Replace ``directory`` with the content of the archive associated
+        with ``key``.
+
+        Return True if the archive was found. The archive is extracted into
+        a temporary directory next to ``directory`` first: if it can not be
+        extracted, ``directory`` is left unchanged, the archive is considered
+        missing (so that :meth:`save` replaces it) and
+        :class:`SKCICacheError` is raised.
+        """
+        if not self.contains(key):
+            return False
+        archive = self.backend.open(key)
+        if archive is None:
+            return False
+        directory = os.path.abspath(directory)
+        parent = os.path.dirname(directory)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp_directory = tempfile.mkdtemp(
+            dir=parent, prefix="." + os.path.basename(directory) + ".")
+        try:
+            with archive:
+                extract_archive(archive, tmp_directory)
+            if os.path.isdir(directory) and not os.path.islink(directory):
+                shutil.rmtree(directory)
+            elif os.path.lexists(directory):
+                os.remove(directory)
+            os.rename(tmp_directory, directory)
+        except SKCICacheError:
+            self._found[key] = False
+            raise
+        finally:
+            if os.path.exists(tmp_directory):
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+        return True
+
+    def save(self, key, directory):
+        """Store ``directory`` into the archive associated with ``key``.
+
+        Return False if ``directory`` does not exist or if the archive
+        already exists. Call :meth:`wait` to ensure the archive is stored.
+        """
+        if not os.path.isdir(directory) or self.contains(key):
+            return False
+        handle, path = tempfile.mkstemp(suffix=ARCHIVE_SUFFIX)
+        try:
+            with os.fdopen(handle, "wb") as output_stream:
+                with tarfile.open(fileobj=output_stream, mode="w:gz") as tar:
+                    tar.add(directory, arcname=".")
+        except Exception:  # noqa: B902
+            os.remove(path)
+            raise
+        self.backend.put(key, path)
+        self._found[key] = True
+        return True
+
+    def wait(self):
+        """Wait for all archives to be stored and return their keys.
+        """
+        return self.backend.wait()
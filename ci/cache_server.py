@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides a minimal HTTP server storing the archives of cached
+directories. It is intended to share a cache across build nodes and to test
+:class:`ci.cache.HTTPCacheBackend`.
+
+The following requests are supported:
+
+* ``GET /<key>``: Return the archive associated with ``key``. Its sha256 digest
+  is set in the ``X-Checksum-Sha256`` header.
+* ``HEAD /<key>``: Same as ``GET`` without the content.
+* ``PUT /<key>``: Store the request content as the archive associated with
+  ``key``. If set, the ``X-Checksum-Sha256`` header is checked.
+* ``POST /_lookup``: Given a JSON body of the form ``{"keys": [...]}``, return
+  ``{"found": [...]}`` listing the keys associated with an archive.
+
+Archives are stored using a :class:`ci.cache.FileSystemCacheBackend`.
+
+Usage::
+
+    python -m ci.cache_server --root /path/to/cache --port 8000
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from .cache import (
+    CHECKSUM_HEADER, CHUNK_SIZE, KEY_REGEX, FileSystemCacheBackend)
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+
+    def _key(self):
+        key = self.path.lstrip("/")
+        if not KEY_REGEX.match(key):
+            self.send_error(400, "invalid key")
+            return None
+        return key
+
+    def _send_archive(self, with_content):
+        key = self._key()
+        if key is None:
+            return
+        backend = self.server.backend
+        archive = backend.open(key)
+        if archive is None:
+            self.send_error(404)
+            return
+        with archive:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header(
+                "Content-Length", str(os.fstat(archive.fileno()).st_size))
+            self.send_header(CHECKSUM_HEADER, backend.digest(key))
+            self.end_headers()
+            if with_content:
+                for chunk in iter(lambda: archive.read(CHUNK_SIZE), b""):
+                    self.wfile.write(chunk)
+
+    def do_GET(self):  # noqa: N802
+        self._send_archive(with_content=True)
+
+    def do_HEAD(self):  # noqa: N802
+        self._send_archive(with_content=False)
+
+    def do_PUT(self):  # noqa: N802
+        key = self._key()
+        if key is None:
+            return
+        remaining = int(self.headers.get("Content-Length", 0))
+        digest = hashlib.sha256()
+        handle, path = tempfile.mkstemp(dir=self.server.staging_dir)
+        try:
+            with os.fdopen(handle, "wb") as output_stream:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    digest.update(chunk)
+                    output_stream.write(chunk)
+            expected_digest = self.headers.get(CHECKSUM_HEADER)
+            if remaining or (
+                    expected_digest and expected_digest != digest.hexdigest()):
+                self.send_error(400, "corrupted archive")
+                return
+            with self.server.lock:
+                self.server.backend.put(key, path, digest.hexdigest())
+                self.server.backend.wait()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):  # noqa: N802
+        if self.path != "/_lookup":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        keys = json.loads(self.rfile.read(length).decode("utf-8"))["keys"]
+        keys = [key for key in keys if KEY_REGEX.match(key)]
+        content = json.dumps(
+            {"found": sorted(self.server.backend.lookup(keys))}
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server storing archives into ``root``.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, address=("127.0.0.1", 0), max_size=None,
+                 quiet=False):
+        HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.backend = FileSystemCacheBackend(root, max_size)
+        self.staging_dir = os.path.join(self.backend.root, ".staging")
+        if not os.path.exists(self.staging_dir):
+            os.makedirs(self.staging_dir)
+        self.lock = threading.Lock()
+        self.quiet = quiet
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def start(self):
+        """Serve requests in a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the archives of cached directories.")
+    parser.add_argument("--root", required=True,
+                        help="directory where archives are stored")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-size", default=None,
+                        help="maximum total size of the archives")
+    args = parser.parse_args()
+
+    server = CacheServer(args.root, (args.host, args.port), args.max_size)
+    print("Serving %s on %s" % (server.backend.root, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to skip steps and commands based on
+the paths changed since a given base.
+
+The base is either a git revision, in which case changes are computed
+relative to its merge-base with ``HEAD``, or the state of the workspace
+recorded after the last successful execution of each step or command.
+
+Paths are relative to the current directory. Files written by scikit-ci
+(see :const:`ci.constants.SCIKIT_CI_ENV_FILENAME` and
+:const:`ci.constants.SCIKIT_CI_DIR`) are never considered changed.
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+
+from . import utils
+from .constants import SCIKIT_CI_DIR, SCIKIT_CI_ENV_FILENAME
+from .hashing import input_hasher
+
+LAST_SUCCESS = os.path.join(SCIKIT_CI_DIR, "last-success.json")
+"""File where the digests of the workspace files and the durations of steps
+and commands are recorded after their successful execution."""
+
+LAST_SUCCESS_BASE = "last-success"
+"""Name of the base associated with the state recorded in
+:const:`LAST_SUCCESS`."""
+
+CONDITIONS = ("only_if_changed", "skip_if_changed_only")
+"""Name of the keys describing the paths a step or command depends on."""
+
+
+def match(path, patterns):
+    """Return True if ``path`` matches any of the glob ``patterns``.
+
+    A pattern matching a directory (e.g ``docs`` or ``docs/``) matches all
+    the paths it contains.
+    """
+    for pattern in patterns:
+        pattern = str(pattern)
+        if fnmatch.fnmatch(path, pattern):
+            return True
+        if path.startswith(pattern.rstrip("/") + "/"):
+            return True
+    return False
+
+
+def is_internal(path):
+    """Return True if ``path`` is a file written by scikit-ci.
+    """
+    return path == SCIKIT_CI_ENV_FILENAME or path == SCIKIT_CI_DIR or \
+        path.startswith(SCIKIT_CI_DIR + "/")
+
+
+class ChangeDetector(object):
+    """Decide if steps and commands should be executed considering the
+    paths changed since ``base``.
+
+    If ``base`` is None, the value of the ``SCIKIT_CI_CHANGED_BASE``
+    environment variable is considered. If neither are set, the state
+    recorded after the last successful execution is used if any. In that
+    case, each step or command is compared with the state recorded after its
+    own last successful execution.
+    """
+
+    def __init__(self, base=None, state_file=LAST_SUCCESS):
+        if base is None:
+            base = os.environ.get("SCIKIT_CI_CHANGED_BASE")
+        self.base = base
+        self.state_file = state_file
+        self.state = {"snapshots": {}, "last_success": {}, "durations": {}}
+        if os.path.exists(state_file):
+            with open(state_file) as input_stream:
+                state = json.load(input_stream)
+            # Global snapshot written by older versions
+            state.pop("files", None)
+            self.state.update(state)
+            if self.base is None:
+                self.base = LAST_SUCCESS_BASE
+        self._executed = set()
+        self._changed_paths = {}
+        self._workspace = None
+        self._hasher = None
+
+    @property
+    def hasher(self):
+        if self._hasher is None:
+            self._hasher = input_hasher()
+        return self._hasher
+
+    def _git(self, *args):
+        return subprocess.check_output(["git"] + list(args)).decode("utf-8")
+
+    def workspace_digests(self):
+        """Return a dictionary associating each file of the workspace with
+        its digest.
+        """
+        if self._workspace is None:
+            digests = self.hasher.hash_paths(["."], trees=False)
+            self.hasher.save()
+            self._workspace = dict([
+                (path, digest) for path, digest in [
+                    (os.path.relpath(path).replace(os.sep, "/"), digest)
+                    for path, digest in digests.items()]
+                if not is_internal(path)])
+        return self._workspace
+
+    def changed_paths(self, name=None):
+        """Return the set of paths changed since ``base`` or None if there is
+        no base.
+
+        If ``base`` is the last successful execution, paths are compared
+        with the state recorded after the one of the step or command
+        ``name``.
+        """
+        if self.base is None:
+            return None
+        snapshot = None
+        if self.base == LAST_SUCCESS_BASE:
+            snapshot = self.state["last_success"].get(name)
+            if snapshot not in self.state["snapshots"]:
+                return None
+        if snapshot not in self._changed_paths:
+            self._changed_paths[snapshot] = self._compute_changed_paths(
+                snapshot)
+        return self._changed_paths[snapshot]
+
+    def _compute_changed_paths(self, snapshot):
+        if snapshot is not None:
+            previous = self.state["snapshots"][snapshot]
+            current = self.workspace_digests()
+            return set([path for path in set(previous) | set(current)
+                        if previous.get(path) != current.get(path)])
+        top_level = self._git("rev-parse", "--show-toplevel").strip()
+        merge_base = self._git("merge-base", self.base, "HEAD").strip()
+        # Both commands list paths relative to the top-level directory
+        output = self._git("diff", "--name-only", "-z", merge_base)
+        output += self._git("-C", top_level, "ls-files", "--others",
+                            "--exclude-standard", "-z")
+        paths = [os.path.relpath(os.path.join(top_level, path)).replace(
+            os.sep, "/") for path in output.split("\0") if path]
+        return set([path for path in paths if not is_internal(path)])
+
+    def should_execute(self, name, definition):
+        """Return a tuple ``(execute, reason)`` considering the
+        ``only_if_changed`` and ``skip_if_changed_only`` patterns associated
+        with ``definition``, the definition of the step or command ``name``.
+        """
+        only_if_changed = definition.get("only_if_changed")
+        skip_if_changed_only = definition.get("skip_if_changed_only")
+        if not only_if_changed and not skip_if_changed_only:
+            return True, None
+        changed = self.changed_paths(name)
+        if changed is None:
+            self._executed.add(name)
+            return True, "no base to compare with"
+        if only_if_changed and not [
+                path for path in changed if match(path, only_if_changed)]:
+            return False, "no changes matching %s since %s" % (
+                ", ".join(only_if_changed), self.base)
+        if skip_if_changed_only and changed and not [
+                path for path in changed
+                if not match(path, skip_if_changed_only)]:
+            return False, "only changes matching %s since %s" % (
+                ", ".join(skip_if_changed_only), self.base)
+        self._executed.add(name)
+        return True, None
+
+    def duration(self, name):
+        """Return the duration in seconds of the last execution of the step
+        or command ``name`` or None.
+        """
+        return self.state["durations"].get(name)
+
+    def record_duration(self, name, duration):
+        self.state["durations"][name] = duration
+
+    def save(self):
+        """Record the durations and the state of the workspace after the
+        successful execution of the steps and commands whose patterns were
+        evaluated.
+        """
+        if self._executed:
+            self._workspace = None
+            files = self.workspace_digests()
+            snapshot = hashlib.sha1(
+                json.dumps(files, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+            self.state["snapshots"][snapshot] = files
+            for name in self._executed:
+                self.state["last_success"][name] = snapshot
+            # Forget snapshots no longer associated with any step or command
+            used = set(self.state["last_success"].values())
+            self.state["snapshots"] = dict([
+                (key, value) for key, value in self.state["snapshots"].items()
+                if key in used])
+        utils.atomic_write(self.state_file, json.dumps(self.state))
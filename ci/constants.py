@@ -40,3 +40,25 @@ These are the scikit-ci steps to execute. They are expected to
 be mapped to the step recognized by continuous integration
 services like Appveyor, Azure Pipelines, CircleCI or TravisCI.
 """
+
+CACHE_DIR = "~/.cache/scikit-ci"
+"""Default directory where the archives of cached directories are stored.
+
+It can be changed using the ``SCIKIT_CI_CACHE_DIR`` environment variable
+or the ``--cache-dir`` command line option.
+"""
+
+CACHE_MAX_SIZE = "2G"
+"""Default maximum total size of the archives of cached directories.
+
+It can be changed using the ``SCIKIT_CI_CACHE_MAX_SIZE`` environment variable
+or the ``--cache-max-size`` command line option.
+"""
+
+SCIKIT_CI_DIR = ".scikit-ci"
+"""Name of the directory where scikit-ci stores the state of the workspace
+(e.g hashes of files). It is created along side ``scikit-ci.yml``."""
+
+SCIKIT_CI_ENV_FILENAME = "env.json"
+"""Name of the file where the environment shared between steps is saved.
+It is created in the directory where ``ci`` is executed."""
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to execute ``ci`` invocations in a
+long running process to avoid paying the cost of starting python, importing
+modules and parsing the configuration for each of them.
+
+The daemon (``ci --daemon``) listens on a Unix socket. When invoked, ``ci``
+connects to it and sends its arguments, working directory and environment
+along with its standard input, output and error file descriptors (see
+``SCM_RIGHTS``). The daemon forks a process executing the request with these
+descriptors, so that output is written directly where the client would have
+written it. The exit code is sent back to the client.
+
+Forked processes inherit the modules imported and the configurations parsed
+by the daemon.
+"""
+
+import array
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+from .constants import SCIKIT_CI_CONFIG, SCIKIT_CI_DIR
+from .exceptions import SKCIError
+
+DAEMON_SOCKET = os.path.join(SCIKIT_CI_DIR, "daemon.sock")
+"""Default path of the socket, relative to the working directory."""
+
+SOCKET_ENV_VAR = "SCIKIT_CI_DAEMON_SOCKET"
+"""Environment variable overriding the path of the socket."""
+
+SUPPORTED = hasattr(socket, "AF_UNIX") and hasattr(socket, "SCM_RIGHTS") \
+    and hasattr(socket.socket, "sendmsg") and hasattr(os, "fork")
+"""True if the daemon can be used on this platform."""
+
+_HEADER = struct.Struct("!I")
+_STATUS = struct.Struct("!i")
+_FDS = (0, 1, 2)
+
+
+def socket_path():
+    """Return the absolute path of the socket of the daemon.
+    """
+    return os.path.abspath(os.environ.get(SOCKET_ENV_VAR, DAEMON_SOCKET))
+
+
+def _recv_exactly(connection, size):
+    """Return ``size`` bytes read from ``connection`` or None if it was
+    closed before.
+    """
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def forward(argv, path=None):
+    """Ask the daemon listening on ``path`` to execute ``ci`` with the
+    arguments ``argv`` and return its exit code.
+
+    Return None if no daemon is listening, in which case ``argv`` should be
+    executed by the current process.
+    """
+    path = path or socket_path()
+    if not SUPPORTED or not os.path.exists(path):
+        return None
+    try:
+        for fd in _FDS:
+            os.fstat(fd)
+    except OSError:
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(path)
+        except socket.error:
+            return None
+        payload = json.dumps({
+            "argv": argv, "cwd": os.getcwd(), "environ": dict(os.environ)
+        }).encode("utf-8")
+        message = _HEADER.pack(len(payload)) + payload
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sent = client.sendmsg([message], [(
+            socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", _FDS))])
+        client.sendall(message[sent:])
+        status = _recv_exactly(client, _STATUS.size)
+        pid = _STATUS.unpack(status)[0] if status else None
+        while status is not None:
+            try:
+                status = _recv_exactly(client, _STATUS.size)
+                break
+            except KeyboardInterrupt:
+                os.kill(pid, signal.SIGINT)
+        if status is None:
+            sys.stderr.write(
+                "[scikit-ci] Connection to the daemon %s was lost\n" % path)
+            return 1
+        return _STATUS.unpack(status)[0]
+    finally:
+        client.close()
+
+
+def _receive_request(connection):
+    """Return the request sent by :func:`forward` and the file descriptors
+    attached to it.
+    """
+    fds = array.array("i")
+    header, ancillary, _, _ = connection.recvmsg(
+        _HEADER.size, socket.CMSG_SPACE(len(_FDS) * fds.itemsize))
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    fds = list(fds)
+    if len(header) < _HEADER.size:
+        header += _recv_exactly(connection, _HEADER.size - len(header)) \
+            or b""
+    payload = _recv_exactly(connection, _HEADER.unpack(header)[0]) \
+        if len(header) == _HEADER.size else None
+    if payload is None or len(fds) != len(_FDS):
+        for fd in fds:
+            os.close(fd)
+        raise ValueError("incomplete request")
+    return json.loads(payload.decode("utf-8")), fds
+
+
+def _exit_code(code):
+    """Return the exit status associated with the code of a
+    :class:`SystemExit` exception, writing messages to stderr like python.
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("%s\n" % code)
+    return 1
+
+
+class Daemon(object):
+    """Execute the requests sent by :func:`forward` to the socket ``path``.
+
+    ``main`` is the function executing ``ci`` given its arguments. ``log``
+    is called with a message for each request.
+    """
+
+    def __init__(self, main, path=None, log=None):
+        self.main = main
+        self.path = path or socket_path()
+        self.log = log or (lambda *args: None)
+        self._server = None
+        self._children = set()
+
+    def warm(self, directory):
+        """Parse the configuration found in ``directory`` so that it does
+        not have to be parsed again by the processes executing requests.
+        """
+        from .driver import Driver
+        config_file = os.path.join(directory, SCIKIT_CI_CONFIG)
+        if os.path.exists(config_file):
+            Driver.load_config(config_file)
+
+    def serve(self):
+        """Execute requests until the process is terminated.
+        """
+        if not SUPPORTED:  # pragma: no cover
+            raise SKCIError("the daemon is not supported on this platform")
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the current user may connect
+        umask = os.umask(0o077)
+        try:
+            self._server.bind(self.path)
+        finally:
+            os.umask(umask)
+        self._server.listen(16)
+        self.warm(os.getcwd())
+
+        def _terminate(signum, frame):
+            raise SystemExit(0)
+
+        previous = signal.signal(signal.SIGTERM, _terminate)
+        self.log("[scikit-ci] Daemon listening on %s" % self.path)
+        try:
+            while True:
+                self._reap()
+                if select.select([self._server], [], [], 1.)[0]:
+                    connection, _ = self._server.accept()
+                    try:
+                        self._handle(connection)
+                    finally:
+                        connection.close()
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self._server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _reap(self):
+        for pid in list(self._children):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                self._children.discard(pid)
+
+    def _handle(self, connection):
+        try:
+            request, fds = _receive_request(connection)
+        except (ValueError, socket.error):
+            return
+        self.warm(request["cwd"])
+        self.log("[scikit-ci] Daemon: executing 'ci %s' in %s" % (
+            " ".join(request["argv"]), request["cwd"]))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            code = 1
+            try:
+                self._server.close()
+                connection.sendall(_STATUS.pack(os.getpid()))
+                code = self._execute(request, fds)
+                connection.sendall(_STATUS.pack(code))
+            finally:
+                os._exit(code)
+        for fd in fds:
+            os.close(fd)
+        self._children.add(pid)
+
+    def _execute(self, request, fds):  # pragma: no cover
+        """Execute ``request`` in the forked process and return its exit
+        code.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for target, fd in zip(_FDS, fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["environ"])
+        sys.argv = ["ci"] + request["argv"]
+        try:
+            self.main(request["argv"])
+            code = 0
+        except SystemExit as exc:
+            code = _exit_code(exc.code)
+        except KeyboardInterrupt:
+            code = 128 + signal.SIGINT
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return code
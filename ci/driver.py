@@ -4,26 +4,44 @@
 ``scikit-ci.yml``."""
 
 import errno
+import functools
+import glob
+import hashlib
 import json
 import os
 import os.path
 import re
-import ruamel.yaml
 import shlex
 import subprocess
 import sys
 import tempfile
+import time
 
-from collections import MutableMapping
+from collections import MutableMapping, OrderedDict
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
-from pyfiglet import Figlet
-
 from . import exceptions, utils
-from .constants import SCIKIT_CI_CONFIG, SERVICES, STEPS
+from .banners import render_banner
+from .cache import DirectoryCache, SKCICacheError, cache_backend
+from .changes import CONDITIONS, ChangeDetector
+from .constants import SCIKIT_CI_CONFIG, SCIKIT_CI_DIR, SERVICES, STEPS
+from .hashing import input_hasher
+from .jobserver import jobserver
+from .logs import StepLog
+from .metrics import MetricsTextfile
+from .output import TAIL_LINES, TAIL_SIZE, TailBuffer, check_call
+from .plan import (
+    PLAN_FILE, config_digest, plan_config, read_plan, write_plan)
+from .profiling import (
+    PROFILE_DIR, PROFILE_TOP, PYTHON_PROFILER, format_line_timings,
+    parse_xtrace, report_python_profile, xtrace_pre_code)
+from .resources import RESOURCES, combine, parse_resources
+from .timings import (
+    REGRESSION_MADS, REGRESSION_THRESHOLD, TIMINGS_DB, TimingRecorder)
+from .zygote import Zygote
 
 
 class DriverContext(object):
@@ -33,26 +51,59 @@ class DriverContext(object):
 
     def __enter__(self):
         self.driver.load_env(self.env_file)
-        self.env_file_modified_time = 0
-        if os.path.exists(self.env_file):
-            self.env_file_modified_time = os.path.getmtime(self.env_file)
         return self.driver
 
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is None and exc_value is None and traceback is None:
-            # Skip saving if env_file has been modified since context was entered
-            current_env_file_modified_time = 0
-            if os.path.exists(self.env_file):
-                current_env_file_modified_time = os.path.getmtime(self.env_file)
-            if current_env_file_modified_time == self.env_file_modified_time:
-                self.driver.save_env(self.driver.env, self.env_file)
+            self.driver.save_env_changes()
         self.driver.unload_env()
 
 
+def _env_lock(env_file):
+    """Return the lock serializing the updates of ``env_file``.
+
+    Since ``env_file`` is replaced when written, a separate file is locked.
+    """
+    return utils.FileLock(os.path.join(
+        os.path.dirname(env_file), SCIKIT_CI_DIR,
+        os.path.basename(env_file) + ".lock"))
+
+
+def _write_env(env, env_file):
+    utils.atomic_write(env_file, json.dumps(
+        dict([(str(k), str(v)) for k, v in env.items()]), indent=4),
+        mode=0o644)
+
+
 class Driver(object):
     def __init__(self):
         self.env = None
         self._env_file = None
+        self.cache = None
+        self.hasher = None
+        self.changes = None
+        self.resume = False
+        self.jobserver = None
+        self.timestamps = False
+        self.tail_lines = TAIL_LINES
+        self.tail_size = TAIL_SIZE
+        self.log_dir = None
+        self.log_settings = {}
+        self.step_log = None
+        self.timings = None
+        self.profile_shell = False
+        self.metrics = None
+        self.executed_commands = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.profile_dir = None
+        self.profile_top = PROFILE_TOP
+        self.line_timings = []
+        self.zygote = None
+        self.banner = "figlet"
+        self.fingerprint = None
+        self._loaded_env = {}
+        self._file_env = {}
 
     @staticmethod
     def log(*s):
@@ -61,6 +112,7 @@ class Driver(object):
 
     @staticmethod
     def read_env(env_file="env.json"):
+        # The file is replaced atomically, reading it does not require a lock
         if not os.path.exists(env_file):
             return {}
         with open(env_file) as _file:
@@ -74,19 +126,93 @@ class Driver(object):
         self.env.update(os.environ)
         self._env_file = env_file
 
-        if os.path.exists(self._env_file):
-            self.env.update(self.read_env(self._env_file))
+        file_env = self.read_env(self._env_file)
+        self.env.update(file_env)
 
         self.env = {str(k): str(v) for k, v in self.env.items()}
+        self._loaded_env = dict(self.env)
+        self._file_env = {str(k): str(v) for k, v in file_env.items()}
 
     @staticmethod
     def save_env(env, env_file="env.json"):
-        env = {str(k): str(v) for k, v in env.items()}
-        with open(env_file, "w") as _file:
-            json.dump(env, _file, indent=4)
+        with _env_lock(env_file):
+            _write_env(env, env_file)
+
+    @staticmethod
+    def update_env(updates=None, removed=(), env_file="env.json"):
+        """Set the variables ``updates`` and remove the variables ``removed``
+        in ``env_file``, keeping the others.
+
+        The file is locked while it is read and written, so that concurrent
+        updates are not lost.
+        """
+        with _env_lock(env_file):
+            env = Driver.read_env(env_file)
+            env.update(updates or {})
+            for name in removed:
+                env.pop(name, None)
+            _write_env(env, env_file)
+
+    def save_env_changes(self):
+        """Save the environment into the environment file.
+
+        The variables set or removed since the environment was loaded are
+        merged with the content of the file. If another process modified a
+        variable in the meantime, its value is kept. The environment is then
+        updated with the merged content.
+        """
+        with _env_lock(self._env_file):
+            env = dict([(str(k), str(v)) for k, v in
+                        self.read_env(self._env_file).items()])
+
+            def _modified_by_others(name):
+                return env.get(name) != self._file_env.get(name)
+
+            for name, value in self.env.items():
+                if name not in env or not _modified_by_others(name):
+                    env[name] = value
+            for name in set(self._loaded_env) | set(self._file_env):
+                if name not in self.env and not _modified_by_others(name):
+                    env.pop(name, None)
+            _write_env(env, self._env_file)
+        self.env = env
+        self._loaded_env = dict(env)
+        self._file_env = dict(env)
 
     def unload_env(self):
         self.env = None
+        self._loaded_env = {}
+        self._file_env = {}
+
+    @staticmethod
+    def checkpoint_name(stage_name, index):
+        """Return the name of the variable recording the completion of the
+        command ``index`` of ``stage_name``.
+        """
+        return 'SCIKIT_CI_%s_COMMAND_%d' % (stage_name.upper(), index)
+
+    @staticmethod
+    def checkpoint_value(language, cmd):
+        return hashlib.sha1(
+            ("%s:%s" % (language, cmd)).encode("utf-8")).hexdigest()
+
+    def save_checkpoint(self, stage_name, index, language, cmd):
+        """Record the completion of the command ``index`` of ``stage_name``
+        in the environment file.
+
+        Checkpoints allow to resume the execution of a failed step from the
+        first command that did not complete.
+        """
+        name = self.checkpoint_name(stage_name, index)
+        self.env[name] = self.checkpoint_value(language, cmd)
+        self.update_env({name: self.env[name]}, env_file=self._env_file)
+        self._file_env[name] = self.env[name]
+
+    def clear_checkpoints(self, stage_name):
+        prefix = self.checkpoint_name(stage_name, 0)[:-1]
+        for name in list(self.env.keys()):
+            if name.startswith(prefix):
+                del self.env[name]
 
     if "COMSPEC" in os.environ:
 
@@ -152,6 +278,14 @@ class Driver(object):
 
     def check_call(self, *args, **kwds):
         kwds["env"] = kwds.get("env", self.env)
+        kwds["timestamps"] = self.timestamps
+        if self.tail_lines:
+            # Keep the last lines of the output to report failures
+            kwds["tail"] = TailBuffer(self.tail_lines, self.tail_size)
+        if self.step_log is not None:
+            kwds["log_file"] = self.step_log.stream()
+        if self.jobserver is not None:
+            kwds.update(self.jobserver.popen_kwargs())
         cmd_config = kwds.pop("cmd_config")
         kwds["shell"] = cmd_config.subprocess_shell_mode
         cmd = cmd_config.escape_cmd(args[0])
@@ -173,11 +307,18 @@ class Driver(object):
 
             # Because of python issue #14243, we set "delete=False" and delete
             # manually after process execution.
+            trace_file = None
+            profiler_file = None
+            profile_output = kwds.pop("profile_output", None)
             try:
                 script_file = tempfile.NamedTemporaryFile(
                     delete=False, suffix=cmd_config.script_suffix)
                 # Pre-code
-                _write(script_file, cmd_config.script_pre_code)
+                pre_code = cmd_config.script_pre_code
+                if self.profile_shell and cmd_config.shell == "bash":
+                    trace_file = script_file.name + ".trace"
+                    pre_code += "\n" + xtrace_pre_code(trace_file)
+                _write(script_file, pre_code)
                 # Content provided in the yml configuration files
                 _write(script_file, script)
                 # Post-code
@@ -187,22 +328,77 @@ class Driver(object):
                 # Then, compose the command to execute
                 shell_cmd = [cmd_config.shell]
                 shell_cmd.extend(cmd_config.shell_options)
+                if profile_output is not None:
+                    profiler_file = tempfile.NamedTemporaryFile(
+                        delete=False, suffix=".py")
+                    profiler_file.write(PYTHON_PROFILER.encode("utf-8"))
+                    profiler_file.close()
+                    shell_cmd.extend([profiler_file.name, profile_output])
                 shell_cmd.append(script_file.name)
                 if cmd_config.subprocess_shell_mode:
                     shell_cmd = " ".join(['"%s"' % arg for arg in shell_cmd])
                 args = [shell_cmd]
+                if self.zygote is not None and profile_output is None and \
+                        cmd_config.shell == "python":
+                    kwds["popen"] = functools.partial(
+                        self.zygote.popen, script_file.name)
                 # And finally execute
-                subprocess.check_call(*args, **kwds)
+                check_call(*args, **kwds)
             finally:
                 script_file.close()
                 os.remove(script_file.name)
+                if trace_file is not None:
+                    self.report_line_timings(
+                        script, trace_file, pre_code.count("\n") + 2)
+                if profiler_file is not None:
+                    os.remove(profiler_file.name)
+                    self.report_python_profile(profile_output)
         else:
             shell_cmd = [cmd_config.shell] if cmd_config.shell else []
             shell_cmd.extend(cmd_config.shell_options)
             shell_cmd.append(cmd)
             args = [" ".join(shell_cmd)]
             self.log("[scikit-ci] Executing: %s" % args[0])
-            subprocess.check_call(*args, **kwds)
+            check_call(*args, **kwds)
+
+    def report_line_timings(self, script, trace_file, first_line):
+        """Log the time spent executing each line of ``script`` found in
+        ``trace_file`` and remove it.
+
+        The timings are also associated with :attr:`line_timings`.
+        """
+        end_time = time.time()
+        if not os.path.exists(trace_file):
+            return
+        with open(trace_file, "rb") as input_stream:
+            trace = input_stream.read().decode("utf-8", "replace")
+        os.remove(trace_file)
+        self.line_timings = parse_xtrace(trace, script, first_line, end_time)
+        self.log("[scikit-ci] Time per line:")
+        for line in format_line_timings(self.line_timings):
+            self.log("[scikit-ci] " + line)
+
+    def profile_output(self, stage_name, index):
+        """Return the absolute path of the file where the profile of command
+        ``index`` of step ``stage_name`` is written.
+        """
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        return os.path.abspath(os.path.join(
+            self.profile_dir, "%s.%d.pstats" % (stage_name, index)))
+
+    def report_python_profile(self, path):
+        """Log the entries of the profile ``path`` with the largest
+        cumulative time.
+        """
+        if not os.path.exists(path):
+            return
+        self.log("[scikit-ci] Profile written into %s" % path)
+        if not self.profile_top:
+            return
+        if not report_python_profile(path, self.profile_top, sys.stdout):
+            self.log("[scikit-ci] Warning: failed to read %s" % path)
+        sys.stdout.flush()
 
     def env_context(self, env_file="env.json"):
         return DriverContext(self, env_file)
@@ -339,63 +535,179 @@ class Driver(object):
                              "It is reserved to store the name of the current "
                              "CI service (e.g appveyor, azure, circle or travis.")
 
-    @staticmethod
-    def parse_config(config_file, stage_name, service_name, global_env):
-        with open(config_file) as input_stream:
-            data = ruamel.yaml.load(input_stream, ruamel.yaml.RoundTripLoader)
+    _config_cache = {}
+
+    _config_digests = {}
+    """Digest of the last content of each configuration file. Only the
+    configurations associated with these digests are kept in
+    ``_config_cache`` so that a long-lived process (see :mod:`ci.daemon`)
+    does not accumulate the configurations of edited files."""
+
+    config_parse_time = 0.
+    """Number of seconds spent parsing configuration files."""
 
-        commands = []
-        environment = {}
+    @staticmethod
+    def cache_config(config_file, digest, data):
+        """Cache ``data``, the configuration parsed from the content of
+        ``config_file`` whose digest is ``digest``.
+        """
+        path = os.path.abspath(config_file)
+        previous = Driver._config_digests.get(path)
+        Driver._config_digests[path] = digest
+        Driver._config_cache[digest] = data
+        if previous is not None and \
+                previous not in Driver._config_digests.values():
+            Driver._config_cache.pop(previous, None)
 
-        if stage_name in data:
-            stage = data[stage_name]
+    @staticmethod
+    def load_config(config_file):
+        """Return the content of ``config_file`` parsed as YAML.
 
-            # common to all services
-            environment = stage.get("environment", {})
-            commands = stage.get("commands", [])
+        Parsed configurations are cached based on the hash of their content.
+        """
+        with open(config_file) as input_stream:
+            text = input_stream.read()
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        data = Driver._config_cache.get(digest)
+        if data is None:
+            # Not needed when executing from a plan (see load_plan)
+            import ruamel.yaml
+            start = time.time()
+            data = ruamel.yaml.load(text, ruamel.yaml.RoundTripLoader)
+            Driver.config_parse_time += time.time() - start
+        Driver.cache_config(config_file, digest, data)
+        return data
 
-            # Sanity checks
-            Driver._raise_if_setting_ci_name(environment)
+    @staticmethod
+    def select_step(data, stage_name, service_name, operating_system):
+        """Return the definition of ``stage_name`` for the given service and
+        operating system.
+
+        The definition is a dictionary associating ``environment`` and
+        ``service_environment`` with the (not yet expanded) environment
+        common to all services and specific to ``service_name``, and
+        ``commands`` with the list of commands to execute, ``cache`` with
+        the description of the directories to cache, ``resources`` with the
+        resources needed by the step, ``only_if_changed`` and
+        ``skip_if_changed_only`` with the lists of path patterns conditioning
+        the execution of the step.
+        """
+        step = {
+            "environment": OrderedDict(),
+            "service_environment": OrderedDict(),
+            "commands": [],
+            "cache": {},
+            RESOURCES: {}
+        }
+
+        if stage_name not in data:
+            return step
+
+        stage = data[stage_name]
+
+        # common to all services
+        step["environment"].update(stage.get("environment", {}))
+        step["commands"].extend(stage.get("commands", []))
+        step["cache"] = stage.get("cache", {})
+        step[RESOURCES] = stage.get(RESOURCES, {})
+        for key in CONDITIONS:
+            step[key] = stage.get(key, [])
+
+        if service_name in stage:
+            system = stage[service_name]
+
+            # consider service offering multiple operating system support
+            if SERVICES[service_name]:
+                system = system.get(operating_system, {})
+
+            # if any, get service specific environment
+            step["service_environment"].update(system.get("environment", {}))
+
+            # ... and append commands
+            step["commands"].extend(system.get("commands", []))
+
+            # if any, get service specific cache, resources and changed paths
+            # patterns
+            for key in ("cache", RESOURCES) + CONDITIONS:
+                step[key] = system.get(key, step[key])
+
+        return step
+
+    def step_fingerprint(self, stage_name, config_file=SCIKIT_CI_CONFIG):
+        """Return a digest of the environment and commands of ``stage_name``
+        for the current service and operating system (see
+        :meth:`current_operating_system`), and of the values in ``self.env``
+        of the ``$<EnvironmentVarName>`` they reference.
+
+        Variables defined by the step or by the steps following it are not
+        considered: ``self.env`` holds the values they had once these steps
+        were executed. Their value when the step starts only depends on the
+        definitions of the previous steps, whose changes also invalidate the
+        following steps (see :func:`invalidate_changed_steps`).
+        """
+        service_name = utils.current_service()
+        operating_system = self.current_operating_system(service_name)
+        data = self.load_config(config_file)
+        definitions = [
+            self.select_step(data, name, service_name, operating_system)
+            for name in STEPS[STEPS.index(stage_name):]]
+        step = definitions[0]
+        definition = json.dumps(
+            [step["environment"], step["service_environment"],
+             step["commands"]], sort_keys=True)
+        defined = set()
+        for _step in definitions:
+            defined.update(_step["environment"])
+            defined.update(_step["service_environment"])
+        names = set([reference[2:-1] for reference in
+                     self.ENV_VAR_REGEX.findall(definition)]) - defined
+        content = json.dumps([definition, [
+            (name, self.env.get(name)) for name in sorted(names)]])
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
 
-            # Expand all occurrences of ``$<EnvironmentVarName>``.
-            Driver.recursively_expand_environment_vars(environment, global_env)
+    @staticmethod
+    def parse_config(config_file, stage_name, service_name, global_env):
+        data = Driver.load_config(config_file)
 
-            if service_name in stage:
-                system = stage[service_name]
+        operating_system = None
+        if SERVICES.get(service_name):
+            operating_system = global_env.get(SERVICES[service_name])
 
-                # consider service offering multiple operating system support
-                if SERVICES[service_name]:
-                    operating_system = global_env[SERVICES[service_name]]
-                    system = system.get(operating_system, {})
+        step = Driver.select_step(
+            data, stage_name, service_name, operating_system)
 
-                # if any, get service specific environment
-                system_environment = system.get("environment", {})
+        environment = step["environment"]
+        system_environment = step["service_environment"]
+        commands = step["commands"]
 
-                # Sanity checks
-                Driver._raise_if_setting_ci_name(environment)
+        # Sanity checks
+        Driver._raise_if_setting_ci_name(environment)
+        Driver._raise_if_setting_ci_name(system_environment)
 
-                # Expand system environment values
-                Driver.recursively_expand_environment_vars(
-                    system_environment, global_env)
+        # Expand all occurrences of ``$<EnvironmentVarName>``.
+        Driver.recursively_expand_environment_vars(environment, global_env)
 
-                # Merge system environment variable back into environment
-                environment.update(system_environment)
+        # Expand system environment values
+        Driver.recursively_expand_environment_vars(
+            system_environment, global_env)
 
-                # ... and append commands
-                commands += system.get("commands", [])
+        # Merge system environment variable back into environment
+        environment.update(system_environment)
 
         return environment, commands
 
-    def execute_commands(self, stage_name):
+    def execute_commands(self, stage_name, config_file=SCIKIT_CI_CONFIG):
 
-        print(Figlet().renderText(stage_name.upper()))
+        self.print_banner(stage_name)
 
         service_name = utils.current_service()
 
         self.env["CI_NAME"] = service_name
 
+        self.fingerprint = self.step_fingerprint(stage_name, config_file)
+
         environment, commands = self.parse_config(
-            SCIKIT_CI_CONFIG, stage_name, service_name, self.env)
+            config_file, stage_name, service_name, self.env)
 
         # Unescape environment variables
         for name in environment:
@@ -404,33 +716,275 @@ class Driver(object):
                 value = value.replace(old, new)
             self.env[name] = value
 
-        for cmd in commands:
-            language = "default"
-            if isinstance(cmd, MutableMapping):
-                # Prevent output of debug message.
-                # Workaround https://bitbucket.org/ruamel/yaml/pull-requests/13
-                try:
-                    oldout = sys.stdout
-                    sys.stdout = StringIO()
-                    language = list(cmd.keys())[0]
-                    cmd = list(cmd.values())[0]
-                finally:
-                    sys.stdout = oldout
+        operating_system = self.current_operating_system(service_name)
+        step = self.select_step(
+            self.load_config(config_file), stage_name, service_name,
+            operating_system)
+
+        if not self.should_execute("step", stage_name, step):
+            return
+
+        step_start = time.time()
+
+        if self.timings is not None:
+            self.timings.service = service_name
+            self.timings.operating_system = operating_system
+
+        cache_misses = self.restore_cache(
+            stage_name, step["cache"], [service_name, operating_system])
+
+        # Advertise the jobserver to commands without recording it in env.json
+        makeflags = self.env.get("MAKEFLAGS")
+        if self.jobserver is not None:
+            self.env["MAKEFLAGS"] = self.jobserver.makeflags(makeflags or "")
+
+        if self.log_dir is not None:
+            self.step_log = StepLog(
+                self.log_dir, stage_name, **self.log_settings)
+        try:
+            self.execute_step_commands(stage_name, commands)
+        except exceptions.SKCIStepExecutionError as exc:
+            if self.timings is not None:
+                self.timings.record(
+                    stage_name, time.time() - step_start, exc.return_code)
+            self.record_metrics(
+                stage_name, service_name, operating_system,
+                time.time() - step_start, 1)
+            raise
+        finally:
+            if self.step_log is not None:
+                self.step_log.close()
+                self.step_log = None
+
+        if makeflags is None:
+            self.env.pop("MAKEFLAGS", None)
+        else:
+            self.env["MAKEFLAGS"] = makeflags
+
+        self.clear_checkpoints(stage_name)
+
+        self.save_cache(cache_misses)
+
+        duration = time.time() - step_start
+        if self.changes is not None:
+            self.changes.record_duration(stage_name, duration)
+        if self.timings is not None:
+            regression = self.timings.check(stage_name, duration)
+            if regression is not None:
+                self.log("[scikit-ci] Warning: %s" % regression)
+            self.timings.record(stage_name, duration)
+        self.record_metrics(
+            stage_name, service_name, operating_system, duration, 0)
+
+    def print_banner(self, stage_name):
+        banner = render_banner(stage_name.upper(), self.banner)
+        if banner is not None:
+            print(banner)
+
+    def record_metrics(self, stage_name, service_name, operating_system,
+                       duration, failures):
+        """Write the metrics of the execution of ``stage_name`` into the
+        metrics textfile if any.
+        """
+        if self.metrics is None:
+            return
+        self.metrics.record(
+            stage_name, service_name, operating_system, duration=duration,
+            commands=self.executed_commands, failures=failures,
+            cache_hits=self.cache_hits, cache_misses=self.cache_misses,
+            config_parse_time=Driver.config_parse_time)
+
+    def execute_step_commands(self, stage_name, commands):
+        """Execute ``commands`` of step ``stage_name`` skipping the ones
+        completed during a previous execution if resuming.
+        """
+        resuming = self.resume
+        for index, cmd in enumerate(commands):
+            language, cmd, conditions = self.parse_command(cmd)
+
+            name = "%s:%d" % (stage_name, index)
+            if not self.should_execute("command", name, conditions):
+                # Resuming continues after the skipped command
+                self.save_checkpoint(stage_name, index, language, cmd)
+                continue
 
-            else:
-                # Expand environment variables used within commands
-                posix_shell = "COMSPEC" not in os.environ
-                cmd = self.expand_command(
-                    cmd, self.env, posix_shell=posix_shell).strip()
+            if resuming:
+                if self.env.get(self.checkpoint_name(stage_name, index)) == \
+                        self.checkpoint_value(language, cmd):
+                    self.log("[scikit-ci] Skipping command %d: completed "
+                             "during a previous execution" % index)
+                    continue
+                resuming = False
+
+            if self.step_log is not None:
+                self.step_log.start_command(index, cmd)
+            kwds = {}
+            if self.profile_dir is not None and language == "python":
+                kwds["profile_output"] = self.profile_output(stage_name, index)
+            start = time.time()
+            self.line_timings = []
+            self.executed_commands += 1
             try:
                 self.check_call(
                     cmd, cmd_config=self.get_command_config(language),
-                    env=self.env
+                    env=self.env, **kwds
                 )
             except subprocess.CalledProcessError as exc:
+                if self.timings is not None:
+                    self.timings.record(
+                        stage_name, time.time() - start, exc.returncode,
+                        index, cmd, self.line_timings)
                 raise exceptions.SKCIStepExecutionError(
                     stage_name, exc.returncode, cmd, exc.output
                 )
+            duration = time.time() - start
+            if self.changes is not None:
+                self.changes.record_duration(name, duration)
+            if self.timings is not None:
+                self.timings.record(
+                    stage_name, duration, 0, index, cmd, self.line_timings)
+            self.save_checkpoint(stage_name, index, language, cmd)
+
+    def parse_command(self, cmd):
+        """Return a tuple ``(language, cmd, conditions)`` associated with
+        a command found in the configuration.
+
+        ``conditions`` is a dictionary associating ``only_if_changed`` or
+        ``skip_if_changed_only`` with list of path patterns.
+        """
+        language = "default"
+        conditions = {}
+        if isinstance(cmd, MutableMapping):
+            # Prevent output of debug message.
+            # Workaround https://bitbucket.org/ruamel/yaml/pull-requests/13
+            try:
+                oldout = sys.stdout
+                sys.stdout = StringIO()
+                conditions = dict([(key, cmd[key]) for key in CONDITIONS
+                                   if key in cmd])
+                language = [key for key in cmd.keys()
+                            if key not in CONDITIONS + (RESOURCES,)][0]
+                cmd = cmd[language]
+            finally:
+                sys.stdout = oldout
+
+        if language != "python":
+            # Expand environment variables used within commands
+            posix_shell = "COMSPEC" not in os.environ
+            cmd = self.expand_command(
+                cmd, self.env, posix_shell=posix_shell).strip()
+
+        return language, cmd, conditions
+
+    def should_execute(self, kind, name, definition):
+        """Return False if the step or command ``name`` should be skipped
+        considering the paths changed since the configured base.
+
+        See :class:`ci.changes.ChangeDetector`.
+        """
+        if self.changes is None:
+            return True
+        execute, reason = self.changes.should_execute(name, definition)
+        if reason is None:
+            return execute
+        message = "[scikit-ci] %s %s '%s': %s" % (
+            "Executing" if execute else "Skipping", kind, name, reason)
+        duration = self.changes.duration(name)
+        if not execute and duration is not None:
+            message += " (saved %.2fs)" % duration
+        self.log(message)
+        return execute
+
+    def current_operating_system(self, service_name):
+        """Return the operating system associated with ``service_name`` or
+        None if the service supports only one operating system.
+        """
+        if SERVICES[service_name]:
+            return self.env.get(SERVICES[service_name])
+        return None
+
+    def expand_path(self, path):
+        """Return the absolute path associated with ``path`` after expanding
+        ``~`` and all occurrences of ``$<EnvironmentVarName>``.
+        """
+        path = re.sub(
+            Driver.ENV_VAR_REGEX,
+            lambda match: self.env.get(match.group(0)[2:-1], ""), str(path))
+        return os.path.abspath(os.path.expanduser(path))
+
+    def cache_entries(self, stage_name, cache, extra=None):
+        """Return the list of ``(key, directory)`` associated with the
+        directories listed in the ``cache`` section of ``stage_name``.
+        """
+        if not cache:
+            return []
+        key_files = []
+        for pattern in cache.get("key_files", []):
+            key_files.extend(sorted(glob.glob(self.expand_path(pattern))))
+        inputs_digest = None
+        if key_files:
+            if self.hasher is None:
+                self.hasher = input_hasher()
+            inputs_digest = self.hasher.digest(key_files)
+            self.hasher.save()
+            self.log("[scikit-ci] Hashed %d files (%d unchanged) in %.2fs" % (
+                self.hasher.hashed_count, self.hasher.reused_count,
+                self.hasher.duration))
+        entries = []
+        for directory in cache.get("directories", []):
+            key = DirectoryCache.key(
+                stage_name, str(directory), inputs_digest,
+                [cache.get("key"), extra])
+            entries.append((key, self.expand_path(directory)))
+        return entries
+
+    def restore_cache(self, stage_name, cache, extra=None):
+        """Restore the directories listed in the ``cache`` section of
+        ``stage_name``.
+
+        Return the list of ``(key, directory)`` that were not found in the
+        cache.
+        """
+        entries = self.cache_entries(stage_name, cache, extra)
+        if entries and self.cache is None:
+            self.cache = DirectoryCache()
+        misses = []
+        for key, directory in entries:
+            start = time.time()
+            try:
+                restored = self.cache.restore(key, directory)
+            except SKCICacheError as exc:
+                # A remote cache is best-effort: failures are cache misses
+                self.log("[scikit-ci] Warning: %s" % exc)
+                restored = False
+            if restored:
+                self.cache_hits += 1
+                self.log("[scikit-ci] Cache restored: %s (%.2fs)" % (
+                    directory, time.time() - start))
+            else:
+                self.log("[scikit-ci] Cache miss: %s" % directory)
+                misses.append((key, directory))
+        self.cache_misses = len(misses)
+        return misses
+
+    def save_cache(self, entries):
+        """Save the directories listed in ``entries``.
+
+        ``entries`` is a list of ``(key, directory)`` returned by
+        :meth:`restore_cache`.
+        """
+        start = time.time()
+        saved = [directory for key, directory in entries
+                 if self.cache.save(key, directory)]
+        if not saved:
+            return
+        try:
+            self.cache.wait()
+        except SKCICacheError as exc:
+            self.log("[scikit-ci] Warning: %s" % exc)
+            return
+        self.log("[scikit-ci] Cache saved: %s (%.2fs)" % (
+            ", ".join(saved), time.time() - start))
 
 
 def dependent_steps(step):
@@ -442,40 +996,242 @@ def dependent_steps(step):
     return STEPS[0:step_index]
 
 
-def execute_step(
-        step, force=False, with_dependencies=True, clear_cached_env=False):
+def step_fingerprint(step, config_file=SCIKIT_CI_CONFIG):
+    """Return the fingerprint of ``step`` as defined in ``config_file`` for
+    the current service and operating system, considering the environment
+    saved by the previous executions.
 
-    if not os.path.exists(SCIKIT_CI_CONFIG):  # pragma: no cover
-        raise OSError(errno.ENOENT, "Couldn't find %s" % SCIKIT_CI_CONFIG)
+    See :meth:`Driver.step_fingerprint`.
+    """
+    d = Driver()
+    d.load_env()
+    try:
+        d.env["CI_NAME"] = utils.current_service()
+        return d.step_fingerprint(step, config_file)
+    finally:
+        d.unload_env()
+
+
+def step_resources(steps, config_file=SCIKIT_CI_CONFIG):
+    """Return the resources needed to execute ``steps`` as defined in
+    ``config_file`` for the current service and operating system.
+
+    Steps and commands are executed sequentially, the largest declared
+    amount of each resource is returned. See :func:`ci.resources.combine`.
+    """
+    service_name = utils.current_service()
+    operating_system = utils.current_operating_system(service_name)
+    data = Driver.load_config(config_file)
+    requests = []
+    for _step in steps:
+        step = Driver.select_step(
+            data, _step, service_name, operating_system)
+        requests.append(parse_resources(step[RESOURCES]))
+        requests.extend([parse_resources(cmd[RESOURCES])
+                         for cmd in step["commands"]
+                         if isinstance(cmd, MutableMapping) and
+                         RESOURCES in cmd])
+    return combine(requests)
+
+
+def invalidate_changed_steps(steps, config_file=SCIKIT_CI_CONFIG):
+    """Remove the ``SCIKIT_CI_<STEP>`` variable of the first step in ``steps``
+    whose fingerprint changed since it was executed, as well as the ones of
+    all the steps depending on it.
+
+    Steps executed without recording a fingerprint are considered unchanged.
+    """
+    env = Driver.read_env()
+    for step in steps:
+        marker = 'SCIKIT_CI_%s' % step.upper()
+        fingerprint = env.get('%s_FINGERPRINT' % marker)
+        if marker not in env or fingerprint is None:
+            continue
+        if fingerprint == step_fingerprint(step, config_file):
+            continue
+        Driver.log("[scikit-ci] Definition of step '%s' changed since it "
+                   "was executed" % step)
+        Driver.update_env(removed=[
+            name % _step.upper() for _step in STEPS[STEPS.index(step):]
+            for name in ('SCIKIT_CI_%s', 'SCIKIT_CI_%s_FINGERPRINT')])
+        return
 
-    if step not in STEPS:  # pragma: no cover
-        raise KeyError("invalid step: {}".format(step))
 
-    if clear_cached_env and os.path.exists('env.json'):
-        os.remove('env.json')
+def lookup_cache(cache, steps, config_file=SCIKIT_CI_CONFIG, hasher=None):
+    """Query ``cache`` for the directories cached by all ``steps`` at once.
 
-    depends = dependent_steps(step)
+    Return the hasher used to compute the keys (see
+    :func:`ci.hashing.input_hasher`) or ``hasher`` if no key was computed.
+    """
+    data = Driver.load_config(config_file)
+    steps = [step for step in steps if data and step in data]
+    if not steps:
+        return hasher
+    d = Driver()
+    d.hasher = hasher
+    d.load_env()
+    try:
+        service_name = utils.current_service()
+        operating_system = d.current_operating_system(service_name)
+        keys = []
+        for step in steps:
+            definition = Driver.select_step(
+                data, step, service_name, operating_system)
+            keys.extend([key for key, _ in d.cache_entries(
+                step, definition["cache"], [service_name, operating_system])])
+        if keys:
+            try:
+                cache.lookup(keys)
+            except SKCICacheError as exc:
+                Driver.log("[scikit-ci] Warning: %s" % exc)
+    finally:
+        d.unload_env()
+    return d.hasher
+
+
+def steps_to_execute(step, with_dependencies=True, force=False,
+                     config_file=SCIKIT_CI_CONFIG):
+    """Return the list of steps to execute to execute ``step``, skipping the
+    ones already executed unless ``force`` is True.
+    """
+    steps = [step]
+    if with_dependencies:
+        steps = dependent_steps(step) + steps
 
     # If forcing execution, remove SCIKIT_CI_<step> env. variables
     if force:
-        env = Driver.read_env()
-        steps = [step]
-        if with_dependencies:
-            steps += depends
-        for _step in steps:
-            if 'SCIKIT_CI_%s' % _step.upper() in env:
-                del env['SCIKIT_CI_%s' % _step.upper()]
-        Driver.save_env(env)
+        Driver.update_env(
+            removed=['SCIKIT_CI_%s' % _step.upper() for _step in steps])
+
+    # Re-execute steps whose definition changed
+    invalidate_changed_steps(steps, config_file)
+
+    # Skip steps executed before the last one already executed
+    env = Driver.read_env()
+    executed = [_step for _step in steps
+                if 'SCIKIT_CI_%s' % _step.upper() in env]
+    if executed:
+        steps = steps[steps.index(executed[-1]) + 1:]
+    return steps
+
+
+def compile_plan(path=PLAN_FILE, config_file=SCIKIT_CI_CONFIG):
+    """Write the plan of the steps defined in ``config_file`` for the current
+    service and operating system into ``path`` and return it.
+
+    See :mod:`ci.plan`.
+    """
+    service_name = utils.current_service()
+    operating_system = utils.current_operating_system(service_name)
+    data = Driver.load_config(config_file)
+    definitions = OrderedDict()
+    for step in STEPS:
+        if step not in data:
+            continue
+        definition = Driver.select_step(
+            data, step, service_name, operating_system)
+        Driver._raise_if_setting_ci_name(definition["environment"])
+        Driver._raise_if_setting_ci_name(definition["service_environment"])
+        definitions[step] = definition
+    return write_plan(
+        path, definitions, config_digest(config_file), service_name,
+        operating_system, data.get("matrix"))
+
+
+def load_plan(path, config_file=SCIKIT_CI_CONFIG):
+    """Use the plan ``path`` instead of parsing ``config_file``.
+
+    Raise :class:`ci.exceptions.SKCIError` if the plan was not compiled
+    from the current content of ``config_file`` for the current service and
+    operating system.
+    """
+    service_name = utils.current_service()
+    plan = read_plan(path, config_file, service_name,
+                     utils.current_operating_system(service_name))
+    Driver.cache_config(
+        config_file, plan["config_digest"], plan_config(plan))
 
-    # Skip step if it has already been executed
-    if 'SCIKIT_CI_%s' % step.upper() in Driver.read_env():
-        return
 
-    # Recursively execute dependent steps
-    if with_dependencies and depends:
-        execute_step(depends[-1], with_dependencies=with_dependencies)
+def execute_step(
+        step, force=False, with_dependencies=True, clear_cached_env=False,
+        cache_dir=None, cache_max_size=None, cache_url=None,
+        changed_base=None, resume=False, config_file=SCIKIT_CI_CONFIG,
+        max_jobs=None, timestamps=False, tail_lines=TAIL_LINES,
+        tail_size=TAIL_SIZE, log_dir=None, log_compression="none",
+        log_max_size=None, log_max_files=None, log_per_command=False,
+        timings_db=TIMINGS_DB, regression_mads=REGRESSION_MADS,
+        regression_threshold=REGRESSION_THRESHOLD, fail_on_regression=False,
+        profile_shell=False, profile_python=False, profile_dir=PROFILE_DIR,
+        profile_top=PROFILE_TOP, metrics_textfile=None, python_preload=None,
+        banner="figlet", plan=None):
+
+    if not os.path.exists(config_file):  # pragma: no cover
+        raise OSError(errno.ENOENT, "Couldn't find %s" % config_file)
+
+    if plan is not None:
+        load_plan(plan, config_file)
 
-    d = Driver()
-    with d.env_context():
-        d.execute_commands(step)
-        d.env['SCIKIT_CI_%s' % step.upper()] = '1'
+    if step not in STEPS:  # pragma: no cover
+        raise KeyError("invalid step: {}".format(step))
+
+    if clear_cached_env and os.path.exists('env.json'):
+        os.remove('env.json')
+
+    steps = steps_to_execute(step, with_dependencies, force, config_file)
+
+    cache = DirectoryCache(
+        cache_backend(cache_url or cache_dir, cache_max_size))
+    hasher = lookup_cache(cache, steps, config_file)
+    changes = ChangeDetector(changed_base)
+    server = jobserver(max_jobs) if steps else None
+    metrics = MetricsTextfile(metrics_textfile) if metrics_textfile else None
+    zygote = Zygote(python_preload, log=Driver.log) \
+        if python_preload and steps else None
+    timings = None
+    if timings_db:
+        timings = TimingRecorder(
+            timings_db, regression_mads, regression_threshold)
+
+    try:
+        for _step in steps:
+            d = Driver()
+            d.cache = cache
+            d.hasher = hasher
+            d.changes = changes
+            d.resume = resume
+            d.jobserver = server
+            d.timestamps = timestamps
+            d.tail_lines = tail_lines
+            d.tail_size = tail_size
+            d.log_dir = log_dir
+            d.timings = timings
+            d.profile_shell = profile_shell
+            d.profile_dir = profile_dir if profile_python else None
+            d.profile_top = profile_top
+            d.metrics = metrics
+            d.zygote = zygote
+            d.banner = banner
+            d.log_settings = {
+                "compression": log_compression,
+                "max_size": log_max_size,
+                "max_files": log_max_files,
+                "per_command": log_per_command
+            }
+            with d.env_context():
+                d.execute_commands(_step, config_file)
+                d.env['SCIKIT_CI_%s' % _step.upper()] = '1'
+                d.env['SCIKIT_CI_%s_FINGERPRINT' % _step.upper()] = \
+                    d.fingerprint
+    finally:
+        if server is not None:
+            server.close()
+        if zygote is not None:
+            zygote.close()
+        if timings is not None:
+            timings.save()
+
+    if steps:
+        changes.save()
+
+    if fail_on_regression and timings is not None and timings.regressions:
+        raise exceptions.SKCIRegressionError(timings.regressions)
@@ -22,6 +22,10 @@ class SKCIStepExecutionError(SKCIError):
         self.output = output
 
     def __str__(self):
+        output = ""
+        if self.output:
+            output = "  Output (last lines):\n" + "\n".join(
+                ["    " + line for line in self.output.splitlines()]) + "\n"
         return textwrap.dedent(
             r"""
             A command failed while executing {step} step.
@@ -31,12 +35,49 @@ class SKCIStepExecutionError(SKCIError):
                 {cmd}
               Working directory:
                 {cwd}
-
-            Please see above for more information.
             """.format(
                 step=self.step.upper(),
                 return_code=self.return_code,
                 cmd=self.cmd,
                 cwd=os.getcwd()
             )
+        ) + output + "\nPlease see above for more information.\n"
+
+
+class SKCIMatrixError(SKCIError):
+    """Exception raised when the execution of a step failed for at least one
+    matrix entry.
+    """
+    def __init__(self, step, entries):
+        self.step = step
+        self.entries = entries
+
+    def __str__(self):
+        return textwrap.dedent(
+            r"""
+            Execution of {step} step failed for the following matrix entries:
+            {entries}
+            """
+        ).format(
+            step=self.step.upper(),
+            entries="\n".join([
+                "  {} (failed to start: {})".format(entry.name, entry.error)
+                if entry.error is not None else
+                "  {} (return code {}, output in {})".format(
+                    entry.name, entry.return_code, entry.output_file) +
+                "".join(["\n    " + line for line in entry.tail.lines()])
+                for entry in self.entries])
         )
+
+
+class SKCIRegressionError(SKCIError):
+    """Exception raised when steps were significantly slower than during
+    their previous executions.
+    """
+    def __init__(self, regressions):
+        self.regressions = regressions
+
+    def __str__(self):
+        return "Steps slower than during their previous executions:\n" + \
+            "\n".join(["  %s" % regression
+                       for regression in self.regressions])
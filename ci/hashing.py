@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to efficiently hash the content of
+files and directories.
+
+Files are hashed in a pool of threads using memory-mapped reads. Digests are
+cached based on the inode, size and modification time of the files so that
+unchanged files are never read again.
+
+In a git checkout, the ids of the objects already computed by git are used
+instead of hashing files without local modifications.
+"""
+
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import subprocess
+import time
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    scandir = None
+
+from . import utils
+from .constants import SCIKIT_CI_DIR
+
+HASH_CACHE = os.path.join(SCIKIT_CI_DIR, "hashes.json")
+"""Default file where digests of files are cached."""
+
+EXCLUDED_DIRECTORIES = (".git", SCIKIT_CI_DIR)
+"""Name of the directories ignored when walking a tree."""
+
+PATHS_PER_CALL = 1000
+"""Maximum number of paths passed to a single git command."""
+
+_RACY_DELAY = 2
+"""Digest of files modified less than this number of seconds ago are not
+cached, their content could change without their modification time being
+updated."""
+
+
+def _mtime_ns(stat):
+    return getattr(stat, "st_mtime_ns", int(stat.st_mtime * 1e9))
+
+
+def _ancestors(path):
+    """Yield the absolute ``path`` and all the directories containing it.
+    """
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+
+
+def hash_file(path, size=None):
+    """Return the sha1 digest of the file ``path``.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as input_stream:
+        if size is None:
+            size = os.fstat(input_stream.fileno()).st_size
+        if size:
+            mapped = mmap.mmap(
+                input_stream.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(mapped)
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+
+def walk(path, excluded_directories=EXCLUDED_DIRECTORIES):
+    """Yield ``(path, stat)`` for all files found in directory ``path``.
+    """
+    if scandir is None:  # pragma: no cover
+        for root, directories, files in os.walk(path):
+            directories[:] = [directory for directory in directories
+                              if directory not in excluded_directories]
+            for name in files:
+                file_path = os.path.join(root, name)
+                yield file_path, os.stat(file_path)
+        return
+    directories = [path]
+    while directories:
+        for entry in scandir(directories.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in excluded_directories:
+                    directories.append(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.stat()
+
+
+class Hasher(object):
+    """Base class of the objects hashing files.
+
+    Sub-classes are expected to implement :meth:`hash_paths` and to set
+    ``hashed_count``, ``reused_count`` and ``duration``.
+    """
+
+    def hash_paths(self, paths, trees=True):
+        """Return a dictionary associating paths with digests.
+
+        If ``trees`` is False, each file found in ``paths`` is associated
+        with its own digest. Otherwise, the hasher may associate a digest
+        with a whole directory.
+        """
+        raise NotImplementedError
+
+    def digest(self, paths):
+        """Return a digest of the content of all files found in ``paths``.
+
+        Paths of the files are considered relative to the current directory
+        so that the digest does not depend on the location of the workspace.
+        """
+        digest = hashlib.sha1()
+        for path, file_digest in sorted(self.hash_paths(paths).items()):
+            digest.update(("%s %s\n" % (
+                os.path.relpath(path).replace(os.sep, "/"), file_digest)
+            ).encode("utf-8"))
+        return digest.hexdigest()
+
+    def save(self):
+        pass
+
+
+class FileHasher(Hasher):
+    """Hash files using ``max_workers`` threads.
+
+    If ``cache_file`` is set, digests are associated with the
+    ``(inode, size, mtime)`` of each file and saved in that file.
+    """
+
+    def __init__(self, cache_file=None, max_workers=None):
+        self.cache_file = cache_file
+        if max_workers is None:
+            max_workers = min(32, multiprocessing.cpu_count() + 4)
+        self.max_workers = max_workers
+        self._cache = self._load(cache_file) if cache_file else {}
+        self._modified = False
+
+        self.hashed_count = 0
+        """Number of files read during the last call to :meth:`hash_paths`."""
+
+        self.reused_count = 0
+        """Number of cached digests used during the last call to
+        :meth:`hash_paths`."""
+
+        self.duration = 0.
+        """Duration in seconds of the last call to :meth:`hash_paths`."""
+
+    @staticmethod
+    def _load(cache_file):
+        if not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file) as input_stream:
+                return json.load(input_stream)
+        except ValueError:
+            return {}
+
+    def _stat_key(self, stat):
+        return [stat.st_ino, stat.st_size, _mtime_ns(stat)]
+
+    def hash_paths(self, paths, trees=True):
+        """Return a dictionary associating each file found in ``paths`` with
+        its digest.
+
+        ``paths`` is a list of files or directories. Directories are walked
+        recursively.
+        """
+        start = time.time()
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(walk(path))
+            elif os.path.isfile(path):
+                files.append((path, os.stat(path)))
+
+        digests = {}
+        to_hash = []
+        for path, stat in files:
+            cached = self._cache.get(path)
+            if cached and cached[:3] == self._stat_key(stat):
+                digests[path] = cached[3]
+            else:
+                to_hash.append((path, stat))
+
+        if len(to_hash) > 1:
+            pool = ThreadPool(min(self.max_workers, len(to_hash)))
+            try:
+                hashed = pool.map(
+                    lambda item: hash_file(item[0], item[1].st_size), to_hash)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            hashed = [hash_file(path, stat.st_size) for path, stat in to_hash]
+
+        now = time.time()
+        for (path, stat), digest in zip(to_hash, hashed):
+            digests[path] = digest
+            if now - stat.st_mtime > _RACY_DELAY:
+                self._cache[path] = self._stat_key(stat) + [digest]
+                self._modified = True
+
+        self.hashed_count = len(to_hash)
+        self.reused_count = len(files) - len(to_hash)
+        self.duration = time.time() - start
+        return digests
+
+    def save(self):
+        """Save cached digests into ``cache_file``.
+        """
+        if not self.cache_file or not self._modified:
+            return
+        # Merge digests saved by other hashers since this one was created
+        cache = self._load(self.cache_file)
+        cache.update(self._cache)
+        self._cache = cache
+        utils.atomic_write(self.cache_file, json.dumps(self._cache))
+        self._modified = False
+
+
+class GitHasher(Hasher):
+    """Hash files of a git checkout using the objects known to git.
+
+    Paths without local modifications are associated with the id of their
+    tree or blob object in ``HEAD``. For other paths, each tracked file is
+    associated with the id of its blob in the index, and modified or
+    untracked files are hashed using ``file_hasher``. Files ignored by git
+    are skipped, unless they are explicitly listed.
+
+    Paths outside of the checkout are hashed using ``file_hasher``, as well
+    as all the paths if git fails.
+    """
+
+    def __init__(self, file_hasher=None, git="git"):
+        self.file_hasher = file_hasher or FileHasher()
+        self.git = git
+        self.hashed_count = 0
+        self.reused_count = 0
+        self.duration = 0.
+
+    def _git(self, *args):
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                [self.git] + list(args), stderr=devnull).decode("utf-8")
+
+    @staticmethod
+    def is_available(git="git"):
+        """Return True if the current directory is part of a git checkout
+        with at least one commit.
+        """
+        try:
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call(
+                    [git, "rev-parse", "--verify", "-q", "HEAD"],
+                    stdout=devnull, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return True
+
+    def _git_paths(self, args, paths):
+        """Return the entries output by ``git <args> -z -- <paths>``.
+
+        Paths are passed literally (e.g ``*`` is not a pattern) in batches of
+        :const:`PATHS_PER_CALL` so that long lists do not exceed the limits of
+        the command line.
+        """
+        entries = []
+        for index in range(0, len(paths), PATHS_PER_CALL):
+            entries.extend(self._git(*(
+                ["--literal-pathspecs"] + list(args) + ["-z", "--"] +
+                list(paths[index:index + PATHS_PER_CALL]))).split("\0"))
+        return [entry for entry in entries if entry]
+
+    def changed_files(self, paths, top_level=None):
+        """Return the set of absolute paths of the files found in ``paths``
+        that are modified, staged or untracked.
+
+        ``paths`` must be part of the checkout whose top level directory is
+        ``top_level``. It is queried if not provided.
+        """
+        if top_level is None:
+            top_level = self._git("rev-parse", "--show-toplevel").strip()
+        entries = self._git_paths(
+            ["status", "--porcelain", "--untracked-files=all"], paths)
+        changed = set()
+        while entries:
+            entry = entries.pop(0)
+            if "R" in entry[:2] or "C" in entry[:2]:
+                # Skip the original path of renamed or copied files
+                entries.pop(0)
+            changed.add(os.path.normpath(os.path.join(top_level, entry[3:])))
+        return changed
+
+    def hash_paths(self, paths, trees=True):
+        """Return a dictionary associating each path (or each file found in
+        the path if it has local modifications) with a digest.
+
+        If ``trees`` is False, each file is always associated with its own
+        digest.
+
+        Whatever the number of paths, git is executed at most four times:
+        once to find the checkout, once to list local modifications, once to
+        read the objects of unmodified paths from ``HEAD`` and once to read
+        the objects of the other tracked files from the index.
+        """
+        start = time.time()
+        paths = [path for path in paths if os.path.exists(path)]
+        try:
+            digests = self._hash_checkout_paths(paths, trees)
+        except (OSError, subprocess.CalledProcessError):
+            # Without usable git, hash all the files
+            digests = self.file_hasher.hash_paths(paths)
+        self.hashed_count = self.file_hasher.hashed_count
+        self.reused_count = len(digests) - self.hashed_count
+        self.duration = time.time() - start
+        return digests
+
+    def _hash_checkout_paths(self, paths, trees):
+        if not paths:
+            return self.file_hasher.hash_paths([])
+        top_level = os.path.realpath(
+            self._git("rev-parse", "--show-toplevel").strip())
+        outside = [path for path in paths if not (
+            os.path.realpath(path) + os.sep).startswith(top_level + os.sep)]
+        paths = [path for path in paths if path not in outside]
+        changed = self.changed_files(paths, top_level) if paths else set()
+        # Changed files and all the directories containing them
+        modified = set()
+        for changed_path in changed:
+            modified.update(_ancestors(changed_path))
+        digests = {}
+        remaining = dict([(os.path.abspath(path), path) for path in paths])
+        if trees:
+            # Without local modification, use the objects from HEAD. The
+            # object of the current directory is not listed by ls-tree.
+            unmodified = [
+                path for prefix, path in remaining.items()
+                if prefix not in modified and
+                os.path.basename(os.path.relpath(prefix)) not in (
+                    os.curdir, os.pardir)]
+            for entry in self._git_paths(["ls-tree", "HEAD"], unmodified):
+                info, file_path = entry.split("\t", 1)
+                path = remaining.pop(os.path.abspath(file_path), None)
+                if path is not None:
+                    digests[path] = info.split()[2]
+        # Other paths are hashed file by file
+        with_files = set()
+        for entry in self._git_paths(["ls-files", "-s"], list(
+                remaining.values())):
+            info, file_path = entry.split("\t", 1)
+            file_path = os.path.normpath(file_path)
+            absolute_path = os.path.abspath(file_path)
+            with_files.update(_ancestors(absolute_path))
+            if absolute_path not in changed:
+                digests[file_path] = info.split()[1]
+        # Paths with changed files were not resolved using HEAD
+        to_hash = set([os.path.relpath(changed_path)
+                       for changed_path in changed
+                       if os.path.isfile(changed_path)])
+        for prefix, path in remaining.items():
+            if prefix not in with_files and prefix not in modified:
+                # Neither tracked nor untracked: the path is ignored
+                to_hash.add(path)
+        to_hash.update(outside)
+        digests.update(self.file_hasher.hash_paths(sorted(to_hash)))
+        return digests
+
+    def save(self):
+        self.file_hasher.save()
+
+
+def input_hasher(cache_file=HASH_CACHE):
+    """Return a :class:`GitHasher` if the current directory is part of a git
+    checkout, otherwise return a :class:`FileHasher`.
+
+    Digests of files hashed by either of them are cached in ``cache_file``.
+    """
+    file_hasher = FileHasher(cache_file)
+    if GitHasher.is_available():
+        return GitHasher(file_hasher)
+    return file_hasher
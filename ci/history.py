@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to record the duration (or any other
+measurement like the peak memory usage) of jobs across executions and to
+order jobs so that the longest ones are started first.
+"""
+
+import heapq
+import json
+import os
+
+from . import utils
+from .constants import SCIKIT_CI_DIR
+
+HISTORY_FILE = os.path.join(SCIKIT_CI_DIR, "history.json")
+"""Default file where the durations of jobs are recorded."""
+
+HISTORY_SIZE = 10
+"""Number of durations recorded for each job."""
+
+DEFAULT_ESTIMATE = 60.
+"""Duration in seconds assumed for jobs never executed when no other job has
+a known duration."""
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.
+
+
+class History(object):
+    """Keep track of the last ``size`` durations of each job.
+
+    Jobs are identified by a key (e.g ``matrix/test/PYTHON-3.7``). Durations
+    recorded since the history was loaded are merged with the ones saved by
+    other processes when calling :meth:`save`.
+    """
+
+    def __init__(self, path=HISTORY_FILE, size=HISTORY_SIZE):
+        self.path = path
+        self.size = size
+        self._durations = self._load(path)
+        self._recorded = {}
+
+    @staticmethod
+    def _load(path):
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as input_stream:
+                return json.load(input_stream)
+        except ValueError:
+            return {}
+
+    def durations(self, key):
+        """Return the list of recorded durations of job ``key``, the most
+        recent last.
+        """
+        return list(self._durations.get(key, []))
+
+    def estimate(self, key):
+        """Return the median of the recorded durations of job ``key`` or None
+        if it was never executed.
+        """
+        durations = self.durations(key)
+        if not durations:
+            return None
+        return _median(durations)
+
+    def maximum(self, key):
+        """Return the largest recorded value of job ``key`` or None if it was
+        never executed.
+        """
+        durations = self.durations(key)
+        if not durations:
+            return None
+        return max(durations)
+
+    def estimates(self, keys):
+        """Return a dictionary associating each key with its estimated
+        duration.
+
+        Jobs never executed are assumed to take the mean of the known
+        estimates, or :const:`DEFAULT_ESTIMATE` if there are none.
+        """
+        estimates = dict([(key, self.estimate(key)) for key in keys])
+        known = [value for value in estimates.values() if value is not None]
+        default = sum(known) / len(known) if known else DEFAULT_ESTIMATE
+        for key, value in estimates.items():
+            if value is None:
+                estimates[key] = default
+        return estimates
+
+    def record(self, key, duration):
+        """Record ``duration`` (in seconds) of job ``key``.
+        """
+        self._durations[key] = (
+            self.durations(key) + [duration])[-self.size:]
+        self._recorded.setdefault(key, []).append(duration)
+
+    def save(self):
+        """Save the durations recorded since the history was loaded.
+        """
+        if not self._recorded:
+            return
+        durations = self._load(self.path)
+        for key, recorded in self._recorded.items():
+            durations[key] = (durations.get(key, []) + recorded)[-self.size:]
+        utils.atomic_write(self.path, json.dumps(durations))
+        self._durations = durations
+        self._recorded = {}
+
+
+def longest_first(jobs, estimates, workers):
+    """Order ``jobs`` by decreasing estimated duration.
+
+    ``estimates`` associates each job with its estimated duration. Jobs with
+    equal estimates keep their relative order.
+
+    Return a tuple ``(ordered_jobs, makespan)`` where ``makespan`` is the
+    predicted duration of the execution of all jobs started in that order
+    by ``workers`` concurrent workers.
+    """
+    ordered = sorted(jobs, key=lambda job: -estimates[job])
+    finish_times = [0.] * max(1, min(workers, len(ordered)))
+    for job in ordered:
+        heapq.heapreplace(finish_times, finish_times[0] + estimates[job])
+    return ordered, max(finish_times)
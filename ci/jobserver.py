@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an implementation of the GNU make jobserver
+protocol.
+
+A jobserver limits the number of jobs executed concurrently by a tree of
+processes (e.g ``ci matrix`` executing ``make -j`` in several entries). Each
+process implicitly owns one token and has to read an additional token from
+a shared pipe before starting each additional job. Tokens are written back
+once jobs complete.
+
+See https://www.gnu.org/software/make/manual/html_node/Job-Slots.html
+"""
+
+import errno
+import os
+import re
+import select
+import sys
+import threading
+
+_AUTH_REGEX = re.compile(
+    r"--jobserver-(?:auth|fds)=(?:(\d+),(\d+)|fifo:(\S+))")
+_JOBS_REGEX = re.compile(r"^-j(\d*)$")
+
+_POLL_INTERVAL = 0.1
+
+TOKEN = b"+"
+"""Byte written in the pipe for each available token."""
+
+
+def _set_inheritable(fd):
+    if hasattr(os, "set_inheritable"):
+        os.set_inheritable(fd, True)
+
+
+def _open_nonblocking(fd, fifo=None):
+    """Return a new non-blocking file descriptor reading from the pipe ``fd``
+    or from the named pipe ``fifo``, or None if it can not be opened.
+
+    Descriptors returned by :func:`os.dup` share their ``O_NONBLOCK`` flag
+    with all the processes using the pipe, so the pipe is opened again
+    (using ``/proc`` for anonymous pipes).
+    """
+    path = fifo or "/proc/self/fd/%d" % fd
+    try:
+        return os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+
+
+def _fd_is_valid(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+class JobServer(object):
+    """Share ``size`` job slots through the pipe ``(read_fd, write_fd)``
+    or through the named pipe ``fifo``.
+
+    Use :meth:`create` to create a new pool of tokens or
+    :meth:`from_environment` to join the pool of a parent process (e.g
+    ``make`` or ``ci matrix``).
+    """
+
+    def __init__(self, read_fd, write_fd, size=None, owner=False,
+                 fifo=None):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.size = size
+        self.owner = owner
+        self.fifo = fifo
+        self._implicit_token_available = True
+        self._lock = threading.Lock()
+        self._nonblocking_fd = None
+
+    @classmethod
+    def create(cls, size):
+        """Create a pipe holding ``size - 1`` tokens, the remaining one
+        being implicitly owned by the current process.
+
+        Return None if jobservers are not supported on this platform.
+        """
+        if os.name != "posix":  # pragma: no cover
+            return None
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            _set_inheritable(fd)
+        os.write(write_fd, TOKEN * (size - 1))
+        return cls(read_fd, write_fd, size, owner=True)
+
+    @classmethod
+    def from_environment(cls, environment=None):
+        """Return the jobserver advertised in the ``MAKEFLAGS`` variable
+        of ``environment`` (defaults to ``os.environ``).
+
+        Return None if there is none or if its file descriptors were not
+        inherited.
+        """
+        if environment is None:
+            environment = os.environ
+        makeflags = environment.get("MAKEFLAGS", "")
+        match = _AUTH_REGEX.search(makeflags)
+        if match is None:
+            return None
+        size = None
+        for flag in makeflags.split():
+            jobs = _JOBS_REGEX.match(flag)
+            if jobs and jobs.group(1):
+                size = int(jobs.group(1))
+        if match.group(3):
+            try:
+                fd = os.open(match.group(3), os.O_RDWR)
+            except OSError:
+                return None
+            return cls(fd, fd, size, owner=True, fifo=match.group(3))
+        read_fd, write_fd = int(match.group(1)), int(match.group(2))
+        if not _fd_is_valid(read_fd) or not _fd_is_valid(write_fd):
+            return None
+        return cls(read_fd, write_fd, size)
+
+    def makeflags(self, makeflags=""):
+        """Return ``makeflags`` updated to advertise this jobserver.
+
+        Existing ``-j`` and jobserver options are replaced, other flags are
+        kept.
+        """
+        flags = [flag for flag in makeflags.split()
+                 if not _JOBS_REGEX.match(flag) and
+                 not flag.startswith("--jobserver-")]
+        jobs = "-j%d" % self.size if self.size else "-j"
+        if self.fifo is not None:
+            return " ".join([jobs, "--jobserver-auth=fifo:" + self.fifo] +
+                            flags)
+        auth = "%d,%d" % (self.read_fd, self.write_fd)
+        return " ".join(
+            [jobs, "--jobserver-fds=" + auth, "--jobserver-auth=" + auth] +
+            flags)
+
+    def environment(self, environment):
+        """Return a copy of ``environment`` where ``MAKEFLAGS`` advertises
+        this jobserver.
+        """
+        environment = dict(environment)
+        environment["MAKEFLAGS"] = self.makeflags(
+            environment.get("MAKEFLAGS", ""))
+        return environment
+
+    def popen_kwargs(self):
+        """Return the arguments to pass to :class:`subprocess.Popen` so that
+        children inherit the file descriptors of the jobserver.
+        """
+        if self.fifo is not None:
+            return {}
+        if sys.version_info[0] >= 3:
+            return {"pass_fds": (self.read_fd, self.write_fd)}
+        return {"close_fds": False}  # pragma: no cover
+
+    def acquire(self):
+        """Block until a token is available and return it.
+
+        The token implicitly owned by the current process is returned first.
+        """
+        with self._lock:
+            if self._nonblocking_fd is None:
+                fd = _open_nonblocking(self.read_fd, self.fifo)
+                self._nonblocking_fd = -1 if fd is None else fd
+        read_fd = self._nonblocking_fd
+        if read_fd < 0:  # pragma: no cover
+            # Without a non-blocking descriptor, reading blocks until a token
+            # is released if another process read the token first
+            read_fd = self.read_fd
+        while True:
+            with self._lock:
+                if self._implicit_token_available:
+                    self._implicit_token_available = False
+                    return None
+            # Wait for a token with a timeout to notice the release of the
+            # implicit token by another thread.
+            if not select.select([read_fd], [], [], _POLL_INTERVAL)[0]:
+                continue
+            try:
+                token = os.read(read_fd, 1)
+            except OSError as exc:
+                # The token was read by another process
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                     errno.EINTR):
+                    raise
+                continue
+            if token:
+                return token
+
+    def release(self, token):
+        """Make ``token`` returned by :meth:`acquire` available again.
+        """
+        if token is None:
+            with self._lock:
+                self._implicit_token_available = True
+            return
+        os.write(self.write_fd, token)
+
+    def close(self):
+        """Close the file descriptors opened by this object.
+        """
+        if self._nonblocking_fd is not None and self._nonblocking_fd >= 0:
+            os.close(self._nonblocking_fd)
+        self._nonblocking_fd = None
+        if not self.owner:
+            return
+        for fd in set([self.read_fd, self.write_fd]):
+            os.close(fd)
+        self.owner = False
+
+
+def jobserver(size=None):
+    """Return the jobserver inherited from the parent process if any,
+    otherwise create one with ``size`` tokens.
+
+    Return None if ``size`` is 0, if there is no inherited jobserver and
+    ``size`` is None, or if jobservers are not supported on this platform.
+    Commands are not executed in parallel unless requested: ``make`` reads
+    the number of jobs from the advertised jobserver.
+    """
+    if size == 0:
+        return None
+    server = JobServer.from_environment()
+    if server is not None or size is None:
+        return server
+    return JobServer.create(size)
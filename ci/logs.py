@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to write the output of the commands of
+a step into log files, optionally compressed while streaming and rotated
+once they reach a maximum size.
+
+Next to the log files, an index file ``<step>.index.json`` records where
+the output of each command is stored::
+
+    {
+      "step": "build",
+      "compression": "gzip",
+      "files": ["build.log.gz", "build.1.log.gz"],
+      "commands": [
+        {"index": 0, "command": "make",
+         "sections": [{"file": "build.log.gz", "offset": 0, "size": 2817}]}
+      ]
+    }
+
+Each section is a standalone gzip member (or xz stream) so that the output
+of a command can be extracted using :func:`read_command_output` without
+decompressing the rest of the file.
+"""
+
+import json
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
+from . import utils
+
+INDEX_SUFFIX = ".index.json"
+"""Suffix of the index file written next to the log files of a step."""
+
+
+def _gzip_compressor():
+    # A window size of 16 + MAX_WBITS produces a gzip member
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+COMPRESSIONS = {"none": ("", None, None),
+                "gzip": (".gz", _gzip_compressor, _gzip_decompressor)}
+"""Dictionary associating supported compressions with the extension of the
+log files and factories of compressor and decompressor objects."""
+
+if lzma is not None:
+    COMPRESSIONS["xz"] = (
+        ".xz", lambda: lzma.LZMACompressor(lzma.FORMAT_XZ),
+        lambda: lzma.LZMADecompressor(lzma.FORMAT_XZ))
+
+
+class StepLog(object):
+    """Sink writing the output of the commands of ``step`` into log files
+    created in ``directory``.
+
+    ``compression`` is one of :const:`COMPRESSIONS`. If ``max_size`` (in
+    bytes) is set, output is written into a new file once the current one
+    reaches that size, and only the last ``max_files`` files are kept if it
+    is set. If ``per_command`` is True, the output of each command is
+    written into its own files named ``<step>.<index>.log``.
+    """
+
+    def __init__(self, directory, step, compression="none", max_size=None,
+                 max_files=None, per_command=False):
+        self.directory = directory
+        self.step = step
+        self.compression = compression or "none"
+        if self.compression not in COMPRESSIONS:
+            raise ValueError("unsupported log compression: %s" % compression)
+        self.extension, self._compressor_factory, _ = \
+            COMPRESSIONS[self.compression]
+        self.max_size = max_size
+        self.max_files = max_files
+        self.per_command = per_command
+        self.index = {"step": step, "compression": self.compression,
+                      "files": [], "commands": []}
+        self._name = step
+        self._rotations = 0
+        self._rotated = []
+        self._stream = None
+        self._compressor = None
+        self._section = None
+
+    @property
+    def index_file(self):
+        return os.path.join(self.directory, self.step + INDEX_SUFFIX)
+
+    def _file_name(self):
+        suffix = ".%d" % self._rotations if self._rotations else ""
+        return "%s%s.log%s" % (self._name, suffix, self.extension)
+
+    def _open(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        name = self._file_name()
+        self._stream = open(os.path.join(self.directory, name), "wb")
+        self.index["files"].append(name)
+        self._rotated.append(name)
+        if self.max_files:
+            for removed in self._rotated[:-self.max_files]:
+                os.remove(os.path.join(self.directory, removed))
+                self.index["files"].remove(removed)
+            self._rotated = self._rotated[-self.max_files:]
+
+    def _end_section(self):
+        """Terminate the compressed member of the current section and record
+        its size.
+        """
+        if self._section is None:
+            return
+        if self._compressor is not None:
+            self._stream.write(self._compressor.flush())
+            self._compressor = None
+        self._stream.flush()
+        self._section["size"] = self._stream.tell() - self._section["offset"]
+        self._section = None
+
+    def _start_section(self):
+        if self._stream is None:
+            self._open()
+        self._stream.flush()
+        self._section = {"file": self.index["files"][-1],
+                         "offset": self._stream.tell(), "size": 0}
+        self.index["commands"][-1]["sections"].append(self._section)
+        if self._compressor_factory is not None:
+            self._compressor = self._compressor_factory()
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def start_command(self, index, command):
+        """Record that the output written from now on is the one of command
+        ``index`` of the step.
+        """
+        self._end_section()
+        if self.per_command:
+            self._close_stream()
+            self._name = "%s.%d" % (self.step, index)
+            self._rotations = 0
+            self._rotated = []
+        self.index["commands"].append(
+            {"index": index, "command": command, "sections": []})
+        self._start_section()
+        self.save_index()
+
+    def stream(self):
+        """Return the file the output of the current command can be written
+        into directly (allowing it to be spliced) if neither compression nor
+        rotation is used, otherwise return this object.
+        """
+        if self._compressor_factory is None and not self.max_size:
+            return self._stream
+        return self
+
+    def write(self, data):
+        if self._section is None:
+            raise ValueError("output written before starting a command")
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._stream.write(data)
+        if self.max_size and self._stream.tell() >= self.max_size:
+            self._rotate()
+
+    def flush(self):
+        if self._stream is not None:
+            self._stream.flush()
+
+    def _rotate(self):
+        self._end_section()
+        self._close_stream()
+        self._rotations += 1
+        self._start_section()
+
+    def save_index(self):
+        if self._section is not None:
+            self._stream.flush()
+            # Sizes of the section being written are updated when it ends
+            self._section["size"] = \
+                self._stream.tell() - self._section["offset"]
+        utils.atomic_write(
+            self.index_file, json.dumps(self.index, indent=2))
+
+    def close(self):
+        self._end_section()
+        self._close_stream()
+        if self.index["commands"]:
+            self.save_index()
+
+
+def read_command_output(directory, step, index):
+    """Return the output of command ``index`` of ``step`` stored in the
+    log files of ``directory``.
+
+    Only the sections of the files holding that output are read and
+    decompressed. Raise :class:`KeyError` if the command was not executed
+    and :class:`IOError` if its output was removed by the rotation.
+    """
+    with open(os.path.join(directory, step + INDEX_SUFFIX)) as input_stream:
+        log_index = json.load(input_stream)
+    decompressor_factory = COMPRESSIONS[log_index["compression"]][2]
+    commands = [command for command in log_index["commands"]
+                if command["index"] == index]
+    if not commands:
+        raise KeyError("command %d of step %s was not executed" % (
+            index, step))
+    output = []
+    for section in commands[-1]["sections"]:
+        with open(os.path.join(directory, section["file"]), "rb") \
+                as input_stream:
+            input_stream.seek(section["offset"])
+            data = input_stream.read(section["size"])
+        if decompressor_factory is not None:
+            data = decompressor_factory().decompress(data)
+        output.append(data)
+    return b"".join(output)
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to expand the ``matrix`` section of
+``scikit-ci.yml`` and to execute steps for each of its entries.
+
+Each entry is executed in its own work directory (and consequently with its
+own ``env.json``) by a separate ``ci`` process. Commands are executed in the
+work directory, paths of source files must be given relative to the
+``SCIKIT_CI_SOURCE_DIR`` environment variable.
+
+Each ``ci`` process is started in a new session so that it can be stopped
+along with all the processes it started.
+"""
+
+import itertools
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from .constants import SCIKIT_CI_DIR
+from .exceptions import SKCIMatrixError
+from .history import History, longest_first
+from .output import OutputMultiplexer, TailBuffer, binary_stream
+from .resources import AdmissionController
+from .utils import wait_process
+
+MATRIX_DIR = os.path.join(SCIKIT_CI_DIR, "matrix")
+"""Directory where the work directories of matrix entries are created."""
+
+OUTPUT_FILE = "output.log"
+"""Name of the file where the output of an entry is written in its work
+directory."""
+
+TERMINATE_TIMEOUT = 5.
+"""Number of seconds processes of a cancelled entry are given to terminate
+before being killed."""
+
+
+def expand_matrix(matrix):
+    """Return the list of environments described by ``matrix``.
+
+    ``matrix`` is a dictionary with the following keys:
+
+    * ``axes``: dictionary associating environment variable names with
+      the list of their values. The cartesian product of the axes is
+      considered.
+    * ``exclude``: list of partial environments. Combinations matching all
+      the values of any of them are removed.
+    * ``include``: list of environments appended to the combinations.
+    """
+    axes = matrix.get("axes", {})
+    names = list(axes.keys())
+    entries = []
+    for values in itertools.product(*[axes[name] for name in names]):
+        entries.append(OrderedDict(
+            [(name, str(value)) for name, value in zip(names, values)]))
+
+    def _matches(entry, partial):
+        return all([entry.get(name) == str(value)
+                    for name, value in partial.items()])
+
+    for excluded in matrix.get("exclude", []):
+        entries = [entry for entry in entries
+                   if not _matches(entry, excluded)]
+
+    for included in matrix.get("include", []):
+        included = OrderedDict(
+            [(name, str(value)) for name, value in included.items()])
+        if included not in entries:
+            entries.append(included)
+
+    return entries
+
+
+def entry_name(entry):
+    """Return a name identifying ``entry`` and usable as a directory name.
+    """
+    return "_".join([
+        re.sub(r"[^\w.-]", "-", "%s-%s" % (name, value))
+        for name, value in entry.items()]) or "default"
+
+
+class MatrixEntry(object):
+    """Keep track of the execution of a matrix entry.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.name = entry_name(environment)
+        self.work_dir = os.path.abspath(os.path.join(MATRIX_DIR, self.name))
+        self.status = "pending"
+        """One of ``pending``, ``running``, ``success``, ``failure`` or
+        ``cancelled``."""
+        self.return_code = None
+        self.duration = None
+        self.estimate = None
+        """Duration in seconds predicted from previous executions."""
+        self.resources = {"memory": 0, "cpus": 0.}
+        """Resources reserved while the entry is running."""
+        self.peak_rss = None
+        """Largest resident set size in bytes of the ``ci`` process or any of
+        the commands it executed."""
+        self.tail = TailBuffer()
+        """Last lines of the output of the entry."""
+        self.process = None
+        self.source = None
+        self.error = None
+        """Error which prevented the entry from being started."""
+
+    @property
+    def output_file(self):
+        return os.path.join(self.work_dir, OUTPUT_FILE)
+
+
+class MatrixRunner(object):
+    """Execute ``step`` for each entry using up to ``max_workers`` concurrent
+    ``ci`` processes.
+
+    If ``fail_fast`` is True, running entries are terminated and pending ones
+    are cancelled as soon as one entry fails. All the processes started by
+    a running entry are sent ``SIGTERM``, then ``SIGKILL`` if they are still
+    running after :const:`TERMINATE_TIMEOUT` seconds.
+
+    Entries are started longest first based on the durations recorded in
+    ``history`` (a :class:`ci.history.History`) by previous executions.
+
+    If ``jobserver`` (a :class:`ci.jobserver.JobServer`) is set, a token is
+    acquired before starting each entry and it is advertised to the ``ci``
+    processes so that the jobs they start are counted against the same pool.
+
+    If ``admission`` (a :class:`ci.resources.AdmissionController`) is set,
+    entries are started only if the ``resources`` they need fit in its
+    budgets. The memory needed by an entry is the largest peak RSS recorded
+    during its previous executions, or the declared one.
+
+    The output of all entries is read by a single
+    :class:`ci.output.OutputMultiplexer` and written into the ``output.log``
+    file of each entry. If ``stream_output`` is True, it is also written to
+    the standard output, each line being prefixed with the name of the entry.
+    """
+
+    def __init__(self, step, config_file, max_workers=1, fail_fast=False,
+                 ci_args=None, log=None, history=None, jobserver=None,
+                 resources=None, admission=None, stream_output=False):
+        self.step = step
+        self.config_file = os.path.abspath(config_file)
+        self.max_workers = max(1, max_workers)
+        self.fail_fast = fail_fast
+        self.ci_args = ci_args or []
+        self.log = log or (lambda *args: None)
+        self.history = history if history is not None else History()
+        self.predicted_duration = None
+        self.jobserver = jobserver
+        self.resources = resources or {"memory": 0, "cpus": 0.}
+        self.admission = admission or AdmissionController()
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._admitted = threading.Condition(self._lock)
+        self._pending = []
+        self._killer = None
+        self.stream_output = stream_output
+        self._multiplexer = None
+
+    def command(self):
+        return [sys.executable, "-m", "ci", self.step,
+                "--config", self.config_file] + self.ci_args
+
+    def _execute(self, entry):
+        if self.jobserver is None:
+            return self._execute_entry(entry)
+        token = self.jobserver.acquire()
+        try:
+            self._execute_entry(entry)
+        finally:
+            self.jobserver.release(token)
+
+    def _execute_entry(self, entry):
+        with self._lock:
+            if self._cancelled.is_set():
+                entry.status = "cancelled"
+                return
+            entry.status = "running"
+            start = time.time()
+            try:
+                output = self._start(entry)
+            except Exception as exc:  # noqa: B902
+                entry.error = exc
+                entry.status = "failure"
+                if self.fail_fast:
+                    self._cancel()
+        if entry.error is not None:
+            self.log("[scikit-ci] Matrix entry %s: failure (%s)" % (
+                entry.name, entry.error))
+            return
+        self.log("[scikit-ci] Matrix entry %s: started" % entry.name)
+        try:
+            entry.return_code, entry.peak_rss = wait_process(
+                entry.process, self._lock)
+            entry.source.closed.wait()
+        finally:
+            output.close()
+        entry.duration = time.time() - start
+        with self._lock:
+            if entry.return_code == 0:
+                entry.status = "success"
+            elif self._cancelled.is_set():
+                entry.status = "cancelled"
+            else:
+                entry.status = "failure"
+                if self.fail_fast:
+                    self._cancel()
+        self.log("[scikit-ci] Matrix entry %s: %s (%.2fs)" % (
+            entry.name, entry.status, entry.duration))
+        if entry.status == "failure":
+            self.log("[scikit-ci]   See %s" % entry.output_file)
+
+    def _start(self, entry):
+        """Start the process of ``entry`` and return the file its output is
+        written into. Must be called while holding ``_lock``.
+        """
+        if not os.path.exists(entry.work_dir):
+            os.makedirs(entry.work_dir)
+        env = dict(os.environ)
+        env.update(entry.environment)
+        env["SCIKIT_CI_SOURCE_DIR"] = os.path.dirname(self.config_file)
+        kwargs = {}
+        if self.jobserver is not None:
+            env = self.jobserver.environment(env)
+            kwargs = self.jobserver.popen_kwargs()
+        if hasattr(os, "killpg"):
+            if sys.version_info[0] >= 3:
+                kwargs["start_new_session"] = True
+            else:  # pragma: no cover
+                kwargs["preexec_fn"] = os.setsid
+        output = open(entry.output_file, "wb")
+        try:
+            entry.process = subprocess.Popen(
+                self.command(), cwd=entry.work_dir, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+        except Exception:  # noqa: B902
+            output.close()
+            raise
+        sinks = [output, entry.tail]
+        if self.stream_output:
+            sinks.append((binary_stream(sys.stdout),
+                          ("[%s] " % entry.name).encode("utf-8")))
+        entry.source = self._multiplexer.register(entry.process.stdout, sinks)
+        return output
+
+    def _cancel(self):
+        """Cancel pending entries and terminate running ones. Must be called
+        while holding ``_lock``.
+        """
+        if self._cancelled.is_set():
+            return
+        self._cancelled.set()
+        self._admitted.notify_all()
+        for entry in self.entries:
+            self._signal(entry)
+        self._killer = threading.Timer(TERMINATE_TIMEOUT, self._kill)
+        self._killer.daemon = True
+        self._killer.start()
+
+    def _kill(self):
+        with self._lock:
+            for entry in self.entries:
+                self._signal(entry, kill=True)
+
+    @staticmethod
+    def _signal(entry, kill=False):
+        """Send ``SIGTERM`` (or ``SIGKILL`` if ``kill`` is True) to the
+        processes of ``entry`` if it is running.
+        """
+        process = entry.process
+        if entry.status != "running" or process is None:
+            return
+        # Once the ci process is reaped, the processes it started may still
+        # be writing its output
+        if process.returncode is not None and entry.source.closed.is_set():
+            return
+        if not hasattr(os, "killpg"):  # pragma: no cover
+            if process.returncode is not None:
+                return
+            if kill:
+                process.kill()
+            else:
+                process.terminate()
+            return
+        try:
+            os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+        except OSError:
+            # All the processes already completed
+            pass
+
+    def _admit(self):
+        """Wait until a pending entry fits in the admission budgets, reserve
+        its resources and return it. Return None if no entry is pending.
+        """
+        with self._admitted:
+            waiting = set()
+            while self._pending:
+                for entry in self._pending:
+                    if self._cancelled.is_set() or \
+                            self.admission.fits(entry.resources):
+                        self._pending.remove(entry)
+                        self.admission.reserve(entry.resources)
+                        return entry
+                entry = self._pending[0]
+                if entry not in waiting:
+                    waiting.add(entry)
+                    self.log("[scikit-ci] Matrix entry %s: waiting for "
+                             "resources (memory: %dM, cpus: %g)" % (
+                                 entry.name,
+                                 entry.resources["memory"] // 1024 ** 2,
+                                 entry.resources["cpus"]))
+                self._admitted.wait()
+        return None
+
+    def _worker(self):
+        while True:
+            entry = self._admit()
+            if entry is None:
+                return
+            try:
+                self._execute(entry)
+            finally:
+                with self._admitted:
+                    self.admission.release(entry.resources)
+                    self._admitted.notify_all()
+
+    def history_key(self, entry):
+        return "matrix/%s/%s" % (self.step, entry.name)
+
+    def memory_key(self, entry):
+        return "memory/" + self.history_key(entry)
+
+    def run(self, environments):
+        """Execute the step for all ``environments`` and return the list of
+        :class:`MatrixEntry`.
+
+        Raise :class:`ci.exceptions.SKCIMatrixError` if any entry failed.
+        """
+        self.entries = [MatrixEntry(environment)
+                        for environment in environments]
+        estimates = self.history.estimates(
+            [self.history_key(entry) for entry in self.entries])
+        for entry in self.entries:
+            entry.estimate = estimates[self.history_key(entry)]
+            entry.resources = dict(self.resources)
+            peak_rss = self.history.maximum(self.memory_key(entry))
+            if peak_rss is not None:
+                entry.resources["memory"] = peak_rss
+        ordered, self.predicted_duration = longest_first(
+            self.entries, dict([(entry, entry.estimate)
+                                for entry in self.entries]),
+            self.max_workers)
+        self._pending = list(ordered)
+
+        start = time.time()
+        self._multiplexer = OutputMultiplexer()
+        self._multiplexer.start()
+        workers = [threading.Thread(target=self._worker)
+                   for _ in range(min(self.max_workers, len(self.entries)))]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        except BaseException:
+            # Entries run in their own session and are not interrupted along
+            # with this process
+            with self._lock:
+                self._cancel()
+            for worker in workers:
+                worker.join()
+            raise
+        finally:
+            if self._killer is not None:
+                self._killer.cancel()
+            self._multiplexer.stop()
+        self.duration = time.time() - start
+
+        for entry in self.entries:
+            if entry.status == "success":
+                self.history.record(self.history_key(entry), entry.duration)
+                if entry.peak_rss is not None:
+                    self.history.record(
+                        self.memory_key(entry), entry.peak_rss)
+        self.history.save()
+
+        self.report()
+
+        failed = [entry for entry in self.entries
+                  if entry.status == "failure"]
+        if failed:
+            raise SKCIMatrixError(self.step, failed)
+        return self.entries
+
+    def report(self):
+        """Log the status, the estimated and the actual duration of each
+        entry as well as the predicted and actual makespan.
+        """
+        width = max([len(entry.name) for entry in self.entries] + [0])
+        self.log("[scikit-ci] Matrix report:")
+        for entry in self.entries:
+            duration = "" if entry.duration is None else \
+                "%.2fs" % entry.duration
+            self.log("[scikit-ci]   %s  %-9s  %-10s (estimated %.2fs)" % (
+                entry.name.ljust(width), entry.status, duration,
+                entry.estimate))
+        cumulated = sum([entry.duration or 0. for entry in self.entries])
+        self.log("[scikit-ci] %d entries executed in %.2fs "
+                 "(cumulated %.2fs) using %d workers" % (
+                     len(self.entries), self.duration, cumulated,
+                     min(self.max_workers, len(self.entries))))
+        self.log("[scikit-ci] Makespan: predicted %.2fs, actual %.2fs" % (
+            self.predicted_duration, self.duration))
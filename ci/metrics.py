@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to export metrics about the execution
+of steps into a file using the Prometheus text exposition format, e.g. to be
+collected by the textfile collector of node_exporter.
+
+The file is replaced atomically so that collectors never read a partial
+file. Metrics of steps executed by previous processes and found in the file
+are kept: the file is read and written while holding a lock of
+``<path>.lock`` so that concurrent processes do not lose each other's
+metrics.
+"""
+
+import os
+import re
+import time
+
+from . import utils
+
+METRICS = [
+    ("scikit_ci_step_duration_seconds",
+     "Duration of the last execution of the step."),
+    ("scikit_ci_step_last_run_timestamp_seconds",
+     "Time the last execution of the step completed."),
+    ("scikit_ci_step_commands",
+     "Number of commands executed during the last execution of the step."),
+    ("scikit_ci_step_failures",
+     "Number of commands that failed during the last execution of the "
+     "step."),
+    ("scikit_ci_step_cache_hits",
+     "Number of cached directories restored during the last execution of "
+     "the step."),
+    ("scikit_ci_step_cache_misses",
+     "Number of cached directories not found during the last execution of "
+     "the step."),
+    ("scikit_ci_config_parse_seconds",
+     "Time spent parsing the configuration file by the process executing "
+     "the step.")
+]
+"""List of ``(name, help)`` of the exported metrics. All of them are
+gauges labeled with ``service``, ``os`` and ``step``."""
+
+_SAMPLE = re.compile(r"^(scikit_ci_\w+)(\{.*\})? (\S+)$")
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace(
+        "\n", "\\n")
+
+
+def _labels(service, operating_system, step):
+    return "{service=\"%s\",os=\"%s\",step=\"%s\"}" % (
+        _escape(service or ""), _escape(operating_system or ""),
+        _escape(step))
+
+
+class MetricsTextfile(object):
+    """Write the metrics of executed steps into ``path``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        """Return a dictionary associating ``(name, labels)`` with the value
+        of the samples found in the file.
+        """
+        samples = {}
+        if not os.path.exists(self.path):
+            return samples
+        with open(self.path) as input_stream:
+            for line in input_stream:
+                match = _SAMPLE.match(line.strip())
+                if match:
+                    name, labels, value = match.groups()
+                    samples[(name, labels or "")] = value
+        return samples
+
+    def record(self, step, service=None, operating_system=None,
+               duration=0., commands=0, failures=0, cache_hits=0,
+               cache_misses=0, config_parse_time=0.):
+        """Write the metrics of the last execution of ``step`` into the
+        file, replacing the previous ones.
+        """
+        with utils.FileLock(self.path + ".lock"):
+            self._record(step, service, operating_system, [
+                duration, time.time(), commands, failures, cache_hits,
+                cache_misses, config_parse_time])
+
+    def _record(self, step, service, operating_system, values):
+        samples = self._load()
+        labels = _labels(service, operating_system, step)
+        for (name, _), value in zip(METRICS, values):
+            samples[(name, labels)] = repr(float(value)) \
+                if isinstance(value, float) else str(value)
+        lines = []
+        for name, description in METRICS:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s gauge" % name)
+            lines.extend([
+                "%s%s %s" % (name, sample_labels, value)
+                for (sample_name, sample_labels), value in sorted(
+                    samples.items()) if sample_name == name])
+        # Collectors usually run as another user
+        utils.atomic_write(self.path, "\n".join(lines) + "\n", mode=0o644)
@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to capture the output of child
+processes.
+
+A single event loop reads the pipes of all the processes, assembles complete
+lines, optionally prefixes them (e.g with a timestamp) and writes them to the
+sinks associated with each pipe in batches.
+
+On POSIX systems, pipes are read without blocking using :mod:`selectors`.
+Elsewhere, one thread per pipe forwards what it reads to the event loop.
+
+On Linux, output written unmodified into files (e.g the terminal or a log
+file) is copied by the kernel using ``tee(2)`` and ``splice(2)`` without
+going through Python.
+"""
+
+import ctypes
+import errno
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    selectors = None
+
+BUFFER_SIZE = 64 * 1024
+"""Number of bytes read at once from a pipe, and number of bytes buffered
+for a sink before writing them."""
+
+FLUSH_INTERVAL = 0.1
+"""Maximum number of seconds output is buffered before being written."""
+
+DRAIN_TIMEOUT = 1.
+"""Maximum number of seconds the output of a command is read once it exited,
+processes it started in the background keeping its pipes open."""
+
+TAIL_LINES = 20
+"""Default number of last output lines kept to report failures."""
+
+TAIL_SIZE = 16 * 1024
+"""Default maximum number of bytes of the last output lines kept to report
+failures."""
+
+
+def binary_stream(stream):
+    """Return the binary stream underlying the text stream ``stream``
+    (e.g ``sys.stdout``).
+    """
+    return getattr(stream, "buffer", stream)
+
+
+class TailBuffer(object):
+    """Sink keeping the last ``max_lines`` lines written into it, up to
+    ``max_bytes`` bytes.
+    """
+
+    def __init__(self, max_lines=TAIL_LINES, max_bytes=TAIL_SIZE):
+        self.max_bytes = max_bytes
+        self._lines = deque(maxlen=max_lines)
+        self._size = 0
+        self.truncated = False
+        """True if lines were discarded."""
+
+    def write(self, data):
+        for line in data.splitlines():
+            if len(self._lines) == self._lines.maxlen and self._lines:
+                self._size -= len(self._lines[0])
+                self.truncated = True
+            self._lines.append(line[-self.max_bytes:])
+            self._size += len(self._lines[-1])
+        while self._size > self.max_bytes:
+            self._size -= len(self._lines.popleft())
+            self.truncated = True
+
+    def lines(self):
+        """Return the kept lines decoded as text.
+        """
+        return [line.decode("utf-8", "replace") for line in self._lines]
+
+    def text(self):
+        return "\n".join(self.lines())
+
+
+def _load_libc():
+    """Return the C library if it provides ``tee`` and ``splice``.
+    """
+    if not sys.platform.startswith("linux"):  # pragma: no cover
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.tee.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+        libc.tee.restype = ctypes.c_ssize_t
+        libc.splice.argtypes = [
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_uint]
+        libc.splice.restype = ctypes.c_ssize_t
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+    return libc
+
+
+_LIBC = _load_libc()
+
+_SPLICE_F_NONBLOCK = 0x02
+
+ZERO_COPY = _LIBC is not None
+"""True if output can be copied into files without going through Python."""
+
+
+def _check_errno(result):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def _tee(fd_in, fd_out, size):
+    return _check_errno(_LIBC.tee(fd_in, fd_out, size, _SPLICE_F_NONBLOCK))
+
+
+def _splice(fd_in, fd_out, size, flags=0):
+    return _check_errno(_LIBC.splice(fd_in, None, fd_out, None, size, flags))
+
+
+def _splice_all(fd_in, fd_out, size):
+    while size:
+        size -= _splice(fd_in, fd_out, size)
+
+
+class FileSink(object):
+    """Sink writing into the binary file ``stream``.
+
+    If possible, the output of processes is copied into the file by the
+    kernel (see :const:`ZERO_COPY`).
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.fd = stream.fileno()
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def supports_zero_copy(self):
+        """Return True if output can be spliced into the file: it has to be
+        a pipe or a regular file not opened in append mode.
+        """
+        if not ZERO_COPY:  # pragma: no cover
+            return False
+        mode = os.fstat(self.fd).st_mode
+        if stat.S_ISFIFO(mode):
+            return True
+        return stat.S_ISREG(mode) and \
+            not fcntl.fcntl(self.fd, fcntl.F_GETFL) & os.O_APPEND
+
+
+def file_sink(stream):
+    """Return a :class:`FileSink` writing into ``stream`` if it is backed
+    by a file descriptor, otherwise return ``stream``.
+    """
+    try:
+        stream.fileno()
+    except (AttributeError, IOError, ValueError):
+        return stream
+    return FileSink(stream)
+
+
+class Source(object):
+    """A pipe registered in an :class:`OutputMultiplexer`.
+    """
+
+    def __init__(self, stream, sinks, prefix):
+        self.stream = stream
+        self.fd = stream.fileno()
+        self.sinks = [sink if isinstance(sink, tuple) else (sink, prefix)
+                      for sink in sinks]
+        self.fd_sinks = []
+        """Sinks into which output is spliced."""
+        self.partial = b""
+        self.closed = threading.Event()
+        """Set once the end of the stream is reached and all its lines were
+        written."""
+
+
+class OutputMultiplexer(object):
+    """Read the output of several processes in a single event loop.
+
+    Lines read from each registered stream are written into the sinks
+    associated with the stream. Sinks are objects with a ``write(bytes)``
+    method (e.g binary files) or tuples ``(sink, prefix)`` to use a prefix
+    specific to the sink. If ``timestamps`` is True, the wall-clock time is
+    added at the beginning of each line, after the prefix.
+
+    Unless ``zero_copy`` is False, output is spliced into :class:`FileSink`
+    sinks without prefix (nor timestamps) when possible.
+
+    Either call :meth:`run` to process registered streams until they are all
+    closed, or :meth:`start` and :meth:`stop` to process streams registered
+    at any time from a background thread, possibly abandoning the streams
+    not closed within a timeout.
+    """
+
+    def __init__(self, timestamps=False, buffer_size=BUFFER_SIZE,
+                 flush_interval=FLUSH_INTERVAL, zero_copy=True):
+        self.timestamps = timestamps
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._registered = []
+        self._sources = {}
+        self._buffers = {}
+        self._buffered_size = 0
+        self._last_flush = time.time()
+        self._stopping = False
+        self._deadline = None
+        self._thread = None
+        self._scratch_fds = None
+        self.zero_copy = zero_copy and ZERO_COPY and selectors is not None
+        if selectors is not None and fcntl is not None:
+            self._selector = selectors.DefaultSelector()
+            self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()
+            self._set_non_blocking(self._wakeup_read_fd)
+            self._selector.register(
+                self._wakeup_read_fd, selectors.EVENT_READ, None)
+        else:  # pragma: no cover
+            self._selector = None
+            self._events = queue.Queue()
+
+    @staticmethod
+    def _set_non_blocking(fd):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def register(self, stream, sinks, prefix=b""):
+        """Read ``stream`` until its end and write its lines into ``sinks``
+        prefixed with ``prefix`` unless a sink has its own prefix.
+
+        Return a :class:`Source` whose ``closed`` event is set once all the
+        lines were written.
+        """
+        source = Source(stream, sinks, prefix)
+        with self._lock:
+            self._registered.append(source)
+        self._wakeup()
+        return source
+
+    def _wakeup(self):
+        if self._selector is not None:
+            os.write(self._wakeup_write_fd, b"\0")
+        else:  # pragma: no cover
+            self._events.put((None, None))
+
+    def _add_registered(self):
+        with self._lock:
+            registered, self._registered = self._registered, []
+        for source in registered:
+            self._sources[source.fd] = source
+            if self.zero_copy and not self.timestamps:
+                self._select_fd_sinks(source)
+            if self._selector is not None:
+                self._set_non_blocking(source.fd)
+                self._selector.register(
+                    source.fd, selectors.EVENT_READ, source)
+            else:  # pragma: no cover
+                thread = threading.Thread(
+                    target=self._read_in_thread, args=(source,))
+                thread.daemon = True
+                thread.start()
+
+    def _select_fd_sinks(self, source):
+        for sink, prefix in list(source.sinks):
+            if isinstance(sink, FileSink) and not prefix and \
+                    sink.supports_zero_copy():
+                source.sinks.remove((sink, prefix))
+                source.fd_sinks.append(sink)
+                # Write data buffered by Python before splicing
+                sink.flush()
+        if source.fd_sinks and self._scratch_fds is None:
+            self._scratch_fds = os.pipe()
+
+    def _read_in_thread(self, source):  # pragma: no cover
+        while True:
+            chunk = os.read(source.fd, self.buffer_size)
+            self._events.put((source, chunk))
+            if not chunk:
+                return
+
+    def _read(self, source):
+        """Read from ``source`` until no more data is available and return
+        the list of chunks read, the last one being empty if the end of the
+        stream was reached."""
+        if source.fd_sinks:
+            return self._splice(source)
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(source.fd, self.buffer_size)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return chunks
+                if exc.errno == errno.EINTR:  # pragma: no cover
+                    continue
+                raise
+            chunks.append(chunk)
+            if not chunk:
+                return chunks
+
+    def _splice(self, source):
+        """Splice the data available in ``source`` into its file sinks and
+        return the list of chunks to write into the other sinks, the last
+        one being empty if the end of the stream was reached.
+
+        The data is duplicated into a scratch pipe using ``tee`` for each
+        file sink and finally consumed by reading it if other sinks need it,
+        or by splicing it into the last file sink.
+        """
+        scratch_read_fd, scratch_write_fd = self._scratch_fds
+        copies = source.fd_sinks if source.sinks else source.fd_sinks[:-1]
+        chunks = []
+        while True:
+            try:
+                if copies:
+                    size = _tee(source.fd, scratch_write_fd, self.buffer_size)
+                else:
+                    size = _splice(source.fd, source.fd_sinks[-1].fd,
+                                   self.buffer_size, _SPLICE_F_NONBLOCK)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return chunks
+                if exc.errno == errno.EINTR:  # pragma: no cover
+                    continue
+                raise
+            if not size:
+                chunks.append(b"")
+                return chunks
+            if not copies:
+                continue
+            _splice_all(scratch_read_fd, copies[0].fd, size)
+            for sink in copies[1:]:
+                # The data is still available in the source pipe
+                _tee(source.fd, scratch_write_fd, size)
+                _splice_all(scratch_read_fd, sink.fd, size)
+            if source.sinks:
+                chunks.append(os.read(source.fd, size))
+            else:
+                _splice_all(source.fd, source.fd_sinks[-1].fd, size)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read_fd, self.buffer_size):
+                pass
+        except OSError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _wait(self, timeout):
+        """Return the list of ``(source, chunk)`` read within ``timeout``
+        seconds."""
+        if self._selector is None:  # pragma: no cover
+            try:
+                events = [self._events.get(timeout=timeout)]
+                while True:
+                    events.append(self._events.get_nowait())
+            except queue.Empty:
+                pass
+            return [(source, chunk) for source, chunk in events
+                    if source is not None]
+        events = []
+        for key, _ in self._selector.select(timeout):
+            if key.data is None:
+                self._drain_wakeup()
+                continue
+            events.extend([(key.data, chunk)
+                           for chunk in self._read(key.data)])
+        return events
+
+    def _emit(self, source, data):
+        lines = (source.partial + data).split(b"\n")
+        source.partial = lines.pop()
+        lines = [line + b"\n" for line in lines]
+        # Do not wait forever for the end of a very long line, and write the
+        # last line even if it does not end with a newline.
+        if source.partial and (
+                not data or len(source.partial) >= self.buffer_size):
+            lines.append(source.partial)
+            source.partial = b""
+        if not lines:
+            return
+        timestamp = b""
+        if self.timestamps:
+            timestamp = time.strftime("[%H:%M:%S] ").encode("ascii")
+        texts = {}
+        for sink, prefix in source.sinks:
+            if prefix not in texts:
+                # Decorated lines may be interleaved with the ones of other
+                # sources, they always end with a newline. Others are copied
+                # as they are, like when output is spliced.
+                end = b"\n" if prefix or timestamp else b""
+                texts[prefix] = b"".join(
+                    [prefix + timestamp + line +
+                     (end if not line.endswith(b"\n") else b"")
+                     for line in lines])
+            self._buffers.setdefault(sink, []).append(texts[prefix])
+            self._buffered_size += len(texts[prefix])
+
+    def _close(self, source):
+        del self._sources[source.fd]
+        if self._selector is not None:
+            self._selector.unregister(source.fd)
+        source.stream.close()
+
+    def flush(self):
+        """Write buffered lines into their sinks.
+        """
+        for sink, texts in self._buffers.items():
+            sink.write(b"".join(texts))
+            if hasattr(sink, "flush"):
+                sink.flush()
+        self._buffers = {}
+        self._buffered_size = 0
+        self._last_flush = time.time()
+
+    def _process(self):
+        # Without buffered output, wait until something happens
+        timeout = self.flush_interval if self._buffers else None
+        if self._deadline is not None:
+            remaining = max(0, self._deadline - time.time())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        closed = []
+        for source, chunk in self._wait(timeout):
+            self._emit(source, chunk)
+            if not chunk:
+                closed.append(source)
+        for source in closed:
+            self._close(source)
+        if closed or self._buffered_size >= self.buffer_size or \
+                time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+        for source in closed:
+            source.closed.set()
+
+    def run(self):
+        """Process registered streams until all of them are closed.
+        """
+        while True:
+            self._add_registered()
+            if not self._sources:
+                break
+            self._process()
+        self.flush()
+
+    def _run_forever(self):
+        while True:
+            self._add_registered()
+            if self._stopping and (not self._sources or (
+                    self._deadline is not None and
+                    time.time() >= self._deadline)):
+                break
+            self._process()
+        # Abandon the streams still open, writing their last partial line
+        abandoned = list(self._sources.values())
+        for source in abandoned:
+            self._emit(source, b"")
+            self._close(source)
+        self.flush()
+        for source in abandoned:
+            source.closed.set()
+
+    def start(self):
+        """Process streams registered at any time from a background thread
+        until :meth:`stop` is called.
+        """
+        self._thread = threading.Thread(target=self._run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Wait for all registered streams to be closed and stop the thread
+        started by :meth:`start`.
+
+        If ``timeout`` is set, streams not closed within ``timeout`` seconds
+        are closed without reading them further.
+        """
+        if timeout is not None:
+            self._deadline = time.time() + timeout
+        self._stopping = True
+        self._wakeup()
+        self._thread.join()
+        self.close()
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+            os.close(self._wakeup_read_fd)
+            os.close(self._wakeup_write_fd)
+            self._selector = None
+        if self._scratch_fds is not None:
+            for fd in self._scratch_fds:
+                os.close(fd)
+            self._scratch_fds = None
+
+
+def check_call(args, stdout_sinks=None, stderr_sinks=None, prefix=b"",
+               timestamps=False, tail=None, log_file=None, popen=None,
+               **kwargs):
+    """Execute ``args`` like :func:`subprocess.check_call` and write its
+    standard output and error into ``stdout_sinks`` and ``stderr_sinks``
+    using an :class:`OutputMultiplexer`.
+
+    Sinks default to ``sys.stdout`` and ``sys.stderr``. If ``tail`` (a
+    :class:`TailBuffer`) is set, both outputs are also written into it and
+    its text is associated with the ``output`` attribute of the
+    :class:`subprocess.CalledProcessError` raised on failure. If
+    ``log_file`` (a binary file) is set, both outputs are also written into
+    it.
+
+    ``popen`` is the callable starting the process, it defaults to
+    :class:`subprocess.Popen`.
+
+    Output is read until the process exits, and then for at most
+    :const:`DRAIN_TIMEOUT` seconds: processes it started in the background
+    may keep its pipes open.
+    """
+    if stdout_sinks is None:
+        stdout_sinks = [file_sink(binary_stream(sys.stdout))]
+    if stderr_sinks is None:
+        stderr_sinks = [file_sink(binary_stream(sys.stderr))]
+    if log_file is not None:
+        stdout_sinks = stdout_sinks + [(file_sink(log_file), b"")]
+        stderr_sinks = stderr_sinks + [(file_sink(log_file), b"")]
+    if tail is not None:
+        stdout_sinks = stdout_sinks + [(tail, b"")]
+        stderr_sinks = stderr_sinks + [(tail, b"")]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    multiplexer = OutputMultiplexer(timestamps=timestamps)
+    multiplexer.start()
+    try:
+        process = (popen or subprocess.Popen)(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        multiplexer.register(process.stdout, stdout_sinks, prefix)
+        multiplexer.register(process.stderr, stderr_sinks, prefix)
+        return_code = process.wait()
+    finally:
+        multiplexer.stop(timeout=DRAIN_TIMEOUT)
+    if return_code:
+        raise subprocess.CalledProcessError(
+            return_code, args,
+            output=tail.text() if tail is not None else None)
+    return 0
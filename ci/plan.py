@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to write and read execution plans.
+
+A plan is a JSON file holding the definition of every step of a
+configuration file for a given service and operating system (see
+:meth:`ci.driver.Driver.select_step`): environments with their unexpanded
+``$<EnvironmentVarName>`` references, commands with their language, cached
+directories, resources and conditions. Executing steps from a plan does not
+require parsing the YAML configuration.
+
+A plan records the digest of the configuration it was compiled from and it
+is refused if the configuration changed since.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from collections import OrderedDict
+
+from . import utils
+from .changes import CONDITIONS
+from .constants import SCIKIT_CI_DIR, SERVICES
+from .exceptions import SKCIError
+from .resources import RESOURCES
+
+PLAN_FILE = os.path.join(SCIKIT_CI_DIR, "plan.json")
+"""Default path of the plan written by ``ci compile``."""
+
+PLAN_VERSION = 1
+"""Version of the format of plans."""
+
+_REFERENCE = re.compile(r"\$<([\w\d][\w\d_]*)>", re.IGNORECASE)
+
+
+def config_digest(config_file):
+    """Return the digest of the content of ``config_file``.
+    """
+    with open(config_file) as input_stream:
+        text = input_stream.read()
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def encode_command(cmd):
+    """Return the entry of the plan describing the command ``cmd`` as found
+    in the configuration.
+    """
+    if not isinstance(cmd, dict):
+        return OrderedDict([("language", "default"), ("command", cmd)])
+    entry = OrderedDict()
+    for key, value in cmd.items():
+        if key in CONDITIONS + (RESOURCES,):
+            entry[key] = value
+        else:
+            entry["language"] = key
+            entry["command"] = value
+    return entry
+
+
+def decode_command(entry):
+    """Return the command described by ``entry`` (see
+    :func:`encode_command`) as found in the configuration.
+    """
+    extra = [(key, value) for key, value in entry.items()
+             if key not in ("language", "command")]
+    if entry["language"] == "default" and not extra:
+        return entry["command"]
+    return OrderedDict([(entry["language"], entry["command"])] + extra)
+
+
+def references(step):
+    """Return the sorted names of the variables referenced by the
+    environments and commands of ``step`` which it does not define.
+
+    Their values are resolved when the step is executed.
+    """
+    defined = set(step["environment"]) | set(step["service_environment"])
+    texts = list(step["environment"].values()) + \
+        list(step["service_environment"].values()) + \
+        [entry["command"] for entry in step["commands"]]
+    names = set()
+    for text in texts:
+        names.update(_REFERENCE.findall(str(text)))
+    return sorted(names - defined)
+
+
+def write_plan(path, definitions, digest, service_name, operating_system,
+               matrix=None):
+    """Write the plan holding the step ``definitions`` (a dictionary
+    associating step names with definitions returned by
+    :meth:`ci.driver.Driver.select_step`) into ``path`` and return it.
+    """
+    steps = OrderedDict()
+    for name, definition in definitions.items():
+        step = OrderedDict([
+            ("environment", definition["environment"]),
+            ("service_environment", definition["service_environment"]),
+            ("commands", [encode_command(cmd)
+                          for cmd in definition["commands"]]),
+            ("cache", definition["cache"]),
+            (RESOURCES, definition[RESOURCES])
+        ] + [(key, definition.get(key, [])) for key in CONDITIONS])
+        step["references"] = references(step)
+        steps[name] = step
+    plan = OrderedDict([
+        ("version", PLAN_VERSION),
+        ("config_digest", digest),
+        ("service", service_name),
+        ("operating_system", operating_system),
+        ("steps", steps)
+    ])
+    if matrix:
+        plan["matrix"] = matrix
+    utils.atomic_write(path, json.dumps(plan, indent=2) + "\n", mode=0o644)
+    return plan
+
+
+def read_plan(path, config_file, service_name, operating_system):
+    """Return the plan written into ``path``.
+
+    Raise :class:`ci.exceptions.SKCIError` if it was not compiled from the
+    current content of ``config_file`` for ``service_name`` and
+    ``operating_system``.
+    """
+    try:
+        with open(path) as input_stream:
+            plan = json.load(input_stream, object_pairs_hook=OrderedDict)
+    except (IOError, OSError, ValueError) as exc:
+        raise SKCIError("failed to read plan %s: %s" % (path, exc))
+    if plan.get("version") != PLAN_VERSION:
+        raise SKCIError("plan %s has version %s instead of %s" % (
+            path, plan.get("version"), PLAN_VERSION))
+    if plan["config_digest"] != config_digest(config_file):
+        raise SKCIError("plan %s is outdated: %s changed since it was "
+                        "compiled (see 'ci compile')" % (path, config_file))
+    if (plan["service"], plan["operating_system"]) != \
+            (service_name, operating_system):
+        raise SKCIError(
+            "plan %s was compiled for %s instead of %s" % (
+                path, _platform(plan["service"], plan["operating_system"]),
+                _platform(service_name, operating_system)))
+    return plan
+
+
+def _platform(service_name, operating_system):
+    if operating_system is None:
+        return service_name
+    return "%s (%s)" % (service_name, operating_system)
+
+
+def plan_config(plan):
+    """Return the configuration equivalent to ``plan``, i.e. such that
+    :meth:`ci.driver.Driver.select_step` returns the same definitions.
+    """
+    data = OrderedDict()
+    for name, step in plan["steps"].items():
+        stage = OrderedDict([
+            ("environment", step["environment"]),
+            ("commands", [decode_command(entry)
+                          for entry in step["commands"]]),
+            ("cache", step["cache"]),
+            (RESOURCES, step[RESOURCES])
+        ] + [(key, step[key]) for key in CONDITIONS])
+        system = {"environment": step["service_environment"]}
+        if SERVICES[plan["service"]]:
+            system = {plan["operating_system"]: system}
+        stage[plan["service"]] = system
+        data[name] = stage
+    if "matrix" in plan:
+        data["matrix"] = plan["matrix"]
+    return data
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to measure the time spent executing
+the scripts generated for commands.
+
+Bash scripts are traced using ``set -x``. The trace is written into a
+separate file (see ``BASH_XTRACEFD``) and each traced command is prefixed
+with the time it started (see ``EPOCHREALTIME``, available since bash 5.0)
+and its line number. Once the script completed, the time elapsed between a
+command and the next one is attributed to the line of the former.
+
+Python scripts are executed by :const:`PYTHON_PROFILER` which profiles them
+using :mod:`cProfile`.
+"""
+
+import os
+import pstats
+import re
+
+from .constants import SCIKIT_CI_DIR
+
+PROFILE_DIR = os.path.join(SCIKIT_CI_DIR, "profiles")
+"""Default directory where the profiles of python commands are written."""
+
+PROFILE_TOP = 20
+"""Default number of entries of the profile of python commands reported."""
+
+PYTHON_PROFILER = """\
+import cProfile
+import os
+import sys
+
+output, sys.argv = sys.argv[1], sys.argv[2:]
+sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+with open(sys.argv[0]) as script:
+    code = compile(script.read(), sys.argv[0], "exec")
+profile = cProfile.Profile()
+try:
+    profile.runctx(code, {"__name__": "__main__", "__file__": sys.argv[0]},
+                   None)
+finally:
+    profile.dump_stats(output)
+"""
+"""Script executing the python script given as second argument and writing
+its profile into the file given as first argument.
+
+Unlike ``python -m cProfile``, the exit status of the script is preserved.
+"""
+
+XTRACE_PS4 = "+${EPOCHREALTIME} ${LINENO} "
+"""Prompt prefixing each traced command."""
+
+_XTRACE_LINE = re.compile(r"^\++(\d+)[.,](\d+) (\d+) ")
+
+
+def xtrace_pre_code(trace_file):
+    """Return a line of bash enabling the tracing of the script into
+    ``trace_file`` if ``EPOCHREALTIME`` is supported.
+    """
+    return (
+        "if [ -n \"${EPOCHREALTIME:-}\" ]; then "
+        "exec {_SCIKIT_CI_XTRACE_FD}>\"%s\"; "
+        "BASH_XTRACEFD=$_SCIKIT_CI_XTRACE_FD; PS4='%s'; set -x; fi" % (
+            trace_file.replace("\\", "\\\\").replace("\"", "\\\""),
+            XTRACE_PS4))
+
+
+class LineTiming(object):
+    """Time spent executing a line of a script.
+    """
+
+    def __init__(self, number, text):
+        self.number = number
+        """Line number starting at 1."""
+        self.text = text
+        self.duration = 0.
+        self.count = 0
+        """Number of traced commands started on that line."""
+
+
+def parse_xtrace(trace, script, first_line=1, end_time=None):
+    """Return the list of :class:`LineTiming` of the lines of ``script``
+    found in ``trace``, ordered by line number.
+
+    ``first_line`` is the line number of the first line of ``script`` in the
+    executed file. ``end_time`` is the time the script completed, used to
+    compute the duration of the last traced command.
+    """
+    lines = script.splitlines()
+    events = []
+    for line in trace.splitlines():
+        match = _XTRACE_LINE.match(line)
+        if match:
+            seconds, fraction, number = match.groups()
+            events.append((float("%s.%s" % (seconds, fraction)),
+                           int(number) - first_line + 1))
+    timings = {}
+    for position, (start, number) in enumerate(events):
+        if position + 1 < len(events):
+            end = events[position + 1][0]
+        else:
+            end = end_time if end_time is not None else start
+        if not 1 <= number <= len(lines):
+            continue
+        if number not in timings:
+            timings[number] = LineTiming(number, lines[number - 1])
+        timings[number].duration += max(0., end - start)
+        timings[number].count += 1
+    return [timings[number] for number in sorted(timings)]
+
+
+def format_line_timings(timings):
+    """Return the lines of a report of ``timings`` (see
+    :func:`parse_xtrace`).
+    """
+    return ["%8.2fs %4dx  %4d: %s" % (
+        timing.duration, timing.count, timing.number, timing.text.strip())
+        for timing in timings]
+
+
+def report_python_profile(path, top=PROFILE_TOP, stream=None):
+    """Write the ``top`` entries of the profile ``path`` with the largest
+    cumulative time into ``stream``.
+
+    Return False if the profile could not be read (e.g it was written by
+    an incompatible version of python).
+    """
+    try:
+        stats = pstats.Stats(path, stream=stream)
+    except (EOFError, TypeError, ValueError):
+        return False
+    stats.sort_stats("cumulative").print_stats(top)
+    return True
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to the resources declared by steps and
+commands, and to admit concurrent work only if these resources are
+available.
+
+Resources are declared using a ``resources`` dictionary::
+
+    build:
+      resources:
+        memory: 4G
+        cpus: 2
+      commands:
+        - make
+"""
+
+from . import utils
+
+RESOURCES = "resources"
+"""Key associated with the resources in step and command definitions."""
+
+
+def parse_resources(definition):
+    """Return a dictionary associating ``memory`` (in bytes) and ``cpus``
+    with the values declared in ``definition``.
+
+    Undeclared resources are associated with 0.
+    """
+    definition = definition or {}
+    memory = definition.get("memory")
+    return {
+        "memory": utils.parse_size(memory) if memory is not None else 0,
+        "cpus": float(definition.get("cpus", 0))
+    }
+
+
+def combine(requests):
+    """Return the resources needed to execute sequentially the work
+    described by ``requests``.
+    """
+    return {
+        "memory": max([request["memory"] for request in requests] + [0]),
+        "cpus": max([request["cpus"] for request in requests] + [0])
+    }
+
+
+class AdmissionController(object):
+    """Keep track of the resources reserved by running work.
+
+    ``memory`` (in bytes) and ``cpus`` are the budgets to share. If a budget
+    is None, the associated resource is not limited. Work is always admitted
+    if nothing else is running, even if it needs more than the budget.
+    """
+
+    def __init__(self, memory=None, cpus=None):
+        self.memory = memory
+        self.cpus = cpus
+        self.reserved = {"memory": 0, "cpus": 0.}
+        self.running = 0
+
+    def fits(self, request):
+        """Return True if the work described by ``request`` can start.
+        """
+        if not self.running:
+            return True
+        for resource in ("memory", "cpus"):
+            budget = getattr(self, resource)
+            if budget is not None and \
+                    self.reserved[resource] + request[resource] > budget:
+                return False
+        return True
+
+    def reserve(self, request):
+        for resource in ("memory", "cpus"):
+            self.reserved[resource] += request[resource]
+        self.running += 1
+
+    def release(self, request):
+        for resource in ("memory", "cpus"):
+            self.reserved[resource] -= request[resource]
+        self.running -= 1
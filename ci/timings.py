@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to record the duration and the return
+code of the steps and commands of every execution into a SQLite database,
+and to summarize them.
+
+Measurements are kept in memory while steps are executed and written at the
+end of the execution in a single transaction. The database uses write-ahead
+logging so that concurrent executions (e.g matrix entries sharing a work
+directory) do not block readers and wait for each other when writing.
+"""
+
+import os
+import time
+
+try:
+    import sqlite3
+except ImportError:  # pragma: no cover
+    sqlite3 = None
+
+from .constants import SCIKIT_CI_DIR, STEPS
+
+TIMINGS_DB = os.path.join(SCIKIT_CI_DIR, "timings.db")
+"""Default database where the durations of steps and commands are
+recorded."""
+
+TIMEOUT = 30
+"""Number of seconds to wait for another process writing into the
+database."""
+
+TREND_WINDOW = 5
+"""Number of executions compared to compute trends."""
+
+BASELINE_SIZE = 20
+"""Number of last successful executions of a step used as baseline to
+detect regressions."""
+
+BASELINE_MIN_SIZE = 5
+"""Minimum number of recorded executions needed to detect regressions."""
+
+REGRESSION_MADS = 3.
+"""Default number of (scaled) median absolute deviations above the median
+of the baseline a duration has to be to be considered a regression."""
+
+REGRESSION_THRESHOLD = 0.1
+"""Default minimum relative increase of a duration compared with the median
+of the baseline to be considered a regression."""
+
+REGRESSION_MIN_INCREASE = 1.
+"""Increases of duration smaller than this number of seconds are never
+considered regressions."""
+
+_MAD_SCALE = 1.4826
+"""Factor making the median absolute deviation of normally distributed
+values an estimate of their standard deviation."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    service TEXT,
+    operating_system TEXT
+);
+CREATE TABLE IF NOT EXISTS timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    step TEXT NOT NULL,
+    command_index INTEGER,
+    command TEXT,
+    duration REAL NOT NULL,
+    return_code INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timings_step ON timings(step, command_index);
+CREATE TABLE IF NOT EXISTS line_timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    step TEXT NOT NULL,
+    command_index INTEGER NOT NULL,
+    line_number INTEGER NOT NULL,
+    line TEXT,
+    duration REAL NOT NULL,
+    count INTEGER NOT NULL
+);
+"""
+
+
+def connect(path=TIMINGS_DB):
+    """Return a connection to the database ``path``, creating it if needed.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    connection = sqlite3.connect(path, timeout=TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+class TimingRecorder(object):
+    """Collect the durations of the steps and commands of an execution and
+    write them into the database ``path`` when calling :meth:`save`.
+
+    Nothing is recorded if :mod:`sqlite3` is not available.
+    """
+
+    def __init__(self, path=TIMINGS_DB, regression_mads=REGRESSION_MADS,
+                 regression_threshold=REGRESSION_THRESHOLD):
+        self.path = path
+        self.started = time.time()
+        self.service = None
+        self.operating_system = None
+        self.regression_mads = regression_mads
+        self.regression_threshold = regression_threshold
+        self.regressions = []
+        """List of :class:`Regression` detected by :meth:`check`."""
+        self._timings = []
+        self._lines = []
+
+    def record(self, step, duration, return_code=0, index=None,
+               command=None, lines=None):
+        """Record the duration (in seconds) and return code of ``step`` or,
+        if ``index`` is set, of one of its commands.
+
+        ``lines`` is the list of :class:`ci.profiling.LineTiming` of the
+        command if it was profiled.
+        """
+        self._timings.append(
+            (step, index, command, duration, return_code))
+        for line in lines or []:
+            self._lines.append((step, index, line.number, line.text,
+                                line.duration, line.count))
+
+    def baseline(self, step, size=BASELINE_SIZE):
+        """Return the durations of the last ``size`` successful executions
+        of ``step`` recorded for the current service and operating system.
+        """
+        if sqlite3 is None or not os.path.exists(self.path):
+            return []
+        connection = connect(self.path)
+        try:
+            rows = connection.execute(
+                "SELECT duration FROM timings "
+                "JOIN runs ON runs.id = timings.run_id "
+                "WHERE step = ? AND command_index IS NULL "
+                "AND return_code = 0 AND service IS ? "
+                "AND operating_system IS ? "
+                "ORDER BY runs.started DESC, runs.id DESC LIMIT ?",
+                (step, self.service, self.operating_system, size)
+            ).fetchall()
+        finally:
+            connection.close()
+        return [row[0] for row in rows]
+
+    def check(self, step, duration):
+        """Compare ``duration`` of ``step`` with its baseline and return a
+        :class:`Regression` if it is significantly slower, otherwise None.
+
+        A duration is a regression if it exceeds the median of the baseline
+        by more than ``regression_mads`` scaled median absolute deviations,
+        by more than ``regression_threshold`` times the median and by more
+        than :const:`REGRESSION_MIN_INCREASE`.
+        """
+        durations = self.baseline(step)
+        if len(durations) < BASELINE_MIN_SIZE:
+            return None
+        median = percentile(durations, 0.5)
+        mad = _MAD_SCALE * median_absolute_deviation(durations)
+        if duration <= median + self.regression_mads * mad or \
+                duration <= median * (1 + self.regression_threshold) or \
+                duration <= median + REGRESSION_MIN_INCREASE:
+            return None
+        regression = Regression(step, duration, median, mad, len(durations))
+        self.regressions.append(regression)
+        return regression
+
+    def save(self):
+        if sqlite3 is None or not self._timings:  # pragma: no cover
+            return
+        connection = connect(self.path)
+        try:
+            with connection:
+                run_id = connection.execute(
+                    "INSERT INTO runs (started, service, operating_system) "
+                    "VALUES (?, ?, ?)",
+                    (self.started, self.service, self.operating_system)
+                ).lastrowid
+                connection.executemany(
+                    "INSERT INTO timings (run_id, step, command_index, "
+                    "command, duration, return_code) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(run_id,) + timing for timing in self._timings])
+                connection.executemany(
+                    "INSERT INTO line_timings (run_id, step, command_index, "
+                    "line_number, line, duration, count) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(run_id,) + line for line in self._lines])
+        finally:
+            connection.close()
+        self._timings = []
+        self._lines = []
+
+
+def percentile(values, fraction):
+    """Return the percentile ``fraction`` (between 0 and 1) of ``values``
+    interpolating linearly between the closest ranks.
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (
+        position - lower)
+
+
+def median_absolute_deviation(values):
+    """Return the median of the absolute deviations of ``values`` from their
+    median.
+    """
+    median = percentile(values, 0.5)
+    return percentile([abs(value - median) for value in values], 0.5)
+
+
+class Regression(object):
+    """A step significantly slower than during its previous executions.
+    """
+
+    def __init__(self, step, duration, median, mad, runs):
+        self.step = step
+        self.duration = duration
+        self.median = median
+        self.mad = mad
+        """Scaled median absolute deviation of the baseline."""
+        self.runs = runs
+        """Number of executions in the baseline."""
+
+    def __str__(self):
+        return "%s took %.2fs instead of %.2fs (median of its last %d " \
+               "executions, MAD %.2fs)" % (
+                   self.step, self.duration, self.median, self.runs,
+                   self.mad)
+
+
+def trend(durations, window=TREND_WINDOW):
+    """Return the relative change of the median of the last ``window``
+    durations compared with the ``window`` previous ones, or None if there
+    are not enough durations.
+
+    ``durations`` are ordered from the oldest to the most recent.
+    """
+    if len(durations) < 2 * window:
+        return None
+    previous = percentile(durations[-2 * window:-window], 0.5)
+    if not previous:
+        return None
+    return percentile(durations[-window:], 0.5) / previous - 1
+
+
+class Statistics(object):
+    """Durations of a step or command across executions.
+    """
+
+    def __init__(self, step, index=None, command=None):
+        self.step = step
+        self.index = index
+        self.command = command
+        self.durations = []
+        """Durations of successful executions, the oldest first."""
+        self.failures = 0
+
+    @property
+    def name(self):
+        if self.index is None:
+            return self.step
+        return "%s:%d" % (self.step, self.index)
+
+    def percentile(self, fraction):
+        return percentile(self.durations, fraction)
+
+    def trend(self, window=TREND_WINDOW):
+        return trend(self.durations, window)
+
+
+def load_statistics(path=TIMINGS_DB, step=None, service=None,
+                    operating_system=None):
+    """Return the list of :class:`Statistics` of the steps and commands
+    recorded in the database ``path``.
+
+    Commands are identified by their step, index and text. Results can be
+    restricted to a ``step``, a ``service`` or an ``operating_system``.
+    """
+    conditions = []
+    parameters = []
+    for column, value in [("timings.step", step), ("runs.service", service),
+                          ("runs.operating_system", operating_system)]:
+        if value is not None:
+            conditions.append("%s = ?" % column)
+            parameters.append(value)
+    query = (
+        "SELECT timings.step, command_index, command, duration, return_code "
+        "FROM timings JOIN runs ON runs.id = timings.run_id")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY runs.started, runs.id"
+    connection = connect(path)
+    try:
+        rows = connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+    statistics = {}
+    for _step, index, command, duration, return_code in rows:
+        key = (_step, index, command)
+        if key not in statistics:
+            statistics[key] = Statistics(_step, index, command)
+        if return_code:
+            statistics[key].failures += 1
+        else:
+            statistics[key].durations.append(duration)
+    return list(statistics.values())
+
+
+def format_statistics(statistics, top=10):
+    """Return a report of ``statistics`` (see :func:`load_statistics`)
+    listing the percentiles and trend of each step followed by the ``top``
+    slowest commands.
+    """
+    def _row(stat, label):
+        if not stat.durations:
+            return "  %-40s %5d %7d %s" % (
+                label, 0, stat.failures, "(no successful execution)")
+        change = stat.trend()
+        return "  %-40s %5d %7d %8.2fs %8.2fs %8.2fs %7s" % (
+            label, len(stat.durations), stat.failures,
+            stat.percentile(0.5), stat.percentile(0.9),
+            max(stat.durations),
+            "n/a" if change is None else "%+.0f%%" % (change * 100))
+
+    header = "  %-40s %5s %7s %9s %9s %9s %7s" % (
+        "", "runs", "failed", "p50", "p90", "max", "trend")
+    steps = [stat for stat in statistics if stat.index is None]
+    commands = [stat for stat in statistics
+                if stat.index is not None and stat.durations]
+    lines = ["Steps:", header]
+    steps = sorted(steps, key=lambda stat: (
+        STEPS.index(stat.step) if stat.step in STEPS else len(STEPS)))
+    lines.extend([_row(stat, stat.name) for stat in steps])
+    lines.extend(["", "Slowest commands:", header])
+    commands = sorted(commands, key=lambda stat: -stat.percentile(0.5))
+    for stat in commands[:top]:
+        command = " ".join(stat.command.split())
+        label = "%s %s" % (stat.name, command)
+        if len(label) > 40:
+            label = label[:37] + "..."
+        lines.append(_row(stat, label))
+    return "\n".join(lines)
@@ -2,7 +2,18 @@
 
 """This module defines functions generally useful in scikit-ci."""
 
+import errno
+import math
+import multiprocessing
 import os
+import re
+import sys
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 from .constants import SERVICES, SERVICES_ENV_VAR
 
@@ -38,3 +49,239 @@ def indent(text, prefix, predicate=None):
         for line in text.splitlines(True):
             yield (prefix + line if predicate(line) else line)
     return ''.join(prefixed_lines())
+
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3,
+               "T": 1024 ** 4}
+
+
+def parse_size(size):
+    """Return the number of bytes associated with ``size``.
+
+    ``size`` is either a number of bytes or a string like ``512M`` or
+    ``2GB`` where the suffix is a binary multiple (``K``, ``M``, ``G`` or
+    ``T``).
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$",
+                     str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("invalid size: {}".format(size))
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def atomic_write(path, content, mode=None):
+    """Write ``content`` into ``path`` such that readers either see the
+    previous or the new content, never a partial one.
+
+    Parent directories are created if needed. If ``mode`` is set, it is
+    associated with the file, otherwise only the owner can read it.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    file_mode = "wb" if isinstance(content, bytes) else "w"
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, file_mode) as output_stream:
+            output_stream.write(content)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        if os.name == "nt" and os.path.exists(path):  # pragma: no cover
+            os.remove(path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class FileLock(object):
+    """Context manager holding an exclusive lock of the file ``path``,
+    created if needed, while it is entered.
+
+    The lock is advisory and only excludes other processes using it. It does
+    nothing on platforms without :mod:`fcntl` (e.g. Windows).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is None:  # pragma: no cover
+            return self
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(directory):
+                raise
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as input_stream:
+            return input_stream.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_paths(controller):
+    """Yield the directories of the cgroups of the current process
+    associated with ``controller`` (None for cgroups v2).
+    """
+    try:
+        with open("/proc/self/cgroup") as input_stream:
+            lines = input_stream.read().splitlines()
+    except (IOError, OSError):
+        lines = []
+    root = "/sys/fs/cgroup"
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controller is None and not controllers:
+            yield os.path.join(root, path.lstrip("/"))
+        elif controller in controllers.split(","):
+            yield os.path.join(root, controllers, path.lstrip("/"))
+    # Inside a container, the cgroup of the process is mounted as the root
+    yield root if controller is None else os.path.join(root, controller)
+
+
+def cgroup_cpu_quota():
+    """Return the number of CPUs allowed by the CFS quota of the cgroup of
+    the current process, or None if there is no quota.
+    """
+    for path in _cgroup_paths(None):
+        # cgroups v2: "<quota> <period>" or "max <period>"
+        value = _read_first_line(os.path.join(path, "cpu.max"))
+        if value:
+            quota, period = (value.split() + ["100000"])[:2]
+            if quota == "max":
+                return None
+            return float(quota) / float(period)
+    for path in _cgroup_paths("cpu"):
+        quota = _read_first_line(os.path.join(path, "cpu.cfs_quota_us"))
+        period = _read_first_line(os.path.join(path, "cpu.cfs_period_us"))
+        if quota and period:
+            if int(quota) <= 0:
+                return None
+            return float(quota) / float(period)
+    return None
+
+
+def cpu_count():
+    """Return the number of CPUs the current process can use.
+
+    Contrary to :func:`multiprocessing.cpu_count`, the CPU affinity of the
+    process and the CFS quota of its cgroup (e.g set by ``docker --cpus``)
+    are considered.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        count = multiprocessing.cpu_count()
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, int(math.ceil(quota)))
+    return max(1, count)
+
+
+def _read_int(path):
+    value = _read_first_line(path)
+    if not value or not value.isdigit():
+        return None
+    return int(value)
+
+
+def available_memory():
+    """Return the number of bytes of memory available for new processes or
+    None if it is unknown.
+
+    The ``MemAvailable`` entry of ``/proc/meminfo`` and the memory limit of
+    the cgroup of the current process (e.g set by ``docker --memory``) are
+    considered.
+    """
+    available = None
+    try:
+        with open("/proc/meminfo") as input_stream:
+            for line in input_stream:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    for files in [("memory.max", "memory.current", None),
+                  ("memory.limit_in_bytes", "memory.usage_in_bytes",
+                   "memory")]:
+        limit_file, usage_file, controller = files
+        for path in _cgroup_paths(controller):
+            limit = _read_int(os.path.join(path, limit_file))
+            usage = _read_int(os.path.join(path, usage_file))
+            # Without limit, cgroups v1 reports a value close to 2**63
+            if limit is None or usage is None or limit >= 2 ** 60:
+                continue
+            cgroup_available = max(0, limit - usage)
+            if available is None or cgroup_available < available:
+                available = cgroup_available
+            break
+    return available
+
+
+class _NoLock(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _retry_on_eintr(function, *args):
+    while True:
+        try:
+            return function(*args)
+        except OSError as exc:  # pragma: no cover
+            if exc.errno != errno.EINTR:
+                raise
+
+
+def wait_process(process, lock=None):
+    """Wait for ``process`` (a :class:`subprocess.Popen`) to complete.
+
+    Return a tuple ``(return_code, peak_rss)`` where ``peak_rss`` is the
+    largest resident set size in bytes reached by the process or any of its
+    descendants, or None if it can not be measured on this platform.
+
+    If ``lock`` is set, ``returncode`` is set while holding it. Where
+    :func:`os.waitid` is available, the process is also reaped while holding
+    it, so that a thread checking ``returncode`` under the same lock never
+    signals a reaped process.
+    """
+    if not hasattr(os, "wait4"):  # pragma: no cover
+        return process.wait(), None
+    result = None
+    if lock is not None and hasattr(os, "waitid"):
+        # Wait for the process to exit without reaping it
+        _retry_on_eintr(os.waitid, os.P_PID, process.pid,
+                        os.WEXITED | os.WNOWAIT)
+    else:
+        result = _retry_on_eintr(os.wait4, process.pid, 0)
+    with lock or _NoLock():
+        _, status, rusage = result or _retry_on_eintr(
+            os.wait4, process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is expressed in kilobytes, except on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return process.returncode, rusage.ru_maxrss * scale
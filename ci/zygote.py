@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+"""This module provides an interface to execute python commands in processes
+forked from a python process (the zygote) which imported a list of modules
+once, so that commands do not pay for importing them.
+
+The zygote executes :const:`ZYGOTE_SERVER` using the interpreter and the
+environment of the first python command. For each command, it receives the
+path of the script, the working directory, the environment and the file
+descriptors the process should use as standard input, output and error (see
+``SCM_RIGHTS``). It forks a process executing the script like ``python -B``
+would and reports its exit status once it completes.
+
+A new zygote is started if the interpreter or the variables affecting its
+initialization (see :func:`startup_environment`) change between commands.
+"""
+
+import array
+import json
+import os
+import socket
+import subprocess
+import tempfile
+
+from .daemon import SUPPORTED, _HEADER, _STATUS, _recv_exactly
+
+ZYGOTE_SERVER = """\
+import array
+import fcntl
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+import types
+
+HEADER = struct.Struct("!I")
+STATUS = struct.Struct("!i")
+MAX_FDS = 64
+
+
+def recv_exactly(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def receive(control):
+    fds = array.array("i")
+    header, ancillary, _, _ = control.recvmsg(
+        HEADER.size, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if not header:
+        return None, []
+    header += recv_exactly(control, HEADER.size - len(header)) or b""
+    payload = recv_exactly(control, HEADER.unpack(header)[0])
+    return json.loads(payload.decode("utf-8")), list(fds)
+
+
+def serve(control):
+    wakeup_read, wakeup_write = os.pipe()
+    for fd in (wakeup_read, wakeup_write):
+        fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+    signal.set_wakeup_fd(wakeup_write)
+    children = {}
+    while True:
+        readable = select.select([control, wakeup_read], [], [])[0]
+        if wakeup_read in readable:
+            try:
+                os.read(wakeup_read, 4096)
+            except OSError:
+                pass
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \\
+                else os.WEXITSTATUS(status)
+            connection = children.pop(pid, None)
+            if connection is not None:
+                try:
+                    connection.sendall(STATUS.pack(code))
+                except socket.error:
+                    pass
+                connection.close()
+        if control not in readable:
+            continue
+        request, fds = receive(control)
+        if request is None:
+            return None
+        connection = socket.socket(
+            socket.AF_UNIX, socket.SOCK_STREAM, 0, fds.pop(0))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for fd in (wakeup_read, wakeup_write):
+                os.close(fd)
+            for other in [control, connection] + list(children.values()):
+                other.close()
+            return request, fds
+        for fd in fds:
+            os.close(fd)
+        connection.sendall(STATUS.pack(pid))
+        children[pid] = connection
+
+
+def execute(request, fds):
+    targets = request["fds"]
+    # Move received descriptors out of the way of the targets
+    lowest = max(targets) + 1
+    moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, lowest) for fd in fds]
+    for fd in fds:
+        os.close(fd)
+    for target, fd in zip(targets, moved):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["environ"])
+    script = request["script"]
+    sys.argv = [script]
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    main = types.ModuleType("__main__")
+    main.__file__ = script
+    main.__builtins__ = __builtins__
+    sys.modules["__main__"] = main
+    with open(script, "rb") as input_stream:
+        code = compile(input_stream.read(), script, "exec")
+    try:
+        exec(code, main.__dict__)
+    except SystemExit:
+        raise
+    except BaseException:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        # Hide the frame of the zygote
+        exc_value.with_traceback(exc_traceback.tb_next)
+        sys.excepthook(exc_type, exc_value, exc_traceback.tb_next)
+        if exc_type is KeyboardInterrupt:
+            sys.stdout.flush()
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGINT)
+        sys.exit(1)
+
+
+control = socket.socket(
+    socket.AF_UNIX, socket.SOCK_STREAM, 0, int(sys.argv[1]))
+preloaded = {}
+for name in sys.argv[2:]:
+    try:
+        __import__(name)
+        preloaded[name] = None
+    except Exception:
+        preloaded[name] = traceback.format_exc().splitlines()[-1]
+# Count native threads (e.g. started by OpenBLAS) where possible
+if os.path.isdir("/proc/self/task"):
+    threads = len(os.listdir("/proc/self/task"))
+else:
+    threads = threading.active_count()
+control.sendall(json.dumps(
+    {"modules": preloaded, "threads": threads}).encode("utf-8") + b"\\n")
+request = serve(control)
+if request is not None:
+    execute(*request)
+"""
+"""Script executed by the zygote. Its first argument is the file descriptor
+of the socket connected to :class:`Zygote`, the others are the names of the
+modules to import. Once they are imported, it reports the modules that
+failed to be imported and its number of threads.
+
+The script requires python 3.3 or later."""
+
+STARTUP_VARIABLES = ("PATH", "LANG", "LC_ALL", "LC_CTYPE")
+"""Variables affecting the initialization of python processes, in addition
+to the ones starting with ``PYTHON``."""
+
+
+def startup_environment(env):
+    """Return the items of ``env`` that affect the initialization of python
+    processes, i.e. that can not be changed once the zygote started.
+    """
+    return sorted([(name, value) for name, value in env.items()
+                   if name in STARTUP_VARIABLES or name.startswith("PYTHON")])
+
+
+class ZygoteProcess(object):
+    """Process forked by the zygote, providing the subset of the interface
+    of :class:`subprocess.Popen` used by :func:`ci.output.check_call`.
+    """
+
+    def __init__(self, connection, pid, stdout, stderr):
+        self._connection = connection
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            status = _recv_exactly(self._connection, _STATUS.size)
+            self._connection.close()
+            # The zygote was terminated before reporting the exit status
+            self.returncode = _STATUS.unpack(status)[0] if status else 1
+        return self.returncode
+
+
+class Zygote(object):
+    """Execute python scripts in processes forked from a python process
+    which imported ``modules``.
+
+    ``log`` is called with messages about the zygote. If the zygote can not
+    be started (e.g. python is older than 3.3) or if importing ``modules``
+    started threads (e.g. the thread pool of OpenBLAS imported by numpy),
+    scripts are executed by new python processes.
+    """
+
+    def __init__(self, modules, log=None):
+        self.modules = list(modules)
+        self.log = log or (lambda *args: None)
+        self.disabled = not SUPPORTED
+        self._process = None
+        self._control = None
+        self._server_file = None
+        self._key = None
+
+    def _start(self, env):
+        self.close()
+        self._key = startup_environment(env)
+        self._server_file = tempfile.NamedTemporaryFile(
+            delete=False, suffix=".py")
+        self._server_file.write(ZYGOTE_SERVER.encode("utf-8"))
+        self._server_file.close()
+        self._control, remote = socket.socketpair()
+        line = None
+        try:
+            # Like commands, the output of the zygote is not a terminal
+            self._process = subprocess.Popen(
+                ["python", "-B", self._server_file.name,
+                 str(remote.fileno())] + self.modules,
+                env=env, pass_fds=(remote.fileno(),),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        except OSError:
+            pass
+        else:
+            line = self._control.makefile("rb").readline()
+        finally:
+            remote.close()
+        if not line:
+            self.log("[scikit-ci] Warning: failed to start the python zygote, "
+                     "executing python commands in new processes")
+            self.close()
+            self.disabled = True
+            return
+        status = json.loads(line.decode("utf-8"))
+        for name in self.modules:
+            if status["modules"][name] is not None:
+                self.log("[scikit-ci] Warning: failed to preload %s: %s" % (
+                    name, status["modules"][name]))
+        if status["threads"] > 1:
+            # Only the forking thread exists in the child: locks held by the
+            # others are never released
+            self.log("[scikit-ci] Warning: preloaded modules started %d "
+                     "threads, forking could deadlock. Executing python "
+                     "commands in new processes" % (status["threads"] - 1))
+            self.close()
+            self.disabled = True
+            return
+        self.log("[scikit-ci] Started python zygote (pid %d)" %
+                 self._process.pid)
+
+    def popen(self, script, args, stdout=None, stderr=None, env=None,
+              pass_fds=(), **kwargs):
+        """Execute ``script`` in a process forked from the zygote.
+
+        ``args`` (the command executing ``script`` in a new python process)
+        and ``kwargs`` are used to execute it as :class:`subprocess.Popen`
+        would if the zygote is disabled. Only ``subprocess.PIPE`` is
+        supported for ``stdout`` and ``stderr``, and ``shell`` is the only
+        other supported argument: :class:`TypeError` is raised if any other
+        is set while the zygote is enabled.
+        """
+        env = dict(os.environ if env is None else env)
+        if not self.disabled and (
+                self._process is None or
+                self._key != startup_environment(env)):
+            self._start(env)
+        if self.disabled:
+            if pass_fds:
+                kwargs["pass_fds"] = pass_fds
+            return subprocess.Popen(
+                args, stdout=stdout, stderr=stderr, env=env, **kwargs)
+        # The script is executed directly, whatever the shell mode
+        kwargs.pop("shell", None)
+        if kwargs:
+            raise TypeError(
+                "arguments not supported by the python zygote: %s" %
+                ", ".join(sorted(kwargs)))
+        connection, remote = socket.socketpair()
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        fds = [0, stdout_write, stderr_write] + list(pass_fds)
+        payload = json.dumps({
+            "script": os.path.abspath(script), "cwd": os.getcwd(),
+            "environ": env, "fds": [0, 1, 2] + list(pass_fds)
+        }).encode("utf-8")
+        message = _HEADER.pack(len(payload)) + payload
+        try:
+            sent = self._control.sendmsg([message], [(
+                socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                array.array("i", [remote.fileno()] + fds))])
+            self._control.sendall(message[sent:])
+            status = _recv_exactly(connection, _STATUS.size)
+        finally:
+            remote.close()
+            os.close(stdout_write)
+            os.close(stderr_write)
+        if status is None:
+            raise OSError("the python zygote terminated unexpectedly")
+        return ZygoteProcess(
+            connection, _STATUS.unpack(status)[0],
+            os.fdopen(stdout_read, "rb"), os.fdopen(stderr_read, "rb"))
+
+    def close(self):
+        """Terminate the zygote. Processes forked from it are not affected.
+        """
+        if self._control is not None:
+            self._control.close()
+            self._control = None
+        if self._process is not None:
+            self._process.wait()
+            self._process = None
+        if self._server_file is not None:
+            os.remove(self._server_file.name)
+            self._server_file = None
@@ -1,4 +1,5 @@
 
+import json
 import os
 import platform
 import pyfiglet
@@ -1232,3 +1233,1963 @@ def test_env_file_update_from_step(tmpdir):
         execute_step("test")
         env = Driver.read_env()
         assert env['SCIKIT_CI_UPDATE_FROM_STEP'] == '1'
+
+
+def test_step_definition_change(tmpdir):
+    template = textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        before_install:
+          commands:
+            - "python -c \"with open('before_install', 'w') as file: file.write('{before_install}')\""
+        install:
+          environment:
+            INSTALL_PATH: "$<INSTALL_PATH>:/opt"
+          commands:
+            - "python -c \"with open('install', 'w') as file: file.write('{install}')\""
+        build:
+          environment:
+            BUILD_TARGET: "$<TARGET_NAME>"
+          commands:
+            - "python -c \"import os; open('build', 'w').write(os.environ['BUILD_TARGET'])\""
+        """  # noqa: E501
+    )
+    service = 'circle'
+
+    environment = dict(os.environ)
+    enable_service(service, environment)
+    environment["INSTALL_PATH"] = "/usr"
+    environment.pop("TARGET_NAME", None)
+
+    def _write_config(before_install, install):
+        tmpdir.join('scikit-ci.yml').write(template.format(
+            version=SCHEMA_VERSION,
+            before_install=before_install, install=install))
+
+    def _remove_files():
+        for name in ['before_install', 'install', 'build']:
+            if tmpdir.join(name).exists():
+                tmpdir.join(name).remove()
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+
+        _write_config("a", "a")
+        execute_step("build")
+
+        env = Driver.read_env()
+        assert env['SCIKIT_CI_INSTALL'] == '1'
+        assert 'SCIKIT_CI_INSTALL_FINGERPRINT' in env
+        _remove_files()
+
+        # Unchanged definition: nothing is re-executed
+        execute_step("build")
+        assert not tmpdir.join('before_install').exists()
+        assert not tmpdir.join('install').exists()
+        assert not tmpdir.join('build').exists()
+
+        # Changed 'install' definition: 'install' and its dependents are
+        # re-executed.
+        _write_config("a", "b")
+        execute_step("install")
+        assert not tmpdir.join('before_install').exists()
+        assert tmpdir.join('install').read() == 'b'
+        assert not tmpdir.join('build').exists()
+        assert 'SCIKIT_CI_BUILD' not in Driver.read_env()
+
+        execute_step("build")
+        assert tmpdir.join('build').exists()
+        _remove_files()
+
+        # Changed 'before_install' definition
+        _write_config("b", "b")
+        execute_step("build")
+        assert tmpdir.join('before_install').read() == 'b'
+        assert tmpdir.join('install').exists()
+        assert tmpdir.join('build').exists()
+        _remove_files()
+
+        # Variables referencing their own value do not change the fingerprint
+        install_path = Driver.read_env()["INSTALL_PATH"]
+        assert install_path.startswith("/usr:/opt")
+        execute_step("build")
+        assert not tmpdir.join('install').exists()
+        assert not tmpdir.join('build').exists()
+
+        # Changed value of a referenced variable
+        with push_env(TARGET_NAME="lib"):
+            execute_step("build")
+        assert not tmpdir.join('install').exists()
+        assert tmpdir.join('build').read() == 'lib'
+        assert Driver.read_env()["INSTALL_PATH"] == install_path
+
+
+def test_cache_directories(tmpdir, capfd):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        install:
+          cache:
+            directories:
+              - deps
+            key_files:
+              - requirements.txt
+          commands:
+            - python: |
+                      import os
+                      if not os.path.exists("deps/package"):
+                          os.makedirs("deps")
+                          with open("deps/package", "w") as output:
+                              output.write("")
+                          print("downloaded")
+        """
+    ).format(version=SCHEMA_VERSION))
+    tmpdir.join('requirements.txt').write("package")
+    cache_dir = str(tmpdir.join("cache"))
+
+    service = 'circle'
+
+    environment = dict(os.environ)
+    enable_service(service, environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("install", cache_dir=cache_dir)
+        output_lines, _ = captured_lines(capfd)
+        assert "downloaded" in output_lines
+        assert "[scikit-ci] Cache saved: %s" % tmpdir.join("deps") in \
+            [line.split(" (")[0] for line in output_lines]
+
+        tmpdir.join("deps").remove()
+        execute_step("install", cache_dir=cache_dir, clear_cached_env=True)
+        output_lines, _ = captured_lines(capfd)
+        assert "downloaded" not in output_lines
+        assert tmpdir.join("deps", "package").exists()
+
+        # Corrupted archives are cache misses, replaced once the step
+        # completes
+        for archive in tmpdir.join("cache").listdir("*.tar.gz"):
+            archive.write_binary(archive.read_binary()[:40])
+        tmpdir.join("deps").remove()
+        execute_step("install", cache_dir=cache_dir, clear_cached_env=True)
+        output_lines, _ = captured_lines(capfd)
+        assert [line for line in output_lines if line.startswith(
+            "[scikit-ci] Warning: failed to extract archive")]
+        assert "downloaded" in output_lines
+        assert "[scikit-ci] Cache saved: %s" % tmpdir.join("deps") in \
+            [line.split(" (")[0] for line in output_lines]
+        assert not [path for path in tmpdir.listdir(".deps.*")]
+        tmpdir.join("deps").remove()
+        execute_step("install", cache_dir=cache_dir, clear_cached_env=True)
+        output_lines, _ = captured_lines(capfd)
+        assert "downloaded" not in output_lines
+
+        # Updating key files invalidates the cache
+        tmpdir.join('requirements.txt').write("package==2.0")
+        tmpdir.join("deps").remove()
+        execute_step("install", cache_dir=cache_dir, clear_cached_env=True)
+        output_lines, _ = captured_lines(capfd)
+        assert "downloaded" in output_lines
+
+    assert len(tmpdir.join("cache").listdir()) == 2
+
+
+def test_cache_eviction(tmpdir):
+    from ci.cache import DirectoryCache, FileSystemCacheBackend
+
+    backend = FileSystemCacheBackend(str(tmpdir.join("cache")), max_size="1M")
+    for index in range(3):
+        cache = DirectoryCache(backend)
+        directory = tmpdir.join("dir_%d" % index)
+        directory.ensure(dir=True)
+        directory.join("data").write_binary(os.urandom(400 * 1024))
+        assert cache.save("%d" % index, str(directory))
+        # Make sure modification times are different
+        os.utime(backend.path("%d" % index), (index, index))
+        if index == 1:
+            # Using an archive marks it as recently used
+            assert cache.restore("0", str(tmpdir.join("restored")))
+
+    assert backend.lookup(["0", "1", "2"]) == set(["0", "2"])
+
+
+@pytest.mark.parametrize("data_filter", [True, False])
+def test_cache_unsafe_archive(tmpdir, monkeypatch, data_filter):
+    import io
+    import tarfile
+    from ci.cache import DirectoryCache, FileSystemCacheBackend, SKCICacheError
+
+    if not data_filter:
+        monkeypatch.delattr(tarfile, "data_filter", raising=False)
+    elif not hasattr(tarfile, "data_filter"):  # pragma: no cover
+        pytest.skip("tarfile does not support extraction filters")
+
+    def _archive(key, member):
+        path = str(tmpdir.join(key + ".tar.gz"))
+        with tarfile.open(path, mode="w:gz") as tar:
+            data = member.pop("data", b"")
+            info = tarfile.TarInfo(member.pop("name"))
+            for name, value in member.items():
+                setattr(info, name, value)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        backend.put(key, path)
+
+    backend = FileSystemCacheBackend(str(tmpdir.join("cache")))
+    _archive("1", {"name": "../outside", "data": b"x"})
+    _archive("2", {"name": str(tmpdir.join("absolute")), "data": b"x"})
+    _archive("3", {"name": "link", "type": tarfile.SYMTYPE,
+                   "linkname": str(tmpdir)})
+    _archive("4", {"name": "sub/data", "data": b"x"})
+
+    cache = DirectoryCache(backend)
+    restored = tmpdir.join("restored")
+    for key in ["1", "3"]:
+        with pytest.raises(SKCICacheError):
+            cache.restore(key, str(restored))
+    # The data filter extracts absolute paths relative to the directory
+    try:
+        cache.restore("2", str(restored))
+    except SKCICacheError:
+        assert not data_filter
+    assert not tmpdir.join("outside").exists()
+    assert not tmpdir.join("absolute").exists()
+    assert not restored.join("link").check(link=True)
+
+    assert cache.restore("4", str(restored))
+    assert restored.join("sub", "data").read() == "x"
+
+
+def test_cache_http_backend(tmpdir, monkeypatch):
+    import ci.cache
+    from ci.cache import (
+        CHECKSUM_HEADER, DirectoryCache, HTTPCacheBackend, SKCICacheError)
+    from ci.cache_server import CacheServer
+
+    server = CacheServer(str(tmpdir.join("server")), quiet=True)
+    server.start()
+    try:
+        backend = HTTPCacheBackend(server.url)
+        cache = DirectoryCache(backend)
+
+        for name in ["a", "b"]:
+            tmpdir.join(name, "data").write(name, ensure=True)
+            assert cache.save(name * 8, str(tmpdir.join(name)))
+        assert sorted(cache.wait()) == ["aaaaaaaa", "bbbbbbbb"]
+
+        # All keys are looked up in one request
+        assert backend.lookup(["aaaaaaaa", "bbbbbbbb", "cccccccc"]) == \
+            set(["aaaaaaaa", "bbbbbbbb"])
+
+        cache = DirectoryCache(backend)
+        cache.lookup(["aaaaaaaa", "cccccccc"])
+        assert cache.restore("aaaaaaaa", str(tmpdir.join("restored")))
+        assert tmpdir.join("restored", "data").read() == "a"
+        assert not cache.restore("cccccccc", str(tmpdir.join("missing")))
+        assert not tmpdir.join("missing").exists()
+
+        # Corrupted uploads are rejected
+        archive = tmpdir.join("archive")
+        archive.write("content")
+        with pytest.raises(Exception):
+            backend._request(
+                "dddddddd", data=archive.read_binary(), method="PUT",
+                headers={CHECKSUM_HEADER: "0" * 64})
+        assert backend.lookup(["dddddddd"]) == set()
+
+        # Corrupted downloads are detected before being extracted
+        with open(server.backend.path("aaaaaaaa") + ".sha256", "w") as output:
+            output.write("0" * 64)
+        extracted = []
+        monkeypatch.setattr(ci.cache, "extract_archive",
+                            lambda *args: extracted.append(args))
+        tmpdir.join("corrupted", "previous").write("", ensure=True)
+        with pytest.raises(SKCICacheError) as excinfo:
+            DirectoryCache(backend).restore(
+                "aaaaaaaa", str(tmpdir.join("corrupted")))
+        assert "corrupted archive" in str(excinfo.value)
+        assert not extracted
+        assert tmpdir.join("corrupted").listdir() == [
+            tmpdir.join("corrupted", "previous")]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_cache_unreachable_server(tmpdir, capfd):
+    import socket
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        install:
+          cache:
+            directories:
+              - deps
+          commands:
+            - python: |
+                      import os
+                      os.makedirs("deps")
+                      open("deps/package", "w").close()
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    # Find a port nothing listens on
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+    sock.close()
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("install", cache_url=url)
+        output_lines, _ = captured_lines(capfd)
+        assert Driver.read_env()["SCIKIT_CI_INSTALL"] == "1"
+        warnings = [line for line in output_lines
+                    if line.startswith("[scikit-ci] Warning: ")]
+        assert len(warnings) == 2
+        assert "failed to look up archives" in warnings[0]
+        assert "failed to upload" in warnings[1]
+        assert "[scikit-ci] Cache miss: %s" % tmpdir.join("deps") in \
+            output_lines
+
+
+def test_file_hasher(tmpdir):
+    from ci.hashing import FileHasher, hash_file
+
+    src = tmpdir.join("src")
+    src.join("a.py").write("a", ensure=True)
+    src.join("empty.py").write("", ensure=True)
+    src.join("sub", "b.py").write("b" * 100000, ensure=True)
+    src.join(".git", "index").write("ignored", ensure=True)
+    for path in src.visit(lambda path: path.isfile()):
+        os.utime(str(path), (0, 0))
+
+    cache_file = str(tmpdir.join(".scikit-ci", "hashes.json"))
+
+    with push_dir(str(tmpdir)):
+        hasher = FileHasher(cache_file)
+        digests = hasher.hash_paths(["src"])
+        assert sorted(digests) == [
+            os.path.join("src", "a.py"),
+            os.path.join("src", "empty.py"),
+            os.path.join("src", "sub", "b.py")]
+        assert digests[os.path.join("src", "a.py")] == \
+            hash_file(str(src.join("a.py")))
+        assert hasher.hashed_count == 3
+        digest = hasher.digest(["src"])
+        hasher.save()
+
+        # Digests of unchanged files are read from the cache
+        hasher = FileHasher(cache_file)
+        assert hasher.digest(["src"]) == digest
+        assert hasher.hashed_count == 0
+        assert hasher.reused_count == 3
+
+        # Modified files are hashed again
+        src.join("a.py").write("A")
+        os.utime(str(src.join("a.py")), (1, 1))
+        assert hasher.digest(["src"]) != digest
+        assert hasher.hashed_count == 1
+
+
+def test_git_hasher(tmpdir):
+    from ci.hashing import FileHasher, GitHasher, input_hasher
+
+    def _git(*args):
+        subprocess.check_output(
+            ["git", "-c", "user.name=ci", "-c", "user.email=ci@example.com"] +
+            list(args), cwd=str(tmpdir))
+
+    src = tmpdir.join("src")
+    src.join("a.py").write("a", ensure=True)
+    src.join("sub", "b.py").write("b", ensure=True)
+    tmpdir.join(".gitignore").write("*.log\n")
+    tmpdir.join("build.log").write("log")
+
+    with push_dir(str(tmpdir)):
+        assert isinstance(input_hasher(), FileHasher)
+
+        _git("init", "-q")
+        _git("add", ".")
+        _git("commit", "-q", "-m", "Initial")
+
+        hasher = input_hasher()
+        assert isinstance(hasher, GitHasher)
+
+        # Clean paths are associated with their tree or blob
+        digests = hasher.hash_paths(["src", ".gitignore"])
+        assert sorted(digests) == [".gitignore", "src"]
+        assert hasher.hashed_count == 0
+        digest = hasher.digest(["src"])
+
+        # Only modified and untracked files are hashed
+        src.join("sub", "b.py").write("B")
+        src.join("c.py").write("c")
+        digests = hasher.hash_paths(["src"])
+        assert sorted(digests) == [
+            os.path.join("src", "a.py"),
+            os.path.join("src", "c.py"),
+            os.path.join("src", "sub", "b.py")]
+        assert hasher.hashed_count == 2
+        assert hasher.digest(["src"]) != digest
+
+        # Explicitly listed ignored files are hashed
+        assert list(hasher.hash_paths(["build.log"])) == ["build.log"]
+
+        src.join("sub", "b.py").write("b")
+        src.join("c.py").remove()
+        assert hasher.digest(["src"]) == digest
+
+        # Git is executed a fixed number of times whatever the number of
+        # paths, which are not considered as patterns
+        for index in range(20):
+            src.join("key_%d.txt" % index).write("%d" % index)
+        src.join("*.txt").write("star")
+        _git("add", ".")
+        _git("commit", "-q", "-m", "Keys")
+        src.join("key_0.txt").write("modified")
+        calls = []
+        git = hasher._git
+
+        def _counting_git(*args):
+            calls.append(args)
+            return git(*args)
+
+        hasher._git = _counting_git
+        paths = [os.path.join("src", "key_%d.txt" % index)
+                 for index in range(20)] + [os.path.join("src", "*.txt")]
+        digests = hasher.hash_paths(paths + ["."])
+        assert len(calls) == 4  # rev-parse, status, ls-tree and ls-files
+        assert set(paths) <= set(digests)
+        assert hasher.hashed_count == 1
+        assert digests[os.path.join("src", "*.txt")] != \
+            digests[os.path.join("src", "key_1.txt")]
+        assert os.path.join("src", "a.py") in digests
+        hasher._git = git
+
+        # Paths outside of the checkout are hashed file by file
+        outside = tmpdir.join("..", "outside-%s.txt" % tmpdir.basename)
+        outside.write("outside")
+        try:
+            digests = hasher.hash_paths([str(outside), ".gitignore"])
+            assert sorted(digests) == sorted([str(outside), ".gitignore"])
+            assert hasher.hashed_count == 1
+            assert digests[str(outside)] == FileHasher().hash_paths(
+                [str(outside)])[str(outside)]
+
+            # If git fails, all the paths are hashed file by file
+            hasher.git = str(tmpdir.join("missing-git"))
+            digests = hasher.hash_paths([str(outside), ".gitignore"])
+            assert sorted(digests) == sorted([str(outside), ".gitignore"])
+            assert hasher.hashed_count == 2
+        finally:
+            outside.remove()
+
+
+def test_changed_paths_conditions(tmpdir, capfd):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        install:
+          commands:
+            - python: open("docs-built", "w").close()
+              only_if_changed:
+                - docs
+            - python: open("install-done", "w").close()
+        build:
+          only_if_changed:
+            - src/*.py
+          commands:
+            - python: open("build-done", "w").close()
+        test:
+          skip_if_changed_only:
+            - docs/*
+            - "*.rst"
+          commands:
+            - python: open("test-done", "w").close()
+        """
+    ).format(version=SCHEMA_VERSION))
+    tmpdir.join(".gitignore").write("*-done\n*-built\n")
+    tmpdir.join("src", "a.py").write("a", ensure=True)
+    tmpdir.join("docs", "index.rst").write("a", ensure=True)
+
+    def _git(*args):
+        subprocess.check_output(
+            ["git", "-c", "user.name=ci", "-c", "user.email=ci@example.com"] +
+            list(args), cwd=str(tmpdir))
+
+    def _done():
+        return sorted([path.basename for path in tmpdir.listdir()
+                       if path.basename.endswith(("-done", "-built"))])
+
+    service = 'circle'
+
+    environment = dict(os.environ)
+    enable_service(service, environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        _git("init", "-q")
+        _git("add", ".")
+        _git("commit", "-q", "-m", "Initial")
+
+        # Only documentation changed
+        tmpdir.join("docs", "index.rst").write("b")
+        tmpdir.join("README.rst").write("b")
+        execute_step("test", changed_base="HEAD")
+        assert _done() == ["docs-built", "install-done"]
+        env = Driver.read_env()
+        assert env['SCIKIT_CI_BUILD'] == '1'
+        assert env['SCIKIT_CI_TEST'] == '1'
+        output_lines, _ = captured_lines(capfd)
+        assert "[scikit-ci] Skipping step 'build': no changes matching " \
+               "src/*.py since HEAD" in output_lines
+
+        # Sources changed
+        for path in _done():
+            tmpdir.join(path).remove()
+        _git("checkout", "-q", "--", "docs")
+        tmpdir.join("README.rst").remove()
+        tmpdir.join("src", "a.py").write("b")
+        execute_step("test", changed_base="HEAD", clear_cached_env=True)
+        assert _done() == ["build-done", "install-done", "test-done"]
+
+        # Nothing changed since the last successful execution, except for
+        # the documentation built by the first execution
+        for path in _done():
+            tmpdir.join(path).remove()
+        captured_lines(capfd)
+        execute_step("test", clear_cached_env=True)
+        assert _done() == ["docs-built", "install-done", "test-done"]
+        output_lines, _ = captured_lines(capfd)
+        assert [line for line in output_lines
+                if line.startswith("[scikit-ci] Skipping step 'build'") and
+                "last-success (saved " in line]
+
+        # Files written by scikit-ci are not considered changed
+        assert tmpdir.join("env.json").exists()
+        assert tmpdir.join(".scikit-ci").exists()
+        _git("commit", "-q", "-a", "-m", "Sources")
+        tmpdir.join("docs", "index.rst").write("c")
+        execute_step("test", changed_base="HEAD", clear_cached_env=True)
+        output_lines, _ = captured_lines(capfd)
+        assert [line for line in output_lines if line.startswith(
+            "[scikit-ci] Skipping step 'test': only changes matching "
+            "docs/*, *.rst since HEAD")]
+
+        # Each step is compared with its own last successful execution
+        for path in _done():
+            tmpdir.join(path).remove()
+        tmpdir.join("src", "a.py").write("c")
+        execute_step("test", force=True, with_dependencies=False)
+        assert _done() == ["test-done"]
+        execute_step("build", force=True, with_dependencies=False)
+        assert _done() == ["build-done", "test-done"]
+        output_lines, _ = captured_lines(capfd)
+        assert "[scikit-ci] Skipping step 'build'" not in "\n".join(
+            output_lines)
+
+
+def test_resume_step(tmpdir):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: open("log", "a").write("0")
+            - python: |
+                      import os
+                      if os.path.exists("fail"):
+                          exit(1)
+                      open("log", "a").write("1")
+            - python: open("log", "a").write("2")
+        """
+    ).format(version=SCHEMA_VERSION))
+    tmpdir.join("fail").write("")
+
+    service = 'circle'
+
+    environment = dict(os.environ)
+    enable_service(service, environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        with pytest.raises(SKCIStepExecutionError):
+            execute_step("test", with_dependencies=False)
+        assert tmpdir.join("log").read() == "0"
+        env = Driver.read_env()
+        assert 'SCIKIT_CI_TEST_COMMAND_0' in env
+        assert 'SCIKIT_CI_TEST_COMMAND_1' not in env
+
+        # Resume from the failing command
+        tmpdir.join("fail").remove()
+        execute_step("test", with_dependencies=False, resume=True)
+        assert tmpdir.join("log").read() == "012"
+        env = Driver.read_env()
+        assert env['SCIKIT_CI_TEST'] == '1'
+        assert not [name for name in env
+                    if name.startswith('SCIKIT_CI_TEST_COMMAND_')]
+
+        # Without resuming, all commands are executed
+        tmpdir.join("log").remove()
+        tmpdir.join("fail").write("")
+        with pytest.raises(SKCIStepExecutionError):
+            execute_step("test", with_dependencies=False, force=True)
+        tmpdir.join("fail").remove()
+        execute_step("test", with_dependencies=False)
+        assert tmpdir.join("log").read() == "0012"
+
+
+def test_resume_after_skipped_command(tmpdir, capfd):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: open("log", "a").write("0")
+              only_if_changed:
+                - docs
+            - python: |
+                      import os
+                      if os.path.exists("fail"):
+                          exit(1)
+                      open("log", "a").write("1")
+            - python: open("log", "a").write("2")
+        """
+    ).format(version=SCHEMA_VERSION))
+    tmpdir.join(".gitignore").write("log\nfail\n")
+    tmpdir.join("docs", "index.rst").write("a", ensure=True)
+    tmpdir.join("fail").write("")
+
+    def _git(*args):
+        subprocess.check_output(
+            ["git", "-c", "user.name=ci", "-c", "user.email=ci@example.com"] +
+            list(args), cwd=str(tmpdir))
+
+    service = 'circle'
+
+    environment = dict(os.environ)
+    enable_service(service, environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        _git("init", "-q")
+        _git("add", ".")
+        _git("commit", "-q", "-m", "Initial")
+
+        with pytest.raises(SKCIStepExecutionError):
+            execute_step("test", with_dependencies=False,
+                         changed_base="HEAD")
+        assert not tmpdir.join("log").exists()
+        assert 'SCIKIT_CI_TEST_COMMAND_0' in Driver.read_env()
+
+        # Resuming continues after the skipped command, even if it would
+        # now be executed
+        tmpdir.join("fail").remove()
+        tmpdir.join("docs", "index.rst").write("b")
+        captured_lines(capfd)
+        execute_step("test", with_dependencies=False, changed_base="HEAD",
+                     resume=True)
+        assert tmpdir.join("log").read() == "12"
+        output_lines, _ = captured_lines(capfd)
+        assert "[scikit-ci] Skipping command 0: completed during a " \
+               "previous execution" in output_lines
+
+
+def test_jobserver(tmpdir):
+    from ci.jobserver import JobServer, jobserver
+
+    server = JobServer.create(3)
+    try:
+        tokens = [server.acquire() for _ in range(3)]
+        assert tokens == [None, b"+", b"+"]
+        for token in tokens:
+            server.release(token)
+
+        auth = "%d,%d" % (server.read_fd, server.write_fd)
+        assert server.makeflags("-k -j8 --jobserver-auth=9,10") == \
+            "-j3 --jobserver-fds=%s --jobserver-auth=%s -k" % (auth, auth)
+
+        inherited = JobServer.from_environment(server.environment({}))
+        assert (inherited.read_fd, inherited.write_fd, inherited.size) == \
+            (server.read_fd, server.write_fd, 3)
+        assert JobServer.from_environment({}) is None
+        assert JobServer.from_environment(
+            {"MAKEFLAGS": "-j2 --jobserver-auth=1000,1001"}) is None
+    finally:
+        server.close()
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: |
+                      import os, re
+                      makeflags = os.environ["MAKEFLAGS"]
+                      read_fd, write_fd = [int(fd) for fd in re.search(
+                          r"--jobserver-auth=(\d+),(\d+)", makeflags).groups()]
+                      token = os.read(read_fd, 1)
+                      os.write(write_fd, token)
+                      open("makeflags", "w").write(makeflags)
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+    environment["MAKEFLAGS"] = "-k"
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("test", max_jobs=2)
+        assert tmpdir.join("makeflags").read().startswith("-j2 ")
+        assert tmpdir.join("makeflags").read().endswith(" -k")
+        assert Driver.read_env()["MAKEFLAGS"] == "-k"
+
+        # Without --max-jobs nor inherited jobserver, make is not parallel
+        assert jobserver() is None
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/fd"),
+                    reason="requires /proc")
+def test_jobserver_acquire_without_token(monkeypatch):
+    import threading
+    from ci import jobserver as jobserver_module
+
+    server = jobserver_module.JobServer.create(1)
+    try:
+        assert server.acquire() is None
+        # Another process may read the token between select and read
+        monkeypatch.setattr(jobserver_module.select, "select",
+                            lambda read, write, error, timeout: (read, [], []))
+        tokens = []
+        waiter = threading.Thread(
+            target=lambda: tokens.append(server.acquire()))
+        waiter.daemon = True
+        waiter.start()
+        server.release(None)
+        waiter.join(10)
+        assert not waiter.is_alive()
+        assert tokens == [None]
+    finally:
+        server.close()
+
+
+def test_cgroup_cpu_quota(tmpdir, monkeypatch):
+    from ci import utils
+
+    monkeypatch.setattr(
+        utils, "_cgroup_paths", lambda controller: [str(tmpdir)])
+    assert utils.cgroup_cpu_quota() is None
+
+    tmpdir.join("cpu.cfs_quota_us").write("-1\n")
+    tmpdir.join("cpu.cfs_period_us").write("100000\n")
+    assert utils.cgroup_cpu_quota() is None
+    tmpdir.join("cpu.cfs_quota_us").write("250000\n")
+    assert utils.cgroup_cpu_quota() == 2.5
+
+    tmpdir.join("cpu.max").write("max 100000\n")
+    assert utils.cgroup_cpu_quota() is None
+    tmpdir.join("cpu.max").write("50000 100000\n")
+    assert utils.cgroup_cpu_quota() == 0.5
+    assert utils.cpu_count() == 1
+
+
+def test_admission_controller():
+    from ci.resources import AdmissionController, combine, parse_resources
+
+    assert parse_resources(None) == {"memory": 0, "cpus": 0.}
+    assert parse_resources({"memory": "1G", "cpus": 2}) == {
+        "memory": 1024 ** 3, "cpus": 2.}
+    assert combine([parse_resources({"memory": "1G"}),
+                    parse_resources({"memory": "512M", "cpus": 4})]) == {
+        "memory": 1024 ** 3, "cpus": 4.}
+
+    admission = AdmissionController(memory=1024, cpus=4)
+    large = {"memory": 2048, "cpus": 1}
+    small = {"memory": 512, "cpus": 2}
+    # Work exceeding the budget is admitted if nothing else runs
+    assert admission.fits(large)
+    admission.reserve(large)
+    assert not admission.fits(small)
+    admission.release(large)
+    admission.reserve(small)
+    assert admission.fits(small)
+    admission.reserve(small)
+    assert not admission.fits({"memory": 0, "cpus": 1})
+    admission.release(small)
+    assert admission.fits({"memory": 0, "cpus": 1})
+    assert AdmissionController().fits(large)
+
+
+def test_matrix_admission(tmpdir):
+    from ci.driver import step_resources
+    from ci.history import History
+    from ci.matrix import MatrixRunner
+    from ci.resources import AdmissionController
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        build:
+          resources:
+            memory: 1G
+          circle:
+            resources:
+              memory: 600M
+        test:
+          commands:
+            - python: |
+                      import glob, os, time
+                      source_dir = os.environ["SCIKIT_CI_SOURCE_DIR"]
+                      running = os.path.join(
+                          source_dir, "running-" + os.environ["A"])
+                      open(running, "w").close()
+                      time.sleep(0.2)
+                      assert glob.glob(
+                          os.path.join(source_dir, "running-*")) == [running]
+                      os.remove(running)
+              resources:
+                cpus: 2
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    environment['PYTHONPATH'] = root
+
+    messages = []
+    with push_dir(str(tmpdir)), push_env(**environment):
+        resources = step_resources(["build", "test"])
+        assert resources == {"memory": 600 * 1024 ** 2, "cpus": 2.}
+
+        runner = MatrixRunner(
+            "test", "scikit-ci.yml", max_workers=2, log=messages.append,
+            resources=resources,
+            admission=AdmissionController(memory=1024 ** 3))
+        entries = runner.run([{"A": "1"}, {"A": "2"}])
+        assert [entry.status for entry in entries] == ["success", "success"]
+        assert [message for message in messages
+                if "waiting for resources (memory: 600M" in message]
+
+        # Peak memory usage recorded during the previous execution is used
+        history = History()
+        assert history.maximum("memory/matrix/test/A-1") == \
+            entries[0].peak_rss
+        runner = MatrixRunner(
+            "test", "scikit-ci.yml", max_workers=2, log=messages.append,
+            resources=resources,
+            admission=AdmissionController(memory=1024 ** 3))
+        entries = runner.run([{"A": "1"}])
+        assert entries[0].resources["memory"] == \
+            history.maximum("memory/matrix/test/A-1")
+
+
+@pytest.mark.skipif(not hasattr(os, "killpg"), reason="requires killpg")
+def test_matrix_fail_fast_terminates_commands(tmpdir):
+    import time
+    from ci.exceptions import SKCIMatrixError
+    from ci.matrix import MatrixRunner
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: |
+                      import os, subprocess, sys, time
+                      pid_file = os.path.join(
+                          os.environ["SCIKIT_CI_SOURCE_DIR"], "sleeping.pid")
+                      if os.environ["A"] == "1":
+                          while not os.path.exists(pid_file):
+                              time.sleep(0.05)
+                          exit(1)
+                      # Started by the command, itself started by ci
+                      child = subprocess.Popen([
+                          sys.executable, "-c", "import time; time.sleep(60)"])
+                      with open(pid_file + ".tmp", "w") as output:
+                          output.write(str(child.pid))
+                      os.rename(pid_file + ".tmp", pid_file)
+                      child.wait()
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    environment['PYTHONPATH'] = root
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        runner = MatrixRunner("test", "scikit-ci.yml", max_workers=2,
+                              fail_fast=True)
+        start = time.time()
+        with pytest.raises(SKCIMatrixError):
+            runner.run([{"A": "1"}, {"A": "2"}])
+        assert time.time() - start < 30
+        assert [entry.status for entry in runner.entries] == [
+            "failure", "cancelled"]
+
+        # The process started by the command was terminated
+        pid = int(tmpdir.join("sleeping.pid").read())
+        for _ in range(100):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                break
+            time.sleep(0.05)
+        else:
+            pytest.fail("process %d is still running" % pid)
+
+
+def test_matrix_entry_not_started(tmpdir):
+    from ci.exceptions import SKCIMatrixError
+    from ci.matrix import MatrixRunner
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: pass
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    messages = []
+    with push_dir(str(tmpdir)):
+        runner = MatrixRunner("test", "scikit-ci.yml", log=messages.append)
+        runner.command = lambda: [str(tmpdir.join("missing"))]
+        with pytest.raises(SKCIMatrixError) as excinfo:
+            runner.run([{"A": "1"}])
+    entry = runner.entries[0]
+    assert entry.status == "failure"
+    assert isinstance(entry.error, OSError)
+    assert "A-1 (failed to start: " in str(excinfo.value)
+    assert [message for message in messages
+            if message.startswith("[scikit-ci] Matrix entry A-1: failure (")]
+
+
+def test_output_multiplexer():
+    import io
+    import re
+    import time
+    from ci.output import OutputMultiplexer, check_call
+
+    script = textwrap.dedent(
+        r"""
+        import sys, time
+        for index in range(3):
+            sys.stdout.write("%s-%d" % (sys.argv[1], index))
+            sys.stdout.flush()
+            time.sleep(0.01)
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+        sys.stdout.write("last")
+        """)
+
+    sinks = dict([(name, io.BytesIO()) for name in ["a", "b", "all"]])
+    multiplexer = OutputMultiplexer(timestamps=True)
+    multiplexer.start()
+    processes = []
+    for name in ["a", "b"]:
+        process = subprocess.Popen(
+            [sys.executable, "-c", script, name], stdout=subprocess.PIPE)
+        processes.append(process)
+        multiplexer.register(
+            process.stdout, [sinks[name], (sinks["all"], b"[all] ")],
+            prefix=name.encode() + b": ")
+    for process in processes:
+        process.wait()
+    multiplexer.stop()
+
+    for name in ["a", "b"]:
+        lines = sinks[name].getvalue().decode().splitlines()
+        assert [re.sub(r"\[\d\d:\d\d:\d\d\] ", "", line)
+                for line in lines] == [
+            "%s: %s-%d" % (name, name, index) for index in range(3)] + [
+            "%s: last" % name]
+    lines = sinks["all"].getvalue().decode().splitlines()
+    assert len(lines) == 8
+    assert all([line.startswith("[all] [") for line in lines])
+
+    stdout, stderr = io.BytesIO(), io.BytesIO()
+    check_call(
+        [sys.executable, "-c",
+         "import sys; print('out'); sys.stderr.write('err\\n')"],
+        stdout_sinks=[stdout], stderr_sinks=[stderr], prefix=b"> ")
+    assert stdout.getvalue() == b"> out\n"
+    assert stderr.getvalue() == b"> err\n"
+
+    with pytest.raises(subprocess.CalledProcessError):
+        check_call([sys.executable, "-c", "exit(3)"],
+                   stdout_sinks=[stdout], stderr_sinks=[stderr])
+
+    # Processes started in the background keeping the pipes open are not
+    # waited for
+    stdout = io.BytesIO()
+    start = time.time()
+    check_call(
+        [sys.executable, "-c", textwrap.dedent(
+            """
+            import subprocess, sys
+            subprocess.Popen([sys.executable, "-c",
+                              "import time; time.sleep(8)"])
+            sys.stdout.write("started")
+            """)],
+        stdout_sinks=[stdout], stderr_sinks=[stderr])
+    assert time.time() - start < 4
+    assert stdout.getvalue() == b"started"
+
+
+@pytest.mark.parametrize("with_tail", [True, False])
+def test_output_zero_copy(tmpdir, with_tail):
+    from ci.output import ZERO_COPY, FileSink, TailBuffer, check_call
+
+    script = ("import sys\n"
+              "for index in range(20000):\n"
+              "    sys.stdout.write('line %d\\n' % index)\n"
+              "sys.stderr.write('error\\n')\n")
+    expected = "".join(["line %d\n" % index for index in range(20000)])
+
+    with open(str(tmpdir.join("stdout")), "wb") as stdout, \
+            open(str(tmpdir.join("stderr")), "ab") as stderr, \
+            open(str(tmpdir.join("log")), "wb") as log:
+        assert FileSink(stdout).supports_zero_copy() == ZERO_COPY
+        # Splicing into files opened in append mode is not supported
+        assert not FileSink(stderr).supports_zero_copy()
+        tail = TailBuffer(2) if with_tail else None
+        check_call([sys.executable, "-c", script],
+                   stdout_sinks=[FileSink(stdout)],
+                   stderr_sinks=[FileSink(stderr)], log_file=log, tail=tail)
+
+    assert tmpdir.join("stdout").read() == expected
+    assert tmpdir.join("stderr").read() == "error\n"
+    assert sorted(tmpdir.join("log").read().splitlines(True)) == \
+        sorted(expected.splitlines(True) + ["error\n"])
+    if with_tail:
+        assert tail.lines() in (["line 19999", "error"],
+                                ["error", "line 19999"])
+
+
+def test_log_dir(tmpdir):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        build:
+          commands:
+            - python: print("building")
+        test:
+          commands:
+            - python: print("testing")
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("test", log_dir="logs")
+    assert tmpdir.join("logs", "build.log").read() == "building\n"
+    assert tmpdir.join("logs", "test.log").read() == "testing\n"
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "xz"])
+def test_log_dir_index(tmpdir, compression):
+    import hashlib
+    from ci.logs import COMPRESSIONS, read_command_output
+
+    if compression not in COMPRESSIONS:  # pragma: no cover
+        pytest.skip("%s compression is not supported" % compression)
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: print("first")
+            - python: |
+                import hashlib
+                for index in range(12000):
+                    print(hashlib.sha1(str(index).encode()).hexdigest())
+            - python: print("last")
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    expected = "".join(["%s\n" % hashlib.sha1(str(index).encode()).hexdigest()
+                        for index in range(12000)])
+    extension = COMPRESSIONS[compression][0]
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("test", log_dir="logs", log_compression=compression,
+                     log_max_size=16 * 1024)
+        files = json.loads(tmpdir.join(
+            "logs", "test.index.json").read())["files"]
+        assert files[0] == "test.log" + extension
+        assert len(files) > 1
+        assert read_command_output("logs", "test", 0) == b"first\n"
+        assert read_command_output(
+            "logs", "test", 1).decode() == expected
+        assert read_command_output("logs", "test", 2) == b"last\n"
+        with pytest.raises(KeyError):
+            read_command_output("logs", "test", 3)
+
+        # Only the last files are kept and each command has its own files
+        execute_step("test", force=True, log_dir="per-command",
+                     log_compression=compression, log_max_size=16 * 1024,
+                     log_max_files=2, log_per_command=True)
+        index = json.loads(tmpdir.join(
+            "per-command", "test.index.json").read())
+        assert len(index["files"]) == 4
+        assert sorted([name for name in os.listdir(
+            str(tmpdir.join("per-command"))) if name.startswith("test.")]) == \
+            sorted(index["files"] + ["test.index.json"])
+        assert index["commands"][0]["sections"][0]["file"] == \
+            "test.0.log" + extension
+        assert read_command_output("per-command", "test", 0) == b"first\n"
+        with pytest.raises(IOError):
+            read_command_output("per-command", "test", 1)
+        assert read_command_output("per-command", "test", 2) == b"last\n"
+
+
+def test_timings(tmpdir, capsys):
+    import threading
+    from ci.__main__ import main
+    from ci.timings import (
+        TIMINGS_DB, TimingRecorder, connect, load_statistics, percentile,
+        trend)
+
+    assert percentile([4, 1, 3, 2], 0.5) == 2.5
+    assert percentile([1, 2, 3, 4, 5], 0.9) == pytest.approx(4.6)
+    assert trend([1.] * 4 + [2.] * 5, window=5) is None
+    assert trend([1.] * 5 + [2.] * 5, window=5) == 1.
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: print("testing")
+            - python: import os; exit(int(os.environ["FAILING"]))
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(FAILING="0", **environment):
+        execute_step("test")
+    with push_dir(str(tmpdir)), push_env(FAILING="3", **environment):
+        with pytest.raises(SKCIStepExecutionError):
+            execute_step("test", clear_cached_env=True)
+
+    with push_dir(str(tmpdir)):
+        connection = connect()
+        try:
+            assert connection.execute(
+                "SELECT service, operating_system FROM runs").fetchall() == \
+                [("circle", None)] * 2
+            assert connection.execute(
+                "SELECT step, command_index, return_code FROM timings "
+                "WHERE step = 'test' ORDER BY rowid"
+            ).fetchall() == [
+                ("test", 0, 0), ("test", 1, 0), ("test", None, 0),
+                ("test", 0, 0), ("test", 1, 3), ("test", None, 3)]
+        finally:
+            connection.close()
+
+        # Concurrent executions do not lose measurements
+        def _record():
+            recorder = TimingRecorder()
+            recorder.service = "travis"
+            recorder.record("build", 1.)
+            recorder.save()
+
+        threads = [threading.Thread(target=_record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        statistics = load_statistics(TIMINGS_DB, service="travis")
+        assert [(stat.name, stat.durations) for stat in statistics] == [
+            ("build", [1.] * 8)]
+
+        capsys.readouterr()
+        main(["stats", "test"])
+        output = capsys.readouterr()[0]
+    assert "Steps:" in output
+    assert "Slowest commands:" in output
+    assert "test:0 print(\"testing\")" in output
+    assert "before_install" not in output
+
+
+def test_regression_detection(tmpdir, capfd):
+    from ci.exceptions import SKCIRegressionError
+    from ci.timings import TimingRecorder, median_absolute_deviation
+
+    assert median_absolute_deviation([1, 2, 3, 4, 100]) == 1
+
+    with push_dir(str(tmpdir)):
+        for duration in [0.1, 0.2, 0.1, 0.3, 0.2]:
+            recorder = TimingRecorder()
+            recorder.service = "circle"
+            recorder.record("test", duration)
+            recorder.record("build", 10 * duration)
+            recorder.save()
+        # Another service has its own baseline
+        recorder = TimingRecorder()
+        recorder.service = "travis"
+        assert recorder.baseline("test") == []
+        recorder.service = "circle"
+        assert sorted(recorder.baseline("test")) == [
+            0.1, 0.1, 0.2, 0.2, 0.3]
+        assert recorder.check("test", 1.) is None
+        assert recorder.check("build", 6.) is None
+        regression = recorder.check("build", 7.)
+        assert regression.median == 2.
+        assert "build took 7.00s instead of 2.00s" in str(regression)
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: import time; time.sleep(1.5)
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("test")
+        assert "Warning: test took" in capfd.readouterr()[0]
+        with pytest.raises(SKCIRegressionError) as excinfo:
+            execute_step("test", force=True, fail_on_regression=True)
+        assert "test took" in str(excinfo.value)
+        # The baseline now includes the slower executions
+        execute_step("test", force=True, fail_on_regression=True,
+                     regression_threshold=10)
+
+
+def test_parse_xtrace():
+    from ci.profiling import format_line_timings, parse_xtrace
+
+    script = "echo a\nfor i in 1 2; do\n  sleep 1\ndone\n"
+    trace = "\n".join([
+        "+100.000000 3 echo a",
+        "+100.500000 4 for i in 1 2",
+        "+100.500000 5 sleep 1",
+        "++101.500000 5 echo 'multi",
+        "line'",
+        "+102.000000 4 for i in 1 2",
+        "+102,000000 5 sleep 1"])
+    timings = parse_xtrace(trace, script, first_line=3, end_time=103.)
+    assert [(timing.number, timing.duration, timing.count)
+            for timing in timings] == [
+        (1, 0.5, 1), (2, 0., 2), (3, 2.5, 3)]
+    assert format_line_timings(timings)[2] == \
+        "    2.50s    3x     3: sleep 1"
+
+
+@pytest.mark.skipif(sys.platform.startswith("win"),
+                    reason="requires bash")
+def test_profile_shell(tmpdir, capfd):
+    import tempfile
+    from ci.timings import connect
+
+    if subprocess.call(
+            ["bash", "-c", "[ -n \"${EPOCHREALTIME:-}\" ]"]):
+        pytest.skip("requires bash >= 5.0")
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - |
+              echo "first"
+              sleep 0.5
+              echo "last"
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("test", profile_shell=True)
+        connection = connect()
+        try:
+            rows = connection.execute(
+                "SELECT line_number, line, duration FROM line_timings "
+                "ORDER BY line_number").fetchall()
+        finally:
+            connection.close()
+    output = capfd.readouterr()[0]
+    assert "first\nlast\n" in output
+    assert "[scikit-ci] Time per line:" in output
+    assert "2: sleep 0.5" in output
+    assert [row[:2] for row in rows] == [
+        (1, 'echo "first"'), (2, "sleep 0.5"), (3, 'echo "last"')]
+    assert rows[1][2] >= 0.5
+    assert not [name for name in os.listdir(tempfile.gettempdir())
+                if name.endswith(".sh.trace")]
+
+
+def test_profile_python(tmpdir, capfd):
+    import pstats
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: |
+                def slow_function():
+                    return sum(range(100000))
+                if __name__ == "__main__":
+                    slow_function()
+            - python: import os; exit(int(os.environ["EXIT_CODE"]))
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(EXIT_CODE="0", **environment):
+        execute_step("test", profile_python=True, profile_dir="profiles",
+                     profile_top=5)
+    output = capfd.readouterr()[0]
+    assert "Profile written into %s" % tmpdir.join(
+        "profiles", "test.0.pstats") in output
+    assert "slow_function" in output
+    stats = pstats.Stats(str(tmpdir.join("profiles", "test.0.pstats")))
+    assert [name for _, _, name in stats.stats if name == "slow_function"]
+    assert tmpdir.join("profiles", "test.1.pstats").exists()
+
+    # The exit code of profiled commands is preserved
+    with push_dir(str(tmpdir)), push_env(EXIT_CODE="3", **environment):
+        with pytest.raises(SKCIStepExecutionError) as excinfo:
+            execute_step("test", clear_cached_env=True,
+                         profile_python=True, profile_dir="profiles")
+    assert excinfo.value.return_code == 3
+
+
+def test_metrics_textfile(tmpdir):
+    import stat
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        install:
+          cache:
+            directories:
+              - deps
+            key_files:
+              - requirements.txt
+          commands:
+            - python: |
+                      import os
+                      if not os.path.exists("deps"):
+                          os.makedirs("deps")
+            - python: print("installed")
+        test:
+          commands:
+            - python: import os; exit(int(os.environ["EXIT_CODE"]))
+        """
+    ).format(version=SCHEMA_VERSION))
+    tmpdir.join('requirements.txt').write("package")
+    cache_dir = str(tmpdir.join("cache"))
+    metrics_textfile = str(tmpdir.join("metrics", "scikit_ci.prom"))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    def _samples():
+        samples = {}
+        for line in tmpdir.join("metrics", "scikit_ci.prom").readlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    labels = '{service="circle",os="",step="%s"}'
+    with push_dir(str(tmpdir)), push_env(EXIT_CODE="0", **environment):
+        execute_step("install", cache_dir=cache_dir,
+                     metrics_textfile=metrics_textfile)
+        samples = _samples()
+        assert samples["scikit_ci_step_commands" + labels % "install"] == 2
+        assert samples["scikit_ci_step_failures" + labels % "install"] == 0
+        assert samples["scikit_ci_step_cache_hits" + labels % "install"] == 0
+        assert samples[
+            "scikit_ci_step_cache_misses" + labels % "install"] == 1
+        assert samples[
+            "scikit_ci_step_duration_seconds" + labels % "install"] > 0
+        assert "scikit_ci_config_parse_seconds" + labels % "install" in \
+            samples
+
+    tmpdir.join("deps").remove()
+    with push_dir(str(tmpdir)), push_env(EXIT_CODE="1", **environment):
+        with pytest.raises(SKCIStepExecutionError):
+            execute_step("test", cache_dir=cache_dir, clear_cached_env=True,
+                         metrics_textfile=metrics_textfile)
+        samples = _samples()
+        # Metrics of the steps executed by previous processes are kept
+        assert samples["scikit_ci_step_cache_hits" + labels % "install"] == 1
+        assert samples[
+            "scikit_ci_step_cache_misses" + labels % "install"] == 0
+        assert samples["scikit_ci_step_commands" + labels % "test"] == 1
+        assert samples["scikit_ci_step_failures" + labels % "test"] == 1
+    text = tmpdir.join("metrics", "scikit_ci.prom").read()
+    assert text.count("# TYPE scikit_ci_step_failures gauge\n") == 1
+    assert stat.S_IMODE(os.stat(metrics_textfile).st_mode) == 0o644
+    assert sorted(tmpdir.join("metrics").listdir()) == [
+        tmpdir.join("metrics", "scikit_ci.prom"),
+        tmpdir.join("metrics", "scikit_ci.prom.lock")]
+
+    # Concurrent processes do not overwrite each other's metrics
+    from ci.metrics import MetricsTextfile
+
+    def _steps():
+        return len([name for name in _samples()
+                    if name.startswith("scikit_ci_step_commands{")])
+
+    recorded = _steps()
+    script = textwrap.dedent(
+        """
+        import sys
+        from ci.metrics import MetricsTextfile
+        for index in range(20):
+            MetricsTextfile(sys.argv[1]).record(
+                "%s-%d" % (sys.argv[2], index))
+        """)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    processes = [subprocess.Popen(
+        [sys.executable, "-c", script, metrics_textfile, name],
+        cwd=root) for name in ["a", "b", "c"]]
+    assert [process.wait() for process in processes] == [0, 0, 0]
+    MetricsTextfile(metrics_textfile).record("d")
+    assert _steps() == recorded + 3 * 20 + 1
+
+
+@pytest.mark.skipif(not __import__("ci.daemon").daemon.SUPPORTED,
+                    reason="requires Unix sockets and fork")
+def test_daemon(tmpdir):
+    import signal
+    import time
+    from ci.daemon import DAEMON_SOCKET
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: |
+                      import os, sys
+                      sys.stdout.write("pid %d\n" % os.getpid())
+                      sys.stderr.write("on stderr\n")
+                      exit(int(os.environ["EXIT_CODE"]))
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    environment['PYTHONPATH'] = root
+    environment['EXIT_CODE'] = "0"
+    socket_path = str(tmpdir.join(DAEMON_SOCKET))
+
+    def _ci(*args, **env):
+        process = subprocess.Popen(
+            [sys.executable, "-m", "ci"] + list(args), cwd=str(tmpdir),
+            env=dict(environment, **env), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        return process.returncode, output.decode(), error.decode()
+
+    with tmpdir.join("daemon.log").open("w") as log:
+        daemon = subprocess.Popen(
+            [sys.executable, "-m", "ci", "--daemon"], cwd=str(tmpdir),
+            env=environment, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        assert os.path.exists(socket_path)
+
+        # Output is written into the file descriptors of the client
+        code, output, error = _ci("test", "--clear-cached-env")
+        assert code == 0
+        assert "pid" in output
+        assert "on stderr" in error
+        assert "executing 'ci test --clear-cached-env' in %s" % tmpdir \
+            in tmpdir.join("daemon.log").read()
+
+        # The environment of the client is used and its exit code returned
+        code, output, error = _ci(
+            "test", "--clear-cached-env", EXIT_CODE="3")
+        assert code == 1
+        assert error.split("Return code:")[1].split()[0] == "3"
+
+        code, output, error = _ci("test", "--clear-cached-env", "--no-daemon")
+        assert code == 0
+        assert tmpdir.join("daemon.log").read().count("executing") == 2
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait()
+    assert not os.path.exists(socket_path)
+
+    # Without daemon, the invocation is executed by the client
+    code, output, error = _ci("test", "--clear-cached-env")
+    assert code == 0
+    assert "pid" in output
+
+
+@pytest.mark.skipif(not __import__("ci.zygote").zygote.SUPPORTED,
+                    reason="requires Unix sockets and fork")
+def test_python_zygote(tmpdir, capfd):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: |
+                import os, sys
+                print("preloaded: %s" % ("decimal" in sys.modules))
+                print("name: %s" % __name__)
+                print("cwd: %s" % os.getcwd())
+                print("value: %s" % os.environ["VALUE"])
+                sys.stderr.write("on stderr\n")
+            - python: |
+                import os, signal, sys
+                sys.stdout.flush()
+                if os.environ["EXIT"] == "signal":
+                    os.kill(os.getpid(), signal.SIGTERM)
+                exit(int(os.environ["EXIT"]))
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(VALUE="1", EXIT="0", **environment):
+        execute_step("test", python_preload=["decimal", "nonexistent"])
+    output, error = capfd.readouterr()
+    assert "Warning: failed to preload nonexistent" in output
+    assert "Started python zygote" in output
+    assert "preloaded: True" in output
+    assert "name: __main__" in output
+    assert "cwd: %s" % tmpdir in output
+    assert "value: 1" in output
+    assert "on stderr" in error
+
+    # Exit status is reported like for a new python process
+    for exit_status, return_code in [("3", 3), ("signal", -15)]:
+        with push_dir(str(tmpdir)), \
+                push_env(VALUE="2", EXIT=exit_status, **environment):
+            with pytest.raises(SKCIStepExecutionError) as excinfo:
+                execute_step("test", clear_cached_env=True,
+                             python_preload=["decimal"])
+        assert excinfo.value.return_code == return_code
+    assert "value: 2" in capfd.readouterr()[0]
+
+    # Modules starting threads are not preloaded: forking could deadlock
+    tmpdir.join("spawner.py").write(textwrap.dedent(
+        """
+        import threading, time
+        thread = threading.Thread(target=time.sleep, args=(60,))
+        thread.daemon = True
+        thread.start()
+        """
+    ))
+    with push_dir(str(tmpdir)), \
+            push_env(VALUE="3", EXIT="0", PYTHONPATH=str(tmpdir),
+                     **environment):
+        execute_step("test", clear_cached_env=True,
+                     python_preload=["decimal", "spawner"])
+    output = capfd.readouterr()[0]
+    assert "Warning: preloaded modules started 1 threads" in output
+    assert "Started python zygote" not in output
+    assert "value: 3" in output
+
+    # Arguments the zygote does not support are not silently dropped
+    from ci.zygote import Zygote
+    zygote = Zygote(["decimal"])
+    try:
+        with pytest.raises(TypeError) as excinfo:
+            zygote.popen("script.py", ["python", "script.py"],
+                         cwd=str(tmpdir), shell=True)
+        assert "cwd" in str(excinfo.value)
+        assert zygote._process is not None
+    finally:
+        zygote.close()
+
+
+def test_banners(tmpdir, capfd, monkeypatch):
+    from ci.banners import BANNERS_FILE, render_banner
+
+    cache_dir = tmpdir.join("cache")
+    expected = pyfiglet.Figlet().renderText("TEST")
+    with push_env(SCIKIT_CI_CACHE_DIR=str(cache_dir)):
+        assert render_banner("TEST") == expected
+        banners = json.loads(cache_dir.join(BANNERS_FILE).read())["banners"]
+        assert sorted(banners) == sorted([step.upper() for step in STEPS])
+
+        # Banners rendered by another version of pyfiglet are not used
+        content = json.loads(cache_dir.join(BANNERS_FILE).read())
+        assert content["pyfiglet"] == pyfiglet.__version__
+        content["banners"]["TEST"] = "outdated"
+        cache_dir.join(BANNERS_FILE).write(json.dumps(
+            dict(content, pyfiglet="0.0")))
+        assert render_banner("TEST") == expected
+        content["banners"]["TEST"] = "cached"
+        cache_dir.join(BANNERS_FILE).write(json.dumps(content))
+        assert render_banner("TEST") == "cached"
+
+        # Cached banners do not require importing pyfiglet
+        expected = pyfiglet.Figlet().renderText("BUILD")
+        for name in list(sys.modules):
+            if name.split(".")[0] == "pyfiglet":
+                monkeypatch.delitem(sys.modules, name)
+        assert render_banner("BUILD") == expected
+        assert "pyfiglet" not in sys.modules
+        monkeypatch.setitem(sys.modules, "pyfiglet", None)
+        with pytest.raises(ImportError):
+            render_banner("NOT A STEP")
+
+    assert render_banner("TEST", "plain") == "TEST\n====\n"
+    assert render_banner("TEST", "none") is None
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: print("executed")
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        execute_step("test", banner="plain")
+        output = capfd.readouterr()[0]
+        assert "\nTEST\n====\n\n[scikit-ci] Executing" in output
+        execute_step("test", clear_cached_env=True, banner="none")
+        output = capfd.readouterr()[0]
+        assert output.startswith("[scikit-ci] Executing")
+        assert "TEST" not in output
+
+
+def test_compile_plan(tmpdir, capfd, monkeypatch):
+    from ci.driver import compile_plan
+    from ci.exceptions import SKCIError
+    from ci.plan import decode_command, encode_command
+
+    command = {"python": "pass", "only_if_changed": ["src"]}
+    assert encode_command(command) == {
+        "language": "python", "command": "pass", "only_if_changed": ["src"]}
+    assert decode_command(encode_command(command)) == command
+    assert decode_command(encode_command("echo")) == "echo"
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        before_install:
+          environment:
+            FOO: "$<VALUE>-foo"
+          commands:
+            - echo "before_install $<FOO>"
+        test:
+          environment:
+            BAR: "$<FOO>-bar"
+          commands:
+            - echo "test $<BAR>"
+          circle:
+            environment:
+              BAZ: "$<BAR>-baz"
+            commands:
+              - python: import os; print("python " + os.environ["BAZ"])
+        """
+    ).format(version=SCHEMA_VERSION))
+    plan_file = str(tmpdir.join("plan.json"))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(VALUE="value", **environment):
+        plan = compile_plan(plan_file)
+        execute_step("test")
+    assert list(plan["steps"]) == ["before_install", "test"]
+    assert plan["steps"]["test"]["references"] == ["FOO"]
+    assert plan["steps"]["test"]["commands"][1] == {
+        "language": "python",
+        "command": 'import os; print("python " + os.environ["BAZ"])'}
+    expected = [line for line in captured_lines(capfd)[0]
+                if line.startswith(("before_install", "test", "python"))]
+    assert expected == ["before_install value-foo", "test value-foo-bar",
+                        "python value-foo-bar-baz"]
+
+    # Steps are executed without parsing the configuration
+    monkeypatch.setattr(Driver, "_config_cache", {})
+    monkeypatch.setattr(Driver, "_config_digests", {})
+    monkeypatch.setitem(sys.modules, "ruamel", None)
+    monkeypatch.setitem(sys.modules, "ruamel.yaml", None)
+    with push_dir(str(tmpdir)), push_env(VALUE="value", **environment):
+        execute_step("test", plan=plan_file)
+        output = captured_lines(capfd)[0]
+        # Definitions are the same as in the configuration
+        assert [line for line in output if "changed since" in line] == []
+        assert [line for line in output if line.startswith("test")] == []
+        execute_step("test", force=True, plan=plan_file)
+        assert [line for line in captured_lines(capfd)[0]
+                if line.startswith(("before_install", "test", "python"))] \
+            == expected
+
+    # Plans are refused once the configuration changed
+    tmpdir.join('scikit-ci.yml').write("# comment\n", mode="a")
+    with push_dir(str(tmpdir)), push_env(**environment):
+        with pytest.raises(SKCIError, match="is outdated"):
+            execute_step("test", force=True, plan=plan_file)
+
+
+def test_config_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(Driver, "_config_cache", {})
+    monkeypatch.setattr(Driver, "_config_digests", {})
+    config_file = tmpdir.join('scikit-ci.yml')
+    other_file = tmpdir.join('other.yml')
+    other_file.write("test: {}\n")
+    Driver.load_config(str(other_file))
+
+    # Only the last content of each configuration file is kept
+    for index in range(3):
+        config_file.write("test:\n  commands: [%d]\n" % index)
+        assert Driver.load_config(str(config_file))["test"]["commands"] == \
+            [index]
+    assert len(Driver._config_cache) == 2
+
+    # Configurations shared by several files are kept
+    config_file.write(other_file.read())
+    Driver.load_config(str(config_file))
+    assert len(Driver._config_cache) == 1
+    assert Driver.load_config(str(other_file)) == {"test": {}}
+
+
+def test_env_file_concurrent_updates(tmpdir):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        build:
+          environment:
+            BUILD_VALUE: "build"
+          commands:
+            - python: import time; time.sleep(0.5)
+        test:
+          environment:
+            TEST_VALUE: "test"
+          commands:
+            - python: import time; time.sleep(0.5)
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    environment['PYTHONPATH'] = root
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        # Variables modified by other processes are kept
+        driver = Driver()
+        driver.load_env()
+        driver.env["A"] = "driver"
+        driver.env["B"] = "driver"
+        driver.env["C"] = "driver"
+        Driver.update_env({"B": "other", "D": "other"})
+        driver.save_env_changes()
+        env = Driver.read_env()
+        assert [env["A"], env["B"], env["C"], env["D"]] == [
+            "driver", "other", "driver", "other"]
+        del driver.env["A"]
+        del driver.env["B"]
+        Driver.update_env({"B": "again"})
+        driver.save_env_changes()
+        env = Driver.read_env()
+        assert "A" not in env
+        assert [env["B"], env["C"], env["D"]] == ["again", "driver", "other"]
+        driver.unload_env()
+
+        # Steps executed concurrently both record their variables
+        processes = [subprocess.Popen(
+            [sys.executable, "-m", "ci", step, "--without-deps",
+             "--no-daemon"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for step in ["build", "test"]]
+        for process in processes:
+            process.communicate()
+            assert process.returncode == 0
+        env = Driver.read_env()
+        assert env["SCIKIT_CI_BUILD"] == "1"
+        assert env["SCIKIT_CI_TEST"] == "1"
+        assert env["BUILD_VALUE"] == "build"
+        assert env["TEST_VALUE"] == "test"
+
+
+def test_output_tail(tmpdir):
+    from ci.output import TailBuffer
+
+    tail = TailBuffer(max_lines=3, max_bytes=10)
+    tail.write(b"1\n2\n")
+    assert tail.lines() == ["1", "2"]
+    assert not tail.truncated
+    tail.write(b"3\n4\n")
+    assert tail.lines() == ["2", "3", "4"]
+    assert tail.truncated
+    tail.write(b"abcdefghi\n")
+    assert tail.lines() == ["4", "abcdefghi"]
+    tail.write(b"0123456789abc\n")
+    assert tail.lines() == ["3456789abc"]
+
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        test:
+          commands:
+            - python: |
+                      import sys
+                      for index in range(100):
+                          print("line %d" % index)
+                      sys.stderr.write("error\n")
+                      exit(1)
+        """
+    ).format(version=SCHEMA_VERSION))
+
+    environment = dict(os.environ)
+    enable_service('circle', environment)
+
+    with push_dir(str(tmpdir)), push_env(**environment):
+        with pytest.raises(SKCIStepExecutionError) as excinfo:
+            execute_step("test", tail_lines=3)
+    assert excinfo.value.output.splitlines() == [
+        "line 98", "line 99", "error"]
+    assert "Output (last lines):\n    line 98\n    line 99\n    error\n" \
+        in str(excinfo.value)
+
+
+def test_expand_matrix():
+    from ci.matrix import entry_name, expand_matrix
+
+    matrix = ordereddict()
+    matrix["axes"] = ordereddict([("A", [1, 2]), ("B", ["x", "y"])])
+    matrix["exclude"] = [{"A": 2, "B": "y"}]
+    matrix["include"] = [ordereddict([("A", 3), ("B", "z")]),
+                         {"A": "1", "B": "x"}]
+
+    entries = expand_matrix(matrix)
+    assert [entry_name(entry) for entry in entries] == [
+        "A-1_B-x", "A-1_B-y", "A-2_B-x", "A-3_B-z"]
+    assert entries[0] == {"A": "1", "B": "x"}
+
+
+def test_history_longest_first(tmpdir):
+    from ci.history import DEFAULT_ESTIMATE, History, longest_first
+
+    history_file = str(tmpdir.join("history.json"))
+    history = History(history_file, size=3)
+    assert history.estimate("a") is None
+    assert history.estimates(["a", "b"]) == {
+        "a": DEFAULT_ESTIMATE, "b": DEFAULT_ESTIMATE}
+
+    for duration in [1., 2., 9., 3.]:
+        history.record("a", duration)
+    history.record("b", 10.)
+    assert history.durations("a") == [2., 9., 3.]
+    assert history.estimate("a") == 3.
+
+    # Durations recorded concurrently are merged
+    other = History(history_file, size=3)
+    other.record("c", 5.)
+    other.save()
+    history.save()
+    history = History(history_file, size=3)
+    assert history.estimates(["a", "b", "c", "d"]) == {
+        "a": 3., "b": 10., "c": 5., "d": 6.}
+
+    estimates = {"a": 3., "b": 10., "c": 5., "d": 6., "e": 3.}
+    ordered, makespan = longest_first(
+        ["a", "b", "c", "d", "e"], estimates, 2)
+    assert ordered == ["b", "d", "c", "a", "e"]
+    assert makespan == 14.
+    assert longest_first(["a", "b"], estimates, 1)[1] == 13.
+    assert longest_first([], estimates, 4) == ([], 0.)
+
+
+def test_cli_matrix(tmpdir):
+    tmpdir.join('scikit-ci.yml').write(textwrap.dedent(
+        r"""
+        schema_version: "{version}"
+        matrix:
+          axes:
+            A: [1, 2]
+            B: [x, y]
+        test:
+          commands:
+            - python: |
+                      import os
+                      with open("result", "w") as output:
+                          output.write(os.environ["A"] + os.environ["B"])
+                      if os.environ["A"] + os.environ["B"] == "$<FAILING>":
+                          exit(1)
+            # Commands are executed in the work directory of the entry
+            - python $<SCIKIT_CI_SOURCE_DIR>/scripts/marker.py
+        """
+    ).format(version=SCHEMA_VERSION))
+    tmpdir.join("scripts", "marker.py").write(
+        'open("marker", "w").close()\n', ensure=True)
+    service = 'circle'
+
+    environment = dict(os.environ)
+    enable_service(service, environment)
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    environment['PYTHONPATH'] = root
+
+    subprocess.check_call(
+        "python -m ci matrix test -j 2",
+        shell=True,
+        env=environment,
+        stderr=subprocess.STDOUT,
+        cwd=str(tmpdir)
+    )
+
+    matrix_dir = tmpdir.join(".scikit-ci", "matrix")
+    assert sorted([path.basename for path in matrix_dir.listdir()]) == [
+        "A-1_B-x", "A-1_B-y", "A-2_B-x", "A-2_B-y"]
+    assert matrix_dir.join("A-2_B-y", "result").read() == "2y"
+    assert matrix_dir.join("A-2_B-y", "marker").exists()
+    assert not tmpdir.join("marker").exists()
+    assert "SCIKIT_CI_TEST" in matrix_dir.join("A-2_B-y", "env.json").read()
+    assert sorted([key for key in json.loads(
+        tmpdir.join(".scikit-ci", "history.json").read()).keys()
+        if key.startswith("matrix/")]) == [
+        "matrix/test/A-1_B-x", "matrix/test/A-1_B-y",
+        "matrix/test/A-2_B-x", "matrix/test/A-2_B-y"]
+
+    # Failure of one entry is reported
+    tmpdir.join('scikit-ci.yml').write(
+        tmpdir.join('scikit-ci.yml').read().replace("$<FAILING>", "1x"))
+    # Without history, entries are started in order
+    tmpdir.join(".scikit-ci").remove()
+    process = subprocess.Popen(
+        "python -m ci matrix test -j 1 --fail-fast --stream",
+        shell=True,
+        env=environment,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=str(tmpdir)
+    )
+    output = process.communicate()[0].decode()
+    assert process.returncode != 0
+    assert "Matrix entry A-1_B-x: failure" in output
+    assert "[A-1_B-x] [scikit-ci] Executing:" in output
+    assert "A-1_B-y  cancelled" in output
+    assert not matrix_dir.join("A-1_B-y").exists()